@@ -6,7 +6,11 @@ from sftkit.error import AccessDenied, InvalidArgument
 from sftkit.service import Service, with_db_connection, with_db_transaction
 
 from abrechnung.config import Config
-from abrechnung.core.auth import create_group_log
+from abrechnung.core.auth import (
+    create_group_log,
+    get_group_membership,
+    invalidate_group_membership_cache,
+)
 from abrechnung.core.decorators import (
     requires_group_permissions,
     with_group_last_changed_update,
@@ -21,14 +25,37 @@ from abrechnung.domain.accounts import (
 from abrechnung.domain.groups import GroupMember
 from abrechnung.domain.users import User
 
-from .common import _get_or_create_tag_ids
+from .balances import _invalidate_cached_balances
+from .common import _check_accounts_exist, _get_or_create_tag_ids
 
 
 class AccountService(Service[Config]):
     @staticmethod
-    async def _commit_revision(conn: asyncpg.Connection, revision_id: int):
-        """Touches a revision to have all associated constraints run"""
+    async def _fetch_clearing_state(conn: asyncpg.Connection, account_id: int) -> Optional[asyncpg.Record]:
+        return await conn.fetchrow(
+            "select deleted, clearing_shares from aggregated_account_history "
+            "where account_id = $1 and created_at <= now() order by created_at desc limit 1",
+            account_id,
+        )
+
+    async def _commit_revision(self, conn: asyncpg.Connection, revision_id: int):
+        """
+        Touches a revision to have all associated constraints run.
+
+        Invalidates the cached group balances if the change affects how clearing accounts are resolved.
+        """
+        group_id, account_id = await conn.fetchrow(
+            "select a.group_id, a.id from account_revision ar join account a on ar.account_id = a.id where ar.id = $1",
+            revision_id,
+        )
+        old_state = await self._fetch_clearing_state(conn, account_id)
         await conn.execute("update account_revision set created_at = now() where id = $1", revision_id)
+        new_state = await self._fetch_clearing_state(conn, account_id)
+        # new accounts start out with a balance of zero and need no changes to the cache
+        if old_state is not None and (
+            old_state["deleted"] != new_state["deleted"] or old_state["clearing_shares"] != new_state["clearing_shares"]
+        ):
+            await _invalidate_cached_balances(conn, group_id)
 
     @staticmethod
     async def _create_revision(conn: asyncpg.Connection, user: User, account_id: int) -> int:
@@ -49,17 +76,12 @@ class AccountService(Service[Config]):
         account_type: Optional[Union[str, list[str]]] = None,
     ) -> tuple[int, str]:
         """returns group id of the transaction"""
-        result = await conn.fetchrow(
-            "select a.type, a.group_id, can_write, is_owner "
-            "from group_membership gm join account a on gm.group_id = a.group_id and gm.user_id = $1 "
-            "where a.id = $2",
-            user.id,
-            account_id,
-        )
-        if not result:
+        result = await conn.fetchrow("select type, group_id from account where id = $1", account_id)
+        membership = None if result is None else await get_group_membership(conn, result["group_id"], user)
+        if result is None or membership is None:
             raise InvalidArgument("account not found")
 
-        if can_write and not (result["can_write"] or result["is_owner"]):
+        if can_write and not (membership.can_write or membership.is_owner):
             raise AccessDenied("user does not have write permissions")
 
         if account_type:
@@ -71,23 +93,11 @@ class AccountService(Service[Config]):
 
         return result["group_id"], result["type"]
 
-    @staticmethod
-    async def _check_account_exists(conn: asyncpg.Connection, group_id: int, account_id: int) -> int:
-        acc = await conn.fetchval(
-            "select account_id from account_state_valid_at() where group_id = $1 and account_id = $2 and not deleted",
-            group_id,
-            account_id,
-        )
-        if not acc:
-            raise InvalidArgument(f"Account with id {account_id}")
-
-        return True
-
     @with_db_transaction
     @requires_group_permissions()
     async def list_accounts(self, *, conn: Connection, user: User, group_id: int) -> list[Account]:
         rows = await conn.fetch(
-            "select * from full_account_state_valid_at(now()) where group_id = $1",
+            "select * from group_full_account_state_valid_at($1)",
             group_id,
         )
         return [
@@ -99,12 +109,24 @@ class AccountService(Service[Config]):
             for row in rows
         ]
 
+    @with_db_transaction
+    @requires_group_permissions()
+    async def list_accounts_json(self, *, conn: Connection, user: User, group_id: int) -> str:
+        """
+        Same as list_accounts but returns the json serialized list as built by the database.
+
+        This skips deserializing and validating the rows into pydantic models only to serialize them again.
+        """
+        rows = await conn.fetch("select data::text as json from group_account_json($1)", group_id)
+        return "[" + ",".join(row["json"] for row in rows) + "]"
+
     @with_db_connection
     @requires_group_permissions()
     async def get_account(self, *, conn: Connection, user: User, account_id: int) -> Account:
-        await self._check_account_permissions(conn=conn, user=user, account_id=account_id)
+        group_id, _ = await self._check_account_permissions(conn=conn, user=user, account_id=account_id)
         row = await conn.fetchrow(
-            "select * from full_account_state_valid_at(now()) where id = $1",
+            "select * from group_full_account_state_valid_at($1) where id = $2",
+            group_id,
             account_id,
         )
         if row["type"] == AccountType.clearing.value:
@@ -121,13 +143,39 @@ class AccountService(Service[Config]):
     ):
         if len(tag_ids) <= 0:
             return
-        for tag_id in tag_ids:
-            await conn.execute(
-                "insert into account_to_tag (account_id, revision_id, tag_id) values ($1, $2, $3)",
-                account_id,
-                revision_id,
-                tag_id,
-            )
+        await conn.execute(
+            "insert into account_to_tag (account_id, revision_id, tag_id) select $1, $2, unnest($3::int[])",
+            account_id,
+            revision_id,
+            tag_ids,
+        )
+
+    @staticmethod
+    async def _put_clearing_shares(
+        *,
+        conn: asyncpg.Connection,
+        group_id: int,
+        account_id: int,
+        revision_id: int,
+        clearing_shares: dict[int, float],
+    ):
+        shares = {share_account_id: value for share_account_id, value in clearing_shares.items() if value != 0}
+        if len(shares) <= 0:
+            return
+        await _check_accounts_exist(
+            conn=conn,
+            group_id=group_id,
+            account_ids=set(shares.keys()),
+            error_message="one of the accounts referenced by a clearing share does not exist in this group",
+        )
+        await conn.execute(
+            "insert into clearing_account_share (account_id, revision_id, share_account_id, shares) "
+            "select $1, $2, unnest($3::int[]), unnest($4::double precision[])",
+            account_id,
+            revision_id,
+            list(shares.keys()),
+            list(shares.values()),
+        )
 
     @with_db_transaction
     @requires_group_permissions(requires_write=True)
@@ -166,19 +214,13 @@ class AccountService(Service[Config]):
         await self._add_tags_to_revision(conn=conn, account_id=account_id, revision_id=revision_id, tag_ids=tag_ids)
 
         if account.clearing_shares and account.type == AccountType.clearing:
-            # TODO: make this more efficient
-            for share_account_id, value in account.clearing_shares.items():
-                if value == 0:
-                    continue
-                await self._check_account_exists(conn, group_id, share_account_id)
-                await conn.execute(
-                    "insert into clearing_account_share (account_id, revision_id, share_account_id, shares) "
-                    "values ($1, $2, $3, $4)",
-                    account_id,
-                    revision_id,
-                    share_account_id,
-                    value,
-                )
+            await self._put_clearing_shares(
+                conn=conn,
+                group_id=group_id,
+                account_id=account_id,
+                revision_id=revision_id,
+                clearing_shares=account.clearing_shares,
+            )
 
         await create_group_log(
             conn=conn,
@@ -220,19 +262,13 @@ class AccountService(Service[Config]):
         await self._add_tags_to_revision(conn=conn, account_id=account_id, revision_id=revision_id, tag_ids=tag_ids)
 
         if account.clearing_shares and account_type == AccountType.clearing.value:
-            # TODO: make this more efficient
-            for share_account_id, value in account.clearing_shares.items():
-                if value == 0:
-                    continue
-                await self._check_account_exists(conn, group_id, share_account_id)
-                await conn.execute(
-                    "insert into clearing_account_share (account_id, revision_id, share_account_id, shares) "
-                    "values ($1, $2, $3, $4)",
-                    account_id,
-                    revision_id,
-                    share_account_id,
-                    value,
-                )
+            await self._put_clearing_shares(
+                conn=conn,
+                group_id=group_id,
+                account_id=account_id,
+                revision_id=revision_id,
+                clearing_shares=account.clearing_shares,
+            )
 
         await create_group_log(
             conn=conn,
@@ -263,21 +299,24 @@ class AccountService(Service[Config]):
         # TODO: FIXME move this check into the database
 
         has_shares = await conn.fetchval(
-            "select exists (select from transaction_state_valid_at() t "
-            "where not deleted and $1 = any(involved_accounts))",
+            "select exists (select from group_transaction_state_valid_at($1) t "
+            "where not deleted and $2 = any(involved_accounts))",
+            group_id,
             account_id,
         )
 
         has_clearing_shares = await conn.fetchval(
-            "select exists(select from account_state_valid_at() a where not deleted and $1 = any(involved_accounts))",
+            "select exists(select from group_account_state_valid_at($1) a "
+            "where not deleted and $2 = any(involved_accounts))",
+            group_id,
             account_id,
         )
 
         has_usages = await conn.fetchval(
             "select 1 "
-            "from transaction_position_state_valid_at() p "
-            "join transaction t on t.id = p.transaction_id "
-            "where not p.deleted and $1 = any(p.involved_accounts)",
+            "from group_transaction_position_state_valid_at($1) p "
+            "where not p.deleted and $2 = any(p.involved_accounts)",
+            group_id,
             account_id,
         )
 
@@ -288,7 +327,8 @@ class AccountService(Service[Config]):
             raise InvalidArgument("Cannot delete an account that is references by a clearing account")
 
         row = await conn.fetchrow(
-            "select name, revision_id, deleted from account_state_valid_at() where account_id = $1",
+            "select name, revision_id, deleted from group_account_state_valid_at($1) where account_id = $2",
+            group_id,
             account_id,
         )
         if row is None:
@@ -298,7 +338,9 @@ class AccountService(Service[Config]):
             raise InvalidArgument("Cannot delete an already deleted account")
 
         has_clearing_shares = await conn.fetchval(
-            "select exists (select from account_state_valid_at() p where not p.deleted and $1 = any(p.involved_accounts))",
+            "select exists (select from group_account_state_valid_at($1) p "
+            "where not p.deleted and $2 = any(p.involved_accounts))",
+            group_id,
             account_id,
         )
 
@@ -310,6 +352,7 @@ class AccountService(Service[Config]):
             group_id,
             account_id,
         )
+        invalidate_group_membership_cache(group_id)
 
         revision_id = await self._create_revision(conn=conn, user=user, account_id=account_id)
         await conn.execute(
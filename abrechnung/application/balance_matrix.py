@@ -0,0 +1,287 @@
+"""
+Vectorized balance computation for large groups.
+
+Same semantics as compute_account_balances in abrechnung.application.balances, which serves as the reference
+implementation. Instead of looping over the share dictionaries of every transaction in python all shares, positions
+and usages of a group are flattened into arrays. The balance effects are then summed up per account with
+numpy and clearing accounts are resolved as a matrix over account indices.
+"""
+
+from typing import Iterable, NamedTuple
+
+import asyncpg
+import numpy as np
+
+from abrechnung.domain.balances import AccountBalance, AccountBalanceMap
+
+
+class BalanceArrays(NamedTuple):
+    """Flattened shares, positions and usages of all non-deleted transactions of a group"""
+
+    # per transaction, sorted by transaction id
+    transaction_ids: np.ndarray
+    is_transfer: np.ndarray
+    value: np.ndarray
+    currency_conversion_rate: np.ndarray
+    is_absolute: np.ndarray
+    # one entry per (transaction, account) share, transactions are given as indices into transaction_ids
+    creditor_transactions: np.ndarray
+    creditor_account_ids: np.ndarray
+    creditor_shares: np.ndarray
+    debitor_transactions: np.ndarray
+    debitor_account_ids: np.ndarray
+    debitor_shares: np.ndarray
+    # per non-deleted position
+    position_transactions: np.ndarray
+    position_price: np.ndarray
+    position_communist_shares: np.ndarray
+    # one entry per (position, account) usage, positions are given as indices into the position arrays
+    usage_positions: np.ndarray
+    usage_account_ids: np.ndarray
+    usages: np.ndarray
+
+
+class ClearingResult(NamedTuple):
+    # balances after redistributing clearing accounts, indexed like the account ids
+    balance: np.ndarray
+    # (clearing account id, account id) -> redistributed amount
+    resolution: dict[tuple[int, int], float]
+
+
+def _ints(values: Iterable[int]) -> np.ndarray:
+    return np.fromiter(values, dtype=np.int64)
+
+
+def _floats(values: Iterable[float]) -> np.ndarray:
+    return np.fromiter(values, dtype=np.float64)
+
+
+def _bools(values: Iterable[bool]) -> np.ndarray:
+    return np.fromiter(values, dtype=bool)
+
+
+def _flatten_shares(transactions: list[asyncpg.Record], column: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    shares = [
+        (i, int(account_id), value) for i, t in enumerate(transactions) for account_id, value in t[column].items()
+    ]
+    return (
+        _ints(share[0] for share in shares),
+        _ints(share[1] for share in shares),
+        _floats(share[2] for share in shares),
+    )
+
+
+async def fetch_balance_arrays(conn: asyncpg.Connection, group_id: int) -> BalanceArrays:
+    # positions and usages are read from the flat array columns of current_transaction_state,
+    # parsing the positions json of every transaction would take several times as long as the computation itself
+    transactions = await conn.fetch(
+        "select id, type = 'transfer' as is_transfer, value, currency_conversion_rate, "
+        "   split_mode = 'absolute' as is_absolute, creditor_shares, debitor_shares, position_prices, "
+        "   position_communist_shares, usage_positions, usage_account_ids, usage_shares "
+        "from current_transaction_state where group_id = $1 and not deleted order by id",
+        group_id,
+    )
+    creditor_transactions, creditor_account_ids, creditor_shares = _flatten_shares(transactions, "creditor_shares")
+    debitor_transactions, debitor_account_ids, debitor_shares = _flatten_shares(transactions, "debitor_shares")
+
+    n_positions = _ints(len(t["position_prices"]) for t in transactions)
+    n_usages = _ints(len(t["usage_positions"]) for t in transactions)
+    transaction_index = np.arange(len(transactions))
+    # usage positions are 1-based and relative to their transaction
+    position_offsets = np.cumsum(n_positions) - n_positions
+    usage_positions = np.repeat(position_offsets, n_usages) + _ints(
+        position for t in transactions for position in t["usage_positions"]
+    )
+    return BalanceArrays(
+        transaction_ids=_ints(t["id"] for t in transactions),
+        is_transfer=_bools(t["is_transfer"] for t in transactions),
+        value=_floats(t["value"] for t in transactions),
+        currency_conversion_rate=_floats(t["currency_conversion_rate"] for t in transactions),
+        is_absolute=_bools(t["is_absolute"] for t in transactions),
+        creditor_transactions=creditor_transactions,
+        creditor_account_ids=creditor_account_ids,
+        creditor_shares=creditor_shares,
+        debitor_transactions=debitor_transactions,
+        debitor_account_ids=debitor_account_ids,
+        debitor_shares=debitor_shares,
+        position_transactions=np.repeat(transaction_index, n_positions),
+        position_price=_floats(price for t in transactions for price in t["position_prices"]),
+        position_communist_shares=_floats(shares for t in transactions for shares in t["position_communist_shares"]),
+        usage_positions=usage_positions - 1,
+        usage_account_ids=_ints(account_id for t in transactions for account_id in t["usage_account_ids"]),
+        usages=_floats(shares for t in transactions for shares in t["usage_shares"]),
+    )
+
+
+def _index_of(sorted_ids: np.ndarray, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Maps ids onto their index in sorted_ids, the mask tells which ids are contained in sorted_ids at all"""
+    if len(sorted_ids) == 0:
+        return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+    index = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return index, sorted_ids[index] == ids
+
+
+def _safe_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator, dtype=np.float64), where=denominator != 0)
+
+
+def compute_transaction_totals(arrays: BalanceArrays, account_ids: np.ndarray) -> np.ndarray:
+    """
+    Sums up the balance effects of all transactions per account.
+
+    Returns an array of shape (5, len(account_ids)) holding the balance, consumed purchases, paid purchases,
+    received transfers and paid transfers of each account before clearing. account_ids have to be sorted,
+    shares of accounts which are not contained in them are ignored.
+    """
+    n_transactions = len(arrays.transaction_ids)
+    rate = arrays.currency_conversion_rate
+
+    position_tx = arrays.position_transactions
+    usage_position = arrays.usage_positions
+    total_usages = arrays.position_communist_shares + np.bincount(
+        usage_position, weights=arrays.usages, minlength=len(position_tx)
+    )
+    price_per_usage = _safe_divide(arrays.position_price * rate[position_tx], np.maximum(total_usages, 0))
+    usage_tx = position_tx[usage_position]
+    usage_amount = price_per_usage[usage_position] * arrays.usages
+
+    # the part of the positions which is not used by anyone in particular is billed onto the common debitors
+    remaining_value = arrays.value * rate - np.bincount(
+        position_tx,
+        weights=arrays.position_price * rate[position_tx] - price_per_usage * arrays.position_communist_shares,
+        minlength=n_transactions,
+    )
+
+    debitor_tx = arrays.debitor_transactions
+    total_debitor_shares = np.bincount(debitor_tx, weights=arrays.debitor_shares, minlength=n_transactions)
+    debitor_amount = np.where(
+        arrays.is_absolute[debitor_tx],
+        arrays.debitor_shares * rate[debitor_tx],
+        _safe_divide(remaining_value[debitor_tx], total_debitor_shares[debitor_tx]) * arrays.debitor_shares,
+    )
+    debitor_amount[total_debitor_shares[debitor_tx] == 0] = 0.0
+
+    creditor_tx = arrays.creditor_transactions
+    total_creditor_shares = np.bincount(creditor_tx, weights=arrays.creditor_shares, minlength=n_transactions)
+    creditor_amount = np.where(
+        total_creditor_shares[creditor_tx] > 0,
+        _safe_divide(arrays.value[creditor_tx], total_creditor_shares[creditor_tx])
+        * arrays.creditor_shares
+        * rate[creditor_tx],
+        0.0,
+    )
+
+    n_accounts = len(account_ids)
+    totals = np.zeros((5, n_accounts), dtype=np.float64)
+    for tx, accounts, amounts, sign, is_paid in (
+        (creditor_tx, arrays.creditor_account_ids, creditor_amount, 1.0, True),
+        (debitor_tx, arrays.debitor_account_ids, debitor_amount, -1.0, False),
+        (usage_tx, arrays.usage_account_ids, usage_amount, -1.0, False),
+    ):
+        account, known = _index_of(account_ids, accounts)
+        account, amount, is_transfer = account[known], amounts[known], arrays.is_transfer[tx[known]]
+        totals[0] += np.bincount(account, weights=sign * amount, minlength=n_accounts)
+        # consumed and paid totals are booked onto the purchase or transfer rows depending on the type
+        row = 2 if is_paid else 1
+        totals[row] += np.bincount(account, weights=np.where(is_transfer, 0.0, amount), minlength=n_accounts)
+        totals[row + 2] += np.bincount(account, weights=np.where(is_transfer, amount, 0.0), minlength=n_accounts)
+
+    return totals
+
+
+def resolve_clearing_matrix(
+    account_ids: np.ndarray, balance: np.ndarray, clearing_shares: dict[int, dict[int, float]]
+) -> ClearingResult:
+    """
+    Redistributes clearing account balances as a linear system over account indices.
+
+    clearing_shares have to be in topological order and free of cycles, as returned by _ordered_clearing_shares.
+    With C the matrix of normalized clearing shares (C[c, a] is the fraction clearing account c passes on to a)
+    the amount passing through every account is x = b + x C. Only the rows of clearing accounts are non-zero, so
+    the system splits into the amounts x_c passing through clearing accounts, x_c = b_c + x_c C_cc, and all other
+    accounts, x_o = b_o + x_c C_co. Indexing clearing accounts in topological order makes C_cc strictly triangular,
+    i.e. I - C_cc is always invertible. Accounts which are cleared to but are not part of account_ids (deleted ones)
+    get their own columns such that the clearing resolution is complete, they are cut off from the balances.
+    """
+    known_ids = set(account_ids.tolist())
+    clearing_ids = [account_id for account_id in clearing_shares if account_id in known_ids]
+    other_ids = sorted(
+        known_ids.difference(clearing_ids).union(
+            account_id
+            for shares in clearing_shares.values()
+            for account_id in shares
+            if account_id not in clearing_shares
+        )
+    )
+    # clearing accounts come first in topological order
+    all_ids = np.array(clearing_ids + other_ids, dtype=np.int64)
+    sorting = np.argsort(all_ids, kind="stable")
+    n_clearing = len(clearing_ids)
+
+    def _index(ids: np.ndarray) -> np.ndarray:
+        return sorting[np.searchsorted(all_ids[sorting], ids)]
+
+    rows = []
+    targets = []
+    fractions = []
+    for c, clearing_account_id in enumerate(clearing_ids):
+        shares = clearing_shares[clearing_account_id]
+        total_shares = sum(shares.values())
+        rows.extend([c] * len(shares))
+        targets.extend(shares.keys())
+        fractions.extend(value / total_shares for value in shares.values())
+    rows_array = np.array(rows, dtype=np.int64)
+    columns = _index(np.array(targets, dtype=np.int64))
+    matrix = np.zeros((n_clearing, len(all_ids)), dtype=np.float64)
+    # share targets are unique per clearing account
+    matrix[rows_array, columns] = fractions
+
+    account_index = _index(account_ids)
+    initial = np.zeros(len(all_ids), dtype=np.float64)
+    initial[account_index] = balance
+
+    clearing_flow = (
+        np.linalg.solve((np.eye(n_clearing) - matrix[:, :n_clearing]).T, initial[:n_clearing])
+        if n_clearing
+        else np.zeros(0)
+    )
+    final = initial + clearing_flow @ matrix
+    final[:n_clearing] = 0.0
+
+    amounts = clearing_flow[rows_array] * matrix[rows_array, columns]
+    resolution: dict[tuple[int, int], float] = {}
+    for clearing_index, account_id, amount in zip(rows, targets, amounts.tolist()):
+        key = (clearing_ids[clearing_index], account_id)
+        resolution[key] = resolution.get(key, 0.0) + amount
+    return ClearingResult(balance=final[account_index], resolution=resolution)
+
+
+def compute_account_balances_vectorized(
+    arrays: BalanceArrays, account_ids: list[int], clearing_shares: dict[int, dict[int, float]]
+) -> AccountBalanceMap:
+    """Vectorized equivalent of compute_account_balances, clearing_shares as returned by _ordered_clearing_shares"""
+    sorted_ids = np.array(sorted(account_ids), dtype=np.int64)
+    totals = compute_transaction_totals(arrays, sorted_ids)
+    clearing = resolve_clearing_matrix(sorted_ids, totals[0], clearing_shares)
+
+    balances: AccountBalanceMap = {}
+    for i, account_id in enumerate(sorted_ids.tolist()):
+        balances[account_id] = AccountBalance(
+            balance=clearing.balance[i],
+            before_clearing=totals[0, i],
+            total_consumed_purchases=totals[1, i],
+            total_paid_purchases=totals[2, i],
+            total_received_transfers=totals[3, i],
+            total_paid_transfers=totals[4, i],
+        )
+    for (clearing_account_id, account_id), amount in clearing.resolution.items():
+        balances[clearing_account_id].clearing_resolution[account_id] = amount
+        balance = balances.get(account_id)
+        if balance is None:
+            continue
+        # this assumes that no transfers were booked onto the clearing account
+        if amount > 0:
+            balance.total_paid_purchases += amount
+        else:
+            balance.total_consumed_purchases += -amount
+    return balances
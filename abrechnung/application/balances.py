@@ -0,0 +1,443 @@
+from typing import Any, Iterable, Mapping
+
+import asyncpg
+import numpy as np
+from sftkit.database import Connection
+from sftkit.service import Service, with_db_transaction
+
+from abrechnung.application.balance_matrix import (
+    compute_account_balances_vectorized,
+    compute_transaction_totals,
+    fetch_balance_arrays,
+    resolve_clearing_matrix,
+)
+from abrechnung.config import Config
+from abrechnung.core.decorators import requires_group_permissions
+from abrechnung.domain.accounts import AccountType
+from abrechnung.domain.balances import (
+    AccountBalance,
+    AccountBalanceMap,
+    TransactionAccountBalance,
+    TransactionBalanceEffect,
+)
+from abrechnung.domain.transactions import SplitMode, TransactionType
+from abrechnung.domain.users import User
+
+# indices into the per account accumulators of _transaction_balance_effect
+_POSITIONS = 0
+_COMMON_CREDITORS = 1
+_COMMON_DEBITORS = 2
+
+
+def _transaction_balance_effect(transaction: Mapping[str, Any]) -> dict[int, list[float]]:
+    # accumulates into plain lists as attribute access on pydantic models is comparatively slow
+    effect: dict[int, list[float]] = {}
+    rate = transaction["currency_conversion_rate"]
+    remaining_value = transaction["value"] * rate
+
+    def _account(account_id: int | str) -> list[float]:
+        account_id = int(account_id)
+        account = effect.get(account_id)
+        if account is None:
+            account = effect[account_id] = [0.0, 0.0, 0.0]
+        return account
+
+    for position in transaction["positions"]:
+        if position["deleted"]:
+            continue
+
+        total_usages = position["communist_shares"] + sum(position["usages"].values())
+        price_per_usage = position["price"] / total_usages * rate if total_usages > 0 else 0.0
+        for account_id, usage in position["usages"].items():
+            _account(account_id)[_POSITIONS] += price_per_usage * usage
+
+        # the part of the position which is not used by anyone in particular is billed onto the common debitors
+        remaining_value -= position["price"] * rate - price_per_usage * position["communist_shares"]
+
+    is_absolute = SplitMode(transaction["split_mode"]) == SplitMode.absolute
+    total_debitor_shares = sum(transaction["debitor_shares"].values())
+    for account_id, shares in transaction["debitor_shares"].items():
+        account = _account(account_id)
+        if total_debitor_shares == 0:
+            continue
+        if is_absolute:
+            account[_COMMON_DEBITORS] += shares * rate
+        else:
+            # shares and percent only differ in how they are displayed
+            account[_COMMON_DEBITORS] += remaining_value / total_debitor_shares * shares
+
+    total_creditor_shares = sum(transaction["creditor_shares"].values())
+    for account_id, shares in transaction["creditor_shares"].items():
+        account = _account(account_id)
+        if total_creditor_shares > 0:
+            account[_COMMON_CREDITORS] += transaction["value"] / total_creditor_shares * shares * rate
+
+    return effect
+
+
+def compute_transaction_balance_effect(transaction: Mapping[str, Any]) -> TransactionBalanceEffect:
+    """
+    Computes how a transaction changes the balances of its involved accounts.
+
+    The transaction can be any mapping with the keys of the transaction api model (or a row of
+    current_transaction_state), share dictionaries may be keyed by account ids as integers or strings.
+    Mirrors computeTransactionBalanceEffect of the frontend, except that absolute debitor shares are converted
+    with the currency conversion rate as well such that the effects of a transaction always sum up to zero.
+    """
+    return {
+        account_id: TransactionAccountBalance(
+            total=creditors - positions - debitors,
+            positions=positions,
+            common_creditors=creditors,
+            common_debitors=debitors,
+        )
+        for account_id, (positions, creditors, debitors) in _transaction_balance_effect(transaction).items()
+    }
+
+
+def _sort_clearing_accounts(clearing_shares: dict[int, dict[int, float]]) -> list[int]:
+    """
+    Orders clearing accounts such that every clearing account comes before all clearing accounts it distributes to.
+
+    Clearing accounts which are part of a cycle are left out, the database prevents those from being created.
+    """
+    in_degree: dict[int, int] = {account_id: 0 for account_id in clearing_shares}
+    for shares in clearing_shares.values():
+        for account_id in shares:
+            if account_id in in_degree:
+                in_degree[account_id] += 1
+
+    zero_degree = [account_id for account_id, degree in in_degree.items() if degree == 0]
+    order = []
+    while zero_degree:
+        account_id = zero_degree.pop()
+        order.append(account_id)
+        for next_account_id in clearing_shares[account_id]:
+            if next_account_id not in in_degree:
+                continue
+            in_degree[next_account_id] -= 1
+            if in_degree[next_account_id] == 0:
+                zero_degree.append(next_account_id)
+
+    return order
+
+
+def resolve_clearing_accounts(balances: AccountBalanceMap, clearing_shares: dict[int, dict[int, float]]):
+    """
+    Redistributes the balances of clearing accounts onto the accounts they clear to, in place.
+
+    Expects the balances to hold the sum of all transaction effects, i.e. 'balance' equals 'before_clearing'.
+    """
+    for clearing_account_id in _sort_clearing_accounts(clearing_shares):
+        shares = clearing_shares[clearing_account_id]
+        clearing_balance = balances.get(clearing_account_id)
+        if clearing_balance is None or not shares:
+            continue
+
+        to_split = clearing_balance.balance
+        clearing_balance.balance = 0.0
+        total_shares = sum(shares.values())
+        for account_id, account_shares in shares.items():
+            account_share = to_split * account_shares / total_shares
+            clearing_balance.clearing_resolution[account_id] = (
+                clearing_balance.clearing_resolution.get(account_id, 0.0) + account_share
+            )
+
+            balance = balances.get(account_id)
+            if balance is None:
+                continue
+            balance.balance += account_share
+            # this assumes that no transfers were booked onto the clearing account
+            if account_share > 0:
+                balance.total_paid_purchases += account_share
+            else:
+                balance.total_consumed_purchases += -account_share
+
+
+def _get_clearing_shares(accounts: Iterable[Mapping[str, Any]]) -> dict[int, dict[int, float]]:
+    return {
+        account["id"]: {int(account_id): shares for account_id, shares in account["clearing_shares"].items()}
+        for account in accounts
+        if AccountType(account["type"]) == AccountType.clearing and account["clearing_shares"]
+    }
+
+
+def _ordered_clearing_shares(accounts: Iterable[Mapping[str, Any]]) -> dict[int, dict[int, float]]:
+    """Clearing shares of all resolvable clearing accounts in topological order"""
+    clearing_shares = _get_clearing_shares(accounts)
+    return {account_id: clearing_shares[account_id] for account_id in _sort_clearing_accounts(clearing_shares)}
+
+
+# balance, consumed purchases, paid purchases, received transfers, paid transfers
+_N_TOTALS = 5
+
+
+def _add_transaction_totals(
+    totals: dict[int, list[float]], transaction: Mapping[str, Any], sign: float = 1.0, add_missing: bool = False
+):
+    # consumed and paid totals are booked onto the purchase or transfer columns depending on the type
+    offset = 3 if TransactionType(transaction["type"]) == TransactionType.transfer else 1
+    for account_id, (positions, creditors, debitors) in _transaction_balance_effect(transaction).items():
+        account_totals = totals.get(account_id)
+        if account_totals is None:
+            if not add_missing:
+                continue
+            account_totals = totals[account_id] = [0.0] * _N_TOTALS
+        account_totals[0] += sign * (creditors - positions - debitors)
+        account_totals[offset] += sign * (debitors + positions)
+        account_totals[offset + 1] += sign * creditors
+
+
+def _totals_to_balances(totals: dict[int, list[float]]) -> AccountBalanceMap:
+    return {
+        account_id: AccountBalance(
+            balance=balance,
+            before_clearing=balance,
+            total_consumed_purchases=consumed_purchases,
+            total_paid_purchases=paid_purchases,
+            total_received_transfers=received_transfers,
+            total_paid_transfers=paid_transfers,
+        )
+        for account_id, (
+            balance,
+            consumed_purchases,
+            paid_purchases,
+            received_transfers,
+            paid_transfers,
+        ) in totals.items()
+    }
+
+
+def compute_account_balances(
+    accounts: Iterable[Mapping[str, Any]], transactions: Iterable[Mapping[str, Any]]
+) -> AccountBalanceMap:
+    """
+    Computes the balances of all given accounts, mirroring computeAccountBalances of the frontend.
+
+    Accounts need the keys 'id', 'type' and 'clearing_shares', transactions the keys accepted by
+    compute_transaction_balance_effect as well as 'type'. Deleted accounts and transactions have to be filtered
+    out by the caller.
+    """
+    accounts = list(accounts)
+    totals: dict[int, list[float]] = {account["id"]: [0.0] * _N_TOTALS for account in accounts}
+    for transaction in transactions:
+        _add_transaction_totals(totals, transaction)
+
+    balances = _totals_to_balances(totals)
+    resolve_clearing_accounts(balances, _get_clearing_shares(accounts))
+    return balances
+
+
+def propagate_clearing_deltas(
+    balance_deltas: dict[int, float], clearing_shares: dict[int, dict[int, float]]
+) -> dict[tuple[int, int], float]:
+    """
+    Pushes balance changes of clearing accounts on to the accounts they clear to, in place.
+
+    Clearing is linear in the balances, so applying the propagated changes to balances computed by
+    compute_account_balances gives the same result as a recomputation as long as the clearing shares stay the same.
+    Returns the changes of the clearing resolutions keyed by (clearing account id, account id).
+    """
+    resolution_deltas: dict[tuple[int, int], float] = {}
+    for clearing_account_id in _sort_clearing_accounts(clearing_shares):
+        delta = balance_deltas.get(clearing_account_id, 0.0)
+        if delta == 0:
+            continue
+
+        balance_deltas[clearing_account_id] = 0.0
+        shares = clearing_shares[clearing_account_id]
+        total_shares = sum(shares.values())
+        for account_id, account_shares in shares.items():
+            account_delta = delta * account_shares / total_shares
+            key = (clearing_account_id, account_id)
+            resolution_deltas[key] = resolution_deltas.get(key, 0.0) + account_delta
+            balance_deltas[account_id] = balance_deltas.get(account_id, 0.0) + account_delta
+
+    return resolution_deltas
+
+
+_BALANCE_TRANSACTION_COLUMNS = (
+    "id, group_id, type, value, currency_conversion_rate, split_mode, creditor_shares, debitor_shares, positions, "
+    "deleted"
+)
+
+
+async def _fetch_group_accounts(conn: asyncpg.Connection, group_id: int) -> list[asyncpg.Record]:
+    return await conn.fetch(
+        "select account_id as id, type, clearing_shares from group_account_state_valid_at($1) where not deleted",
+        group_id,
+    )
+
+
+async def _invalidate_cached_balances(conn: asyncpg.Connection, group_id: int):
+    """Drops the cached balances of a group, they are recomputed from scratch the next time they are requested"""
+    await conn.execute("delete from balance_cache where group_id = $1", group_id)
+
+
+async def _recompute_cached_balances(conn: asyncpg.Connection, group_id: int):
+    await _invalidate_cached_balances(conn, group_id)
+    accounts = await _fetch_group_accounts(conn, group_id)
+    arrays = await fetch_balance_arrays(conn, group_id)
+    account_ids = np.array(sorted(account["id"] for account in accounts), dtype=np.int64)
+    # the transaction totals without clearing account redistributions are what transaction commits update later on
+    totals = compute_transaction_totals(arrays, account_ids)
+    clearing = resolve_clearing_matrix(account_ids, totals[0], _ordered_clearing_shares(accounts))
+
+    await conn.execute("insert into balance_cache (group_id) values ($1)", group_id)
+    await conn.execute(
+        "insert into account_balance (account_id, group_id, balance, before_clearing, total_consumed_purchases, "
+        "   total_paid_purchases, total_received_transfers, total_paid_transfers) "
+        "select b.account_id, $1, b.balance, b.before_clearing, b.consumed_purchases, b.paid_purchases, "
+        "   b.received_transfers, b.paid_transfers "
+        "from unnest($2::int[], $3::double precision[], $4::double precision[], $5::double precision[], "
+        "   $6::double precision[], $7::double precision[], $8::double precision[]) "
+        "   as b(account_id, balance, before_clearing, consumed_purchases, paid_purchases, received_transfers, "
+        "   paid_transfers)",
+        group_id,
+        account_ids.tolist(),
+        clearing.balance.tolist(),
+        *totals.tolist(),
+    )
+    resolutions = list(clearing.resolution.items())
+    await conn.execute(
+        "insert into account_clearing_resolution (clearing_account_id, account_id, group_id, amount) "
+        "select r.clearing_account_id, r.account_id, $1, r.amount "
+        "from unnest($2::int[], $3::int[], $4::double precision[]) as r(clearing_account_id, account_id, amount)",
+        group_id,
+        [key[0] for key, _ in resolutions],
+        [key[1] for key, _ in resolutions],
+        [amount for _, amount in resolutions],
+    )
+
+
+async def _fetch_transaction_balance_state(
+    conn: asyncpg.Connection, transaction_ids: list[int]
+) -> list[asyncpg.Record]:
+    """Fetches what _update_cached_balances needs to know about the current state of the given transactions"""
+    return await conn.fetch(
+        f"select {_BALANCE_TRANSACTION_COLUMNS} from current_transaction_state where id = any($1::int[])",
+        transaction_ids,
+    )
+
+
+async def _update_cached_balances(
+    conn: asyncpg.Connection, old_transactions: list[asyncpg.Record], new_transactions: list[asyncpg.Record]
+):
+    """
+    Applies the difference between the old and new state of committed transactions to the cached balances.
+
+    Groups without cached balances are skipped, they are computed from scratch once requested.
+    """
+    totals_by_group: dict[int, dict[int, list[float]]] = {}
+    for sign, transactions in ((-1.0, old_transactions), (1.0, new_transactions)):
+        for transaction in transactions:
+            if transaction["deleted"]:
+                continue
+            totals = totals_by_group.setdefault(transaction["group_id"], {})
+            _add_transaction_totals(totals, transaction, sign=sign, add_missing=True)
+
+    for group_id, totals in totals_by_group.items():
+        if not totals:
+            continue
+        if not await conn.fetchval("select exists (select from balance_cache where group_id = $1)", group_id):
+            continue
+
+        balance_deltas = {account_id: account_totals[0] for account_id, account_totals in totals.items()}
+        clearing_shares = _get_clearing_shares(await _fetch_group_accounts(conn, group_id))
+        resolution_deltas = propagate_clearing_deltas(balance_deltas, clearing_shares)
+
+        account_ids = list(balance_deltas.keys())
+        zeros = [0.0] * _N_TOTALS
+        await conn.execute(
+            "insert into account_balance as ab (account_id, group_id, balance, before_clearing, "
+            "   total_consumed_purchases, total_paid_purchases, total_received_transfers, total_paid_transfers) "
+            "select b.account_id, $1, b.balance, b.before_clearing, b.consumed_purchases, b.paid_purchases, "
+            "   b.received_transfers, b.paid_transfers "
+            "from unnest($2::int[], $3::double precision[], $4::double precision[], $5::double precision[], "
+            "   $6::double precision[], $7::double precision[], $8::double precision[]) "
+            "   as b(account_id, balance, before_clearing, consumed_purchases, paid_purchases, received_transfers, "
+            "   paid_transfers) "
+            "on conflict (account_id) do update set "
+            "   balance = ab.balance + excluded.balance, "
+            "   before_clearing = ab.before_clearing + excluded.before_clearing, "
+            "   total_consumed_purchases = ab.total_consumed_purchases + excluded.total_consumed_purchases, "
+            "   total_paid_purchases = ab.total_paid_purchases + excluded.total_paid_purchases, "
+            "   total_received_transfers = ab.total_received_transfers + excluded.total_received_transfers, "
+            "   total_paid_transfers = ab.total_paid_transfers + excluded.total_paid_transfers",
+            group_id,
+            account_ids,
+            [balance_deltas[account_id] for account_id in account_ids],
+            *([totals.get(account_id, zeros)[i] for account_id in account_ids] for i in range(_N_TOTALS)),
+        )
+        if resolution_deltas:
+            await conn.execute(
+                "insert into account_clearing_resolution as acr (clearing_account_id, account_id, group_id, amount) "
+                "select r.clearing_account_id, r.account_id, $1, r.amount "
+                "from unnest($2::int[], $3::int[], $4::double precision[]) as r(clearing_account_id, account_id, amount) "
+                "on conflict (clearing_account_id, account_id) do update set amount = acr.amount + excluded.amount",
+                group_id,
+                [key[0] for key in resolution_deltas],
+                [key[1] for key in resolution_deltas],
+                list(resolution_deltas.values()),
+            )
+
+
+class BalanceService(Service[Config]):
+    @with_db_transaction
+    @requires_group_permissions()
+    async def get_balances(self, *, conn: Connection, user: User, group_id: int) -> AccountBalanceMap:
+        """
+        Returns the current balances of all non-deleted accounts in a group.
+
+        The balances are served from the balance cache, which is filled on first access and updated incrementally
+        whenever a transaction is committed.
+        """
+        if not await conn.fetchval("select exists (select from balance_cache where group_id = $1)", group_id):
+            await _recompute_cached_balances(conn, group_id)
+
+        accounts = await conn.fetch(
+            "select a.account_id as id, a.type, a.clearing_shares, ab.balance, ab.before_clearing, "
+            "   ab.total_consumed_purchases, ab.total_paid_purchases, ab.total_received_transfers, "
+            "   ab.total_paid_transfers "
+            "from group_account_state_valid_at($1) a left join account_balance ab on a.account_id = ab.account_id "
+            "where not a.deleted",
+            group_id,
+        )
+        balances: AccountBalanceMap = {}
+        for account in accounts:
+            # accounts created after the cache was filled which have not been part of a transaction yet have no row
+            balance = AccountBalance() if account["balance"] is None else AccountBalance.model_validate(dict(account))
+            if AccountType(account["type"]) == AccountType.clearing:
+                balance.clearing_resolution = {int(account_id): 0.0 for account_id in account["clearing_shares"]}
+            balances[account["id"]] = balance
+
+        resolutions = await conn.fetch(
+            "select clearing_account_id, account_id, amount from account_clearing_resolution where group_id = $1",
+            group_id,
+        )
+        for resolution in resolutions:
+            clearing_balance = balances.get(resolution["clearing_account_id"])
+            if clearing_balance is None:
+                continue
+            amount = resolution["amount"]
+            clearing_balance.clearing_resolution[resolution["account_id"]] = amount
+            balance = balances.get(resolution["account_id"])
+            if balance is None:
+                continue
+            # same as in resolve_clearing_accounts
+            if amount > 0:
+                balance.total_paid_purchases += amount
+            else:
+                balance.total_consumed_purchases += -amount
+
+        return balances
+
+    @with_db_transaction
+    @requires_group_permissions()
+    async def compute_balances(self, *, conn: Connection, user: User, group_id: int) -> AccountBalanceMap:
+        """Computes the current balances of all non-deleted accounts in a group from scratch, bypassing the cache"""
+        accounts = await _fetch_group_accounts(conn, group_id)
+        arrays = await fetch_balance_arrays(conn, group_id)
+        return compute_account_balances_vectorized(
+            arrays, [account["id"] for account in accounts], _ordered_clearing_shares(accounts)
+        )
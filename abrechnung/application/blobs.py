@@ -0,0 +1,247 @@
+import hashlib
+import logging
+from datetime import timedelta
+from typing import AsyncIterator, NamedTuple
+
+from sftkit.database import Connection, Pool
+from sftkit.error import InvalidArgument
+from sftkit.service import Service
+
+from abrechnung.config import Config
+from abrechnung.core.blob_storage import BLOB_CHUNK_SIZE, BlobStorage, create_blob_storage
+
+logger = logging.getLogger(__name__)
+
+# how long uploaded blobs can be attached to transactions
+UPLOADED_BLOB_RETENTION = timedelta(hours=24)
+
+
+class StoredBlob(NamedTuple):
+    id: int
+    mime_type: str
+    size: int
+    # hex encoded sha256 hash of the content
+    sha256: str
+    # None if the content is stored in the database
+    storage_key: str | None
+
+
+class StagedBlob(NamedTuple):
+    """Received content, already written to the blob storage if one is configured, which no blob references yet"""
+
+    sha256: bytes
+    size: int
+    # None if the content is to be stored in the database
+    storage_key: str | None
+    content: bytes | None
+
+
+class BlobService(Service[Config]):
+    """
+    Content addressed storage of file attachments.
+
+    Blob metadata always lives in the blob table, the content either in its content column or, if a blob storage is
+    configured, in that storage under the storage key of the blob. Both can be mixed, e.g. while migrating.
+    """
+
+    def __init__(self, db_pool: Pool, config: Config, storage: BlobStorage | None = None):
+        super().__init__(db_pool, config)
+
+        self.storage = storage if storage is not None else create_blob_storage(self.config.blob_storage)
+
+    async def store_blob(self, *, conn: Connection, content: bytes, mime_type: str) -> int:
+        """Returns the blob with the given content, which is only stored if no such blob exists yet"""
+        content_hash = hashlib.sha256(content).digest()
+        # the reference count is maintained by triggers on file_history and blob_upload
+        blob_id = await conn.fetchval("select id from blob where sha256 = $1", content_hash)
+        if blob_id is not None:
+            return blob_id
+
+        if self.storage is None:
+            staged = StagedBlob(sha256=content_hash, size=len(content), storage_key=None, content=content)
+        else:
+            # if the transaction does not commit the object is left behind in the storage, which is harmless
+            storage_key = self.storage.new_key()
+            await self.storage.put(storage_key, content)
+            staged = StagedBlob(sha256=content_hash, size=len(content), storage_key=storage_key, content=None)
+        return await self.add_staged_blob(conn=conn, staged=staged, mime_type=mime_type)
+
+    @staticmethod
+    async def _insert_blob(*, conn: Connection, staged: StagedBlob, mime_type: str) -> tuple[int, str | None]:
+        """
+        Returns the id and storage key of the blob with the staged content, which is a concurrently committed one if
+        the staged content lost the race for its hash.
+
+        Under serializable isolation postgres raises a serialization failure instead if the concurrently committed
+        blob is not visible to the transaction, which is then retried.
+        """
+        blob = await conn.fetchrow(
+            "insert into blob (sha256, size, content, storage_key, mime_type) values ($1, $2, $3, $4, $5) "
+            "on conflict (sha256) do update set sha256 = excluded.sha256 returning id, storage_key",
+            staged.sha256,
+            staged.size,
+            staged.content,
+            staged.storage_key,
+            mime_type,
+        )
+        return blob["id"], blob["storage_key"]
+
+    async def stage_blob(self, chunks: AsyncIterator[bytes], max_size: int) -> StagedBlob:
+        """
+        Writes streamed content to the blob storage while hashing it, without holding a database connection.
+
+        Raises InvalidArgument as soon as the content exceeds max_size bytes.
+        """
+        content_hash = hashlib.sha256()
+        size = 0
+
+        async def _checked_chunks() -> AsyncIterator[bytes]:
+            nonlocal size
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise InvalidArgument(f"File is too large, maximum is {max_size // 1024}KB")
+                content_hash.update(chunk)
+                yield chunk
+
+        if self.storage is None:
+            content = b"".join([chunk async for chunk in _checked_chunks()])
+            return StagedBlob(sha256=content_hash.digest(), size=size, storage_key=None, content=content)
+
+        storage_key = self.storage.new_key()
+        await self.storage.put_stream(storage_key, _checked_chunks())
+        return StagedBlob(sha256=content_hash.digest(), size=size, storage_key=storage_key, content=None)
+
+    async def add_staged_blob(self, *, conn: Connection, staged: StagedBlob, mime_type: str) -> int:
+        """Returns the blob with the staged content, the staged content is discarded if such a blob already exists"""
+        blob_id = await conn.fetchval("select id from blob where sha256 = $1", staged.sha256)
+        if blob_id is None:
+            blob_id, storage_key = await self._insert_blob(conn=conn, staged=staged, mime_type=mime_type)
+            if storage_key == staged.storage_key:
+                return blob_id
+
+        if staged.storage_key is not None:
+            await conn.execute("insert into orphaned_blob (storage_key) values ($1)", staged.storage_key)
+        return blob_id
+
+    async def delete_expired_uploads(self) -> int:
+        """Deletes uploads which have not been attached in time, their blobs are deleted if they are not attached"""
+        n_deleted = await self.db_pool.fetchval(
+            "with deleted as (delete from blob_upload where uploaded_at < now() - $1::interval returning id) "
+            "select count(*) from deleted",
+            UPLOADED_BLOB_RETENTION,
+        )
+        return n_deleted
+
+    async def read_blob(self, *, conn: Connection, blob_id: int) -> tuple[str, bytes]:
+        blob = await conn.fetchrow("select content, storage_key, mime_type from blob where id = $1", blob_id)
+        if not blob:
+            raise InvalidArgument("File not found")
+
+        if blob["content"] is not None:
+            return blob["mime_type"], blob["content"]
+
+        if self.storage is None:
+            raise RuntimeError(f"blob {blob_id} lives in a blob storage but no blob storage is configured")
+        return blob["mime_type"], await self.storage.get(blob["storage_key"])
+
+    async def get_blob(self, *, conn: Connection, blob_id: int) -> StoredBlob:
+        blob = await conn.fetchrow(
+            "select id, mime_type, size, encode(sha256, 'hex') as sha256, storage_key from blob where id = $1",
+            blob_id,
+        )
+        if not blob:
+            raise InvalidArgument("File not found")
+        return StoredBlob(**blob)
+
+    async def get_blobs(self, *, conn: Connection, blob_ids: list[int]) -> dict[int, StoredBlob]:
+        blobs = await conn.fetch(
+            "select id, mime_type, size, encode(sha256, 'hex') as sha256, storage_key from blob where id = any($1::int[])",
+            blob_ids,
+        )
+        if len(blobs) != len(set(blob_ids)):
+            raise InvalidArgument("File not found")
+        return {blob["id"]: StoredBlob(**blob) for blob in blobs}
+
+    async def stream_blob(self, blob: StoredBlob, start: int = 0, end: int | None = None) -> AsyncIterator[bytes]:
+        """Yields the bytes [start, end) of a blob in chunks without holding a database connection in between"""
+        end = blob.size if end is None else end
+        if start >= end:
+            return
+
+        if blob.storage_key is not None:
+            if self.storage is None:
+                raise RuntimeError(f"blob {blob.id} lives in a blob storage but no blob storage is configured")
+            async for chunk in self.storage.stream(blob.storage_key, start, end):
+                yield chunk
+            return
+
+        for offset in range(start, end, BLOB_CHUNK_SIZE):
+            # substring is 1-based, slices of uncompressed values are read without detoasting the whole value
+            chunk = await self.db_pool.fetchval(
+                "select substring(content from $2 for $3) from blob where id = $1",
+                blob.id,
+                offset + 1,
+                min(BLOB_CHUNK_SIZE, end - offset),
+            )
+            if chunk is None:
+                raise FileNotFoundError(f"blob {blob.id} no longer exists in the database")
+            yield chunk
+
+    async def move_blobs_to_storage(self, batch_size: int = 100) -> int:
+        """Moves the content of all blobs stored in the database to the blob storage, returns the number of blobs"""
+        if self.storage is None:
+            raise InvalidArgument("no blob storage is configured, blobs are kept in the database")
+
+        n_moved = 0
+        while True:
+            # every batch is committed on its own, blobs locked by concurrent uploads or deletions are skipped
+            async with self.db_pool.acquire() as conn:
+                async with conn.transaction():
+                    blobs = await conn.fetch(
+                        "select id, content from blob where content is not null order by id limit $1 "
+                        "for update skip locked",
+                        batch_size,
+                    )
+                    if not blobs:
+                        return n_moved
+
+                    moved = []
+                    for blob in blobs:
+                        storage_key = self.storage.new_key()
+                        await self.storage.put(storage_key, blob["content"])
+                        moved.append((blob["id"], storage_key))
+                    await conn.executemany(
+                        "update blob set storage_key = $2, content = null where id = $1",
+                        moved,
+                    )
+
+            n_moved += len(blobs)
+            logger.info(f"Moved {n_moved} blobs to the blob storage")
+
+    async def delete_orphaned_blobs(self, batch_size: int = 100) -> int:
+        """Deletes the storage objects of deleted blobs, returns the number of deleted objects"""
+        if self.storage is None:
+            return 0
+
+        n_deleted = 0
+        while True:
+            async with self.db_pool.acquire() as conn:
+                async with conn.transaction():
+                    storage_keys = await conn.fetch(
+                        "delete from orphaned_blob where storage_key in ("
+                        "   select storage_key from orphaned_blob limit $1 for update skip locked"
+                        ") returning storage_key",
+                        batch_size,
+                    )
+                    if not storage_keys:
+                        return n_deleted
+
+                    for row in storage_keys:
+                        await self.storage.delete(row["storage_key"])
+
+            n_deleted += len(storage_keys)
+
+    async def close(self):
+        if self.storage is not None:
+            await self.storage.close()
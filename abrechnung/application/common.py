@@ -1,24 +1,36 @@
 from typing import Optional
 
+import asyncpg
 from sftkit.database import Connection
+from sftkit.error import InvalidArgument
 
 
 async def _get_or_create_tag_ids(*, conn: Connection, group_id: int, tags: Optional[list[str]]) -> list[int]:
     if not tags or len(tags) <= 0:
         return []
-    tag_rows = await conn.fetch(
-        "select * from tag where group_id = $1 and name = any(($2::varchar(255)[]))",
+    return await conn.fetchval(
+        "with new_tag as ("
+        "   insert into tag (group_id, name) select $1, unnest($2::varchar(255)[]) on conflict do nothing returning id"
+        ") "
+        "select coalesce(array_agg(t.id), array []::integer[]) from ("
+        "   select id from new_tag "
+        "   union all "
+        "   select id from tag where group_id = $1 and name = any($2::varchar(255)[])"
+        ") t",
         group_id,
-        tags,
+        list(set(tags)),
     )
-    tag_ids = [t["id"] for t in tag_rows]
-    existing_tag_names = [t["name"] for t in tag_rows]
-    for t in tags:
-        if t not in existing_tag_names:
-            tag_id = await conn.fetchval(
-                "insert into tag (group_id, name) values ($1, $2) returning id",
-                group_id,
-                t,
-            )
-            tag_ids.append(tag_id)
-    return tag_ids
+
+
+async def _check_accounts_exist(
+    *, conn: asyncpg.Connection, group_id: int, account_ids: set[int], error_message: str
+) -> None:
+    if len(account_ids) <= 0:
+        return
+    n_accounts = await conn.fetchval(
+        "select count(*) from group_account_state_valid_at($1) where account_id = any($2::int[]) and not deleted",
+        group_id,
+        list(account_ids),
+    )
+    if len(account_ids) != n_accounts:
+        raise InvalidArgument(error_message)
@@ -1,19 +1,25 @@
 import base64
 import json
+import mimetypes
 import typing
+from typing import AsyncIterator
 
 from sftkit.database import Connection, Pool
 from sftkit.error import InvalidArgument
 from sftkit.service import Service, with_db_transaction
 
 from abrechnung.application.accounts import AccountService
+from abrechnung.application.blobs import StoredBlob
+from abrechnung.application.common import _get_or_create_tag_ids
 from abrechnung.application.groups import GroupService
 from abrechnung.application.transactions import TransactionService
 from abrechnung.config import Config
+from abrechnung.core.archives import ArchiveEntry, stream_tar, stream_zip
 from abrechnung.core.decorators import requires_group_permissions
 from abrechnung.domain.accounts import Account, AccountType, ClearingAccount, NewAccount, PersonalAccount
 from abrechnung.domain.export_import import (
     ClearingAccountJsonExportV1,
+    ExportFormat,
     FileAttachmentJsonExportV1,
     GroupJsonExportV1,
     GroupMetadataExportV1,
@@ -22,9 +28,18 @@ from abrechnung.domain.export_import import (
     TransactionPositionJsonExportV1,
 )
 from abrechnung.domain.groups import Group
-from abrechnung.domain.transactions import NewFile, NewTransaction, NewTransactionPosition, Transaction
+from abrechnung.domain.transactions import (
+    NewFile,
+    NewTransaction,
+    NewTransactionPosition,
+    Transaction,
+)
 from abrechnung.domain.users import User
 
+# name of the json document in archive exports, file attachments are stored as separate entries in EXPORT_ATTACHMENT_DIR
+EXPORT_ARCHIVE_JSON_NAME = "group.json"
+EXPORT_ATTACHMENT_DIR = "attachments"
+
 
 def _personal_account_to_export(account: PersonalAccount) -> PersonalAccountJsonExportV1:
     return PersonalAccountJsonExportV1(id=account.id, name=account.name, description=account.description)
@@ -56,56 +71,50 @@ class ExportImportService(Service[Config]):
         self.account_service = account_service
         self.transaction_service = transaction_service
 
-    async def _transactions_to_export(
-        self, conn: Connection, user: User, transactions: list[Transaction]
-    ) -> list[TransactionJsonExportV1]:
-        mapped = []
-        for transaction in transactions:
-            mapped_files = []
-            for file in transaction.files:
-                mime_type, content = await self.transaction_service.read_file_contents(
-                    conn=conn, user=user, file_id=file.id, blob_id=file.blob_id
-                )
-                mapped_files.append(
-                    FileAttachmentJsonExportV1(
-                        filename=file.filename, mime_type=mime_type, content=base64.b64encode(content).decode("utf-8")
-                    )
-                )
-            mapped_positions = []
-            for position in transaction.positions:
-                mapped_positions.append(
-                    TransactionPositionJsonExportV1(
-                        id=position.id,
-                        name=position.name,
-                        price=position.price,
-                        communist_shares=position.communist_shares,
-                        usages=position.usages,
-                    )
-                )
-
-            mapped.append(
-                TransactionJsonExportV1(
-                    id=transaction.id,
-                    type=transaction.type,
-                    name=transaction.name,
-                    description=transaction.description,
-                    value=transaction.value,
-                    currency_identifier=transaction.currency_identifier,
-                    currency_conversion_rate=transaction.currency_conversion_rate,
-                    billed_at=transaction.billed_at,
-                    tags=transaction.tags,
-                    creditor_shares=transaction.creditor_shares,
-                    debitor_shares=transaction.debitor_shares,
-                    positions=mapped_positions,
-                    files=mapped_files,
-                    split_mode=transaction.split_mode,
+    @staticmethod
+    def _transaction_to_export(
+        transaction: Transaction, files: list[FileAttachmentJsonExportV1]
+    ) -> TransactionJsonExportV1:
+        mapped_positions = []
+        for position in transaction.positions:
+            mapped_positions.append(
+                TransactionPositionJsonExportV1(
+                    id=position.id,
+                    name=position.name,
+                    price=position.price,
+                    communist_shares=position.communist_shares,
+                    usages=position.usages,
                 )
             )
-        return mapped
+
+        return TransactionJsonExportV1(
+            id=transaction.id,
+            type=transaction.type,
+            name=transaction.name,
+            description=transaction.description,
+            value=transaction.value,
+            currency_identifier=transaction.currency_identifier,
+            currency_conversion_rate=transaction.currency_conversion_rate,
+            billed_at=transaction.billed_at,
+            tags=transaction.tags,
+            creditor_shares=transaction.creditor_shares,
+            debitor_shares=transaction.debitor_shares,
+            positions=mapped_positions,
+            files=files,
+            split_mode=transaction.split_mode,
+        )
 
     @with_db_transaction
     @requires_group_permissions()
-    async def export_group_as_json(self, *, conn: Connection, user: User, group_id: int) -> GroupJsonExportV1:
+    async def _read_group_export(
+        self, *, conn: Connection, user: User, group_id: int
+    ) -> tuple[GroupJsonExportV1, list[StoredBlob]]:
+        """
+        Reads a consistent snapshot of the group without the contents of its file attachments.
+
+        @returns dump, blobs: the dump with the archive path of each file attachment set and the blobs of all file
+        attachments in the order they appear in the dump, their contents can be streamed after the snapshot ended
+        """
         group_details: Group = await self.group_service.get_group(conn=conn, user=user, group_id=group_id)
         accounts: list[Account] = await self.account_service.list_accounts(conn=conn, user=user, group_id=group_id)
         personal_accounts = list(
@@ -124,11 +133,28 @@ class ExportImportService(Service[Config]):
         transactions: list[Transaction] = await self.transaction_service.list_transactions(
             conn=conn, user=user, group_id=group_id
         )
+        mapped_transactions = []
+        blob_ids = []
+        for transaction in transactions:
+            mapped_files = []
+            for file in transaction.files:
+                if file.deleted or file.blob_id is None or file.mime_type is None:
+                    continue
+                extension = mimetypes.guess_extension(file.mime_type) or ""
+                mapped_files.append(
+                    FileAttachmentJsonExportV1(
+                        filename=file.filename,
+                        mime_type=file.mime_type,
+                        path=f"{EXPORT_ATTACHMENT_DIR}/{transaction.id}/{file.id}{extension}",
+                    )
+                )
+                blob_ids.append(file.blob_id)
+            mapped_transactions.append(self._transaction_to_export(transaction, mapped_files))
 
         dump = GroupJsonExportV1(
             personal_accounts=personal_accounts,
             events=events,
-            transactions=await self._transactions_to_export(conn=conn, user=user, transactions=transactions),
+            transactions=mapped_transactions,
             metadata=GroupMetadataExportV1(
                 name=group_details.name,
                 description=group_details.description,
@@ -138,78 +164,155 @@ class ExportImportService(Service[Config]):
             ),
             version=1,
         )
+        stored_blobs = await self.transaction_service.blob_service.get_blobs(conn=conn, blob_ids=blob_ids)
+        return dump, [stored_blobs[blob_id] for blob_id in blob_ids]
+
+    @with_db_transaction
+    @requires_group_permissions()
+    async def export_group_as_json(self, *, conn: Connection, user: User, group_id: int) -> GroupJsonExportV1:
+        dump, blobs = await self._read_group_export(conn=conn, user=user, group_id=group_id)
+        files = [file for transaction in dump.transactions for file in transaction.files]
+        for file, blob in zip(files, blobs):
+            _, content = await self.transaction_service.blob_service.read_blob(conn=conn, blob_id=blob.id)
+            file.content = base64.b64encode(content).decode("utf-8")
+            file.path = None
         return dump
 
-    async def _import_group_from_json_v1(
-        self, *, conn: Connection, user: User, dump: GroupJsonExportV1
-    ) -> tuple[int, dict[int, int]]:
-        # mapping of account ids in the dump to account ids in the newly created group
-        account_mapping: dict[int, int] = {}
+    async def _stream_base64(self, blob: StoredBlob) -> AsyncIterator[bytes]:
+        # base64 encodes groups of three bytes, the remainder of a chunk is carried over to the next one
+        remainder = b""
+        async for chunk in self.transaction_service.blob_service.stream_blob(blob):
+            data = remainder + chunk
+            n_encodable = len(data) - len(data) % 3
+            remainder = data[n_encodable:]
+            yield base64.b64encode(data[:n_encodable])
+        yield base64.b64encode(remainder)
 
-        def remap_shares(shares: dict[int, float]) -> dict[int, float]:
-            result = {}
-            for acc_id, val in shares.items():
-                result[account_mapping[acc_id]] = val
-            return result
+    async def _stream_json_export(self, dump: GroupJsonExportV1, blobs: list[StoredBlob]) -> AsyncIterator[bytes]:
+        # the dump is serialized piece by piece, splicing the file contents into the serialized transactions
+        remaining_blobs = iter(blobs)
+        yield dump.model_dump_json(exclude={"transactions"}).encode("utf-8")[:-1] + b',"transactions":['
+        for i, transaction in enumerate(dump.transactions):
+            yield (b"," if i > 0 else b"") + transaction.model_dump_json(exclude={"files"}).encode("utf-8")[:-1]
+            yield b',"files":['
+            for j, file in enumerate(transaction.files):
+                blob = next(remaining_blobs)
+                yield (b"," if j > 0 else b"") + file.model_dump_json(exclude={"content", "path"}).encode("utf-8")[:-1]
+                yield b',"content":"'
+                async for chunk in self._stream_base64(blob):
+                    yield chunk
+                # the contents are inline, json exports have no archive paths
+                yield b'","path":null}'
+            yield b"]}"
+        yield b"]}"
 
-        group_id = await self.group_service.create_group(
-            conn=conn,
-            user=user,
-            name=dump.metadata.name,
-            description=dump.metadata.description,
-            currency_identifier=dump.metadata.currency_identifier,
-            add_user_account_on_join=dump.metadata.add_user_account_on_join,
-            terms=dump.metadata.terms,
+    async def _archive_entries(self, dump: GroupJsonExportV1, blobs: list[StoredBlob]) -> AsyncIterator[ArchiveEntry]:
+        content = dump.model_dump_json(exclude={"transactions": {"__all__": {"files": {"__all__": {"content"}}}}})
+        encoded = content.encode("utf-8")
+
+        async def _json_chunks():
+            yield encoded
+
+        yield ArchiveEntry(name=EXPORT_ARCHIVE_JSON_NAME, size=len(encoded), chunks=_json_chunks(), compress=True)
+
+        files = [file for transaction in dump.transactions for file in transaction.files]
+        for file, blob in zip(files, blobs):
+            yield ArchiveEntry(
+                name=typing.cast(str, file.path),
+                size=blob.size,
+                chunks=self.transaction_service.blob_service.stream_blob(blob),
+            )
+
+    async def export_group(self, *, user: User, group_id: int, export_format: ExportFormat) -> AsyncIterator[bytes]:
+        """
+        Exports a group without holding it in memory as a whole, file attachments are streamed one by one.
+
+        Permissions are checked and the group is read when calling this, the file contents while iterating the result.
+        """
+        dump, blobs = await self._read_group_export(user=user, group_id=group_id)
+        if export_format == ExportFormat.json:
+            return self._stream_json_export(dump, blobs)
+        if export_format == ExportFormat.zip:
+            return stream_zip(self._archive_entries(dump, blobs))
+        return stream_tar(self._archive_entries(dump, blobs))
+
+    @staticmethod
+    async def _allocate_ids(conn: Connection, table: str, n: int) -> list[int]:
+        """Draws n ids from the id sequence of a table such that rows referencing each other can be copied at once"""
+        if n <= 0:
+            return []
+        return await conn.fetchval(
+            "select array_agg(nextval(pg_get_serial_sequence($1, 'id'))) from generate_series(1, $2)", table, n
         )
+
+    @staticmethod
+    async def _copy_rows(conn: Connection, table: str, columns: list[str], rows: list[tuple]):
+        if len(rows) <= 0:
+            return
+        await conn.copy_records_to_table(table, columns=columns, records=rows)
+
+    @staticmethod
+    def _validate_dump_v1(dump: GroupJsonExportV1) -> tuple[list[tuple[int, NewAccount]], list[NewTransaction]]:
+        """
+        Validates the whole dump before anything is written, the database only checks what depends on other rows.
+
+        @returns the accounts by their id in the dump and the transactions, both still referencing accounts by their
+        ids in the dump
+        """
+        accounts: list[tuple[int, NewAccount]] = []
         for personal_account in dump.personal_accounts:
-            account_id = await self.account_service.create_account(
-                conn=conn,
-                user=user,
-                group_id=group_id,
-                account=NewAccount(
-                    type=AccountType.personal,
-                    name=personal_account.name,
-                    description=personal_account.description,
-                ),
+            accounts.append(
+                (
+                    personal_account.id,
+                    NewAccount(
+                        type=AccountType.personal,
+                        name=personal_account.name,
+                        description=personal_account.description,
+                    ),
+                )
             )
-            account_mapping[personal_account.id] = account_id
-
         for clearing_account in dump.events:
-            account_id = await self.account_service.create_account(
-                conn=conn,
-                user=user,
-                group_id=group_id,
-                account=NewAccount(
-                    type=AccountType.clearing,
-                    name=clearing_account.name,
-                    description=clearing_account.description,
-                    date_info=clearing_account.date_info,
-                    tags=clearing_account.tags,
-                    clearing_shares=remap_shares(clearing_account.clearing_shares),
-                ),
+            accounts.append(
+                (
+                    clearing_account.id,
+                    NewAccount(
+                        type=AccountType.clearing,
+                        name=clearing_account.name,
+                        description=clearing_account.description,
+                        date_info=clearing_account.date_info,
+                        tags=clearing_account.tags,
+                        clearing_shares=clearing_account.clearing_shares,
+                    ),
+                )
             )
-            account_mapping[clearing_account.id] = account_id
+        account_ids = {account_id for account_id, _ in accounts}
+        if len(account_ids) != len(accounts):
+            raise InvalidArgument("Invalid json dump - account ids are not unique")
+
+        def check_references(shares: dict[int, float], what: str):
+            if not account_ids.issuperset(shares.keys()):
+                raise InvalidArgument(f"Invalid json dump - {what} references an account which is not part of the dump")
 
+        for _, account in accounts:
+            check_references(account.clearing_shares, "a clearing share")
+
+        transactions = []
         for transaction in dump.transactions:
-            mapped_positions = []
+            check_references(transaction.creditor_shares, "a creditor share")
+            check_references(transaction.debitor_shares, "a debitor share")
             for position in transaction.positions:
-                mapped_positions.append(
-                    NewTransactionPosition(
-                        name=position.name,
-                        price=position.price,
-                        communist_shares=position.communist_shares,
-                        usages=remap_shares(position.usages),
-                    )
-                )
+                check_references(position.usages, "a position usage")
 
             mapped_files = []
             for file in transaction.files:
+                if file.content is None:
+                    raise InvalidArgument("Invalid json dump - file attachments of archive exports cannot be imported")
+                if "." in file.filename:
+                    raise InvalidArgument("Dots '.' are not allowed in file names")
                 mapped_files.append(NewFile(filename=file.filename, mime_type=file.mime_type, content=file.content))
-            await self.transaction_service.create_transaction(
-                conn=conn,
-                user=user,
-                group_id=group_id,
-                transaction=NewTransaction(
+
+            transactions.append(
+                NewTransaction(
                     type=transaction.type,
                     name=transaction.name,
                     description=transaction.description,
@@ -218,13 +321,193 @@ class ExportImportService(Service[Config]):
                     value=transaction.value,
                     billed_at=transaction.billed_at,
                     tags=transaction.tags,
-                    creditor_shares=remap_shares(transaction.creditor_shares),
-                    debitor_shares=remap_shares(transaction.debitor_shares),
+                    creditor_shares=transaction.creditor_shares,
+                    debitor_shares=transaction.debitor_shares,
                     new_files=mapped_files,
-                    new_positions=mapped_positions,
+                    new_positions=[
+                        NewTransactionPosition(
+                            name=position.name,
+                            price=position.price,
+                            communist_shares=position.communist_shares,
+                            usages=position.usages,
+                        )
+                        for position in transaction.positions
+                    ],
                     split_mode=transaction.split_mode,
-                ),
+                )
             )
+        return accounts, transactions
+
+    async def _import_group_from_json_v1(
+        self, *, conn: Connection, user: User, dump: GroupJsonExportV1
+    ) -> tuple[int, dict[int, int]]:
+        """
+        Bulk loads a dump into a new group.
+
+        Instead of going through create_account and create_transaction for every entity, all ids are drawn upfront,
+        every table is filled with a single COPY and all revisions are committed together at the end, which is when
+        the commit time constraints run.
+        """
+        accounts, transactions = self._validate_dump_v1(dump)
+
+        group_id = await self.group_service.create_group(
+            conn=conn,
+            user=user,
+            name=dump.metadata.name,
+            description=dump.metadata.description,
+            currency_identifier=dump.metadata.currency_identifier,
+            add_user_account_on_join=dump.metadata.add_user_account_on_join,
+            terms=dump.metadata.terms,
+        )
+
+        tags = {tag for _, account in accounts for tag in account.tags} | {tag for t in transactions for tag in t.tags}
+        await _get_or_create_tag_ids(conn=conn, group_id=group_id, tags=list(tags))
+        tag_ids: dict[str, int] = {
+            row["name"]: row["id"] for row in await conn.fetch("select id, name from tag where group_id = $1", group_id)
+        }
+
+        # mapping of account ids in the dump to account ids in the newly created group
+        account_mapping = dict(
+            zip([account_id for account_id, _ in accounts], await self._allocate_ids(conn, "account", len(accounts)))
+        )
+        account_revision_ids = await self._allocate_ids(conn, "account_revision", len(accounts))
+        account_rows, account_revision_rows, account_history_rows = [], [], []
+        account_tag_rows, clearing_share_rows = [], []
+        for (dump_account_id, account), revision_id in zip(accounts, account_revision_ids):
+            account_id = account_mapping[dump_account_id]
+            account_rows.append((account_id, group_id, account.type.value))
+            account_revision_rows.append((revision_id, user.id, account_id, None))
+            account_history_rows.append((account_id, revision_id, account.name, account.description, account.date_info))
+            account_tag_rows.extend((account_id, revision_id, tag_ids[tag]) for tag in set(account.tags))
+            clearing_share_rows.extend(
+                (account_id, revision_id, account_mapping[share_account_id], value)
+                for share_account_id, value in account.clearing_shares.items()
+                if value != 0
+            )
+
+        transaction_ids = await self._allocate_ids(conn, "transaction", len(transactions))
+        transaction_revision_ids = await self._allocate_ids(conn, "transaction_revision", len(transactions))
+        item_ids = iter(
+            await self._allocate_ids(conn, "purchase_item", sum(len(t.new_positions) for t in transactions))
+        )
+        file_ids = iter(await self._allocate_ids(conn, "file", sum(len(t.new_files) for t in transactions)))
+        max_file_size = self.config.api.max_uploadable_file_size
+        transaction_rows, transaction_revision_rows, transaction_history_rows, transaction_tag_rows = [], [], [], []
+        debitor_share_rows, creditor_share_rows = [], []
+        item_rows, item_history_rows, item_usage_rows = [], [], []
+        file_rows, file_history_rows = [], []
+        for transaction, transaction_id, revision_id in zip(transactions, transaction_ids, transaction_revision_ids):
+            transaction_rows.append((transaction_id, group_id, transaction.type.value))
+            transaction_revision_rows.append((revision_id, user.id, transaction_id, None))
+            transaction_history_rows.append(
+                (
+                    transaction_id,
+                    revision_id,
+                    transaction.currency_identifier,
+                    transaction.currency_conversion_rate,
+                    transaction.value,
+                    transaction.name,
+                    transaction.description,
+                    transaction.billed_at,
+                    transaction.split_mode.value,
+                )
+            )
+            transaction_tag_rows.extend((transaction_id, revision_id, tag_ids[tag]) for tag in set(transaction.tags))
+            debitor_share_rows.extend(
+                (transaction_id, revision_id, account_mapping[account_id], value)
+                for account_id, value in transaction.debitor_shares.items()
+            )
+            creditor_share_rows.extend(
+                (transaction_id, revision_id, account_mapping[account_id], value)
+                for account_id, value in transaction.creditor_shares.items()
+            )
+            for position in transaction.new_positions:
+                item_id = next(item_ids)
+                item_rows.append((item_id, transaction_id))
+                item_history_rows.append(
+                    (item_id, revision_id, position.name, position.price, position.communist_shares)
+                )
+                item_usage_rows.extend(
+                    (item_id, revision_id, account_mapping[account_id], value)
+                    for account_id, value in position.usages.items()
+                )
+            for attachment in transaction.new_files:
+                content = base64.b64decode(typing.cast(str, attachment.content))
+                if len(content) / 1024 > max_file_size:
+                    raise InvalidArgument(f"File is too large, maximum is {max_file_size}KB")
+                blob_id = await self.transaction_service.blob_service.store_blob(
+                    conn=conn, content=content, mime_type=typing.cast(str, attachment.mime_type)
+                )
+                file_id = next(file_ids)
+                file_rows.append((file_id, transaction_id))
+                file_history_rows.append((file_id, revision_id, attachment.filename, blob_id))
+
+        # rows are copied in the order of their foreign keys, revisions are copied uncommitted and only checked below
+        await self._copy_rows(conn, "account", ["id", "group_id", "type"], account_rows)
+        await self._copy_rows(
+            conn, "account_revision", ["id", "user_id", "account_id", "created_at"], account_revision_rows
+        )
+        await self._copy_rows(
+            conn,
+            "account_history",
+            ["id", "revision_id", "name", "description", "date_info"],
+            account_history_rows,
+        )
+        await self._copy_rows(conn, "account_to_tag", ["account_id", "revision_id", "tag_id"], account_tag_rows)
+        await self._copy_rows(
+            conn,
+            "clearing_account_share",
+            ["account_id", "revision_id", "share_account_id", "shares"],
+            clearing_share_rows,
+        )
+        await self._copy_rows(conn, "transaction", ["id", "group_id", "type"], transaction_rows)
+        await self._copy_rows(
+            conn, "transaction_revision", ["id", "user_id", "transaction_id", "created_at"], transaction_revision_rows
+        )
+        await self._copy_rows(
+            conn,
+            "transaction_history",
+            [
+                "id",
+                "revision_id",
+                "currency_identifier",
+                "currency_conversion_rate",
+                "value",
+                "name",
+                "description",
+                "billed_at",
+                "split_mode",
+            ],
+            transaction_history_rows,
+        )
+        await self._copy_rows(
+            conn, "transaction_to_tag", ["transaction_id", "revision_id", "tag_id"], transaction_tag_rows
+        )
+        await self._copy_rows(
+            conn, "debitor_share", ["transaction_id", "revision_id", "account_id", "shares"], debitor_share_rows
+        )
+        await self._copy_rows(
+            conn, "creditor_share", ["transaction_id", "revision_id", "account_id", "shares"], creditor_share_rows
+        )
+        await self._copy_rows(conn, "purchase_item", ["id", "transaction_id"], item_rows)
+        await self._copy_rows(
+            conn,
+            "purchase_item_history",
+            ["id", "revision_id", "name", "price", "communist_shares"],
+            item_history_rows,
+        )
+        await self._copy_rows(
+            conn, "purchase_item_usage", ["item_id", "revision_id", "account_id", "share_amount"], item_usage_rows
+        )
+        await self._copy_rows(conn, "file", ["id", "transaction_id"], file_rows)
+        await self._copy_rows(conn, "file_history", ["id", "revision_id", "filename", "blob_id"], file_history_rows)
+
+        # committing the revisions runs their constraints, accounts first as transactions are evaluated against them
+        await conn.execute(
+            "update account_revision set created_at = now() where id = any($1::bigint[])", account_revision_ids
+        )
+        if transaction_revision_ids:
+            await self.transaction_service.commit_revisions(conn=conn, revision_ids=transaction_revision_ids)
         return group_id, account_mapping
 
     @with_db_transaction
@@ -0,0 +1,73 @@
+import asyncio
+from collections import defaultdict
+from datetime import timedelta
+from typing import AsyncIterator
+
+from sftkit.database import Pool
+from sftkit.service import Service
+
+from abrechnung.application.groups import GroupService
+from abrechnung.config import Config
+from abrechnung.core.auth import group_membership_cache
+from abrechnung.domain.groups import Group
+from abrechnung.domain.users import User
+
+# subscribers are woken up at least this often, e.g. to keep proxies from closing idle connections
+GROUP_CHANGES_KEEPALIVE_INTERVAL = timedelta(seconds=30)
+
+
+class GroupChangeService(Service[Config]):
+    """
+    Pushes changes of groups to subscribed clients.
+
+    Every api worker listens for the 'group_changed' notifications, which carry the id of a changed group, on a single
+    connection and wakes up the subscribers of that group. Changes made in quick succession are coalesced, a
+    subscriber only ever sees the latest state of its group.
+    """
+
+    def __init__(self, db_pool: Pool, config: Config, group_service: GroupService):
+        super().__init__(db_pool, config)
+
+        self.group_service = group_service
+        self._subscribers: dict[int, set[asyncio.Event]] = defaultdict(set)
+
+    async def handle_group_changed_notification(self, payload: str | None):
+        """Handler for the 'group_changed' database notification, the payload is the id of the changed group"""
+        if payload is None:
+            return
+        for changed in self._subscribers.get(int(payload), ()):
+            changed.set()
+
+    async def subscribe(self, *, user: User, group_id: int) -> AsyncIterator[Group | None]:
+        """
+        Yields the group once right away and again whenever it changed, None if nothing changed for a while.
+
+        The group is fetched with the current permissions of the user for every change, the subscription ends with
+        InvalidArgument or NotFound once the user is no longer a member of the group or the group has been deleted.
+        """
+        # check the permissions before the response starts
+        await self.group_service.get_group(user=user, group_id=group_id)
+        return self._changes(user=user, group_id=group_id)
+
+    async def _changes(self, *, user: User, group_id: int) -> AsyncIterator[Group | None]:
+        changed = asyncio.Event()
+        self._subscribers[group_id].add(changed)
+        try:
+            while True:
+                # the group is fetched after subscribing such that no change in between is missed
+                changed.clear()
+                # subscriptions outlive any membership cached for the request, e.g. when the user left the group
+                with group_membership_cache():
+                    group = await self.group_service.get_group(user=user, group_id=group_id)
+                yield group
+                while True:
+                    try:
+                        await asyncio.wait_for(changed.wait(), GROUP_CHANGES_KEEPALIVE_INTERVAL.total_seconds())
+                        break
+                    except TimeoutError:
+                        yield None
+        finally:
+            subscribers = self._subscribers[group_id]
+            subscribers.discard(changed)
+            if not subscribers:
+                del self._subscribers[group_id]
@@ -6,7 +6,7 @@ from sftkit.error import AccessDenied, InvalidArgument
 from sftkit.service import Service, with_db_connection, with_db_transaction
 
 from abrechnung.config import Config
-from abrechnung.core.auth import create_group_log
+from abrechnung.core.auth import create_group_log, invalidate_group_membership_cache
 from abrechnung.core.decorators import (
     requires_group_permissions,
     with_group_last_changed_update,
@@ -179,6 +179,7 @@ class GroupService(Service[Config]):
             invite["join_as_editor"],
             account_id,
         )
+        invalidate_group_membership_cache(invite["group_id"])
 
         await create_group_log(
             conn=conn,
@@ -321,9 +322,11 @@ class GroupService(Service[Config]):
             can_write,
             is_owner,
         )
+        invalidate_group_membership_cache(group_id)
 
     @with_db_transaction
     @requires_group_permissions()
+    @with_group_last_changed_update
     async def update_member_owned_account(
         self,
         *,
@@ -354,6 +357,7 @@ class GroupService(Service[Config]):
             group_id,
             owned_account_id,
         )
+        invalidate_group_membership_cache(group_id)
 
     @with_db_transaction
     @requires_group_permissions(requires_owner=True)
@@ -366,9 +370,11 @@ class GroupService(Service[Config]):
             raise InvalidArgument("Can only delete a group when you are the last member")
 
         await conn.execute("delete from grp where id = $1", group_id)
+        invalidate_group_membership_cache(group_id)
 
     @with_db_transaction
     @requires_group_permissions()
+    @with_group_last_changed_update
     async def leave_group(self, *, conn: Connection, user: User, group_id: int):
         n_members = await conn.fetchval(
             "select count(user_id) from group_membership gm where gm.group_id = $1",
@@ -382,6 +388,7 @@ class GroupService(Service[Config]):
                 group_id,
                 user.id,
             )
+        invalidate_group_membership_cache(group_id)
 
     @with_db_transaction
     async def preview_group(self, *, conn: Connection, user: User | None, invite_token: str) -> GroupPreview:
@@ -434,6 +441,16 @@ class GroupService(Service[Config]):
             invite_id,
         )
 
+    @with_db_connection
+    @requires_group_permissions()
+    async def get_last_changed(self, *, conn: Connection, user: User, group_id: int) -> datetime:
+        """
+        Cheap version stamp of everything in a group, i.e. its transactions, accounts, members and log.
+
+        Every change to a group bumps its last_changed in the same database transaction.
+        """
+        return await conn.fetchval("select last_changed from grp where id = $1", group_id)
+
     @with_db_transaction
     @requires_group_permissions()
     async def list_members(self, *, conn: Connection, user: User, group_id: int) -> list[GroupMember]:
@@ -0,0 +1,256 @@
+"""
+Settlement plans, i.e. a set of transfers after which the balance of every personal account in a group is zero.
+
+Balances are settled in whole cents. The greedy mode repeatedly lets the account owing the most pay the account
+which is owed the most, which needs at most n - 1 transfers for n accounts. The exact mode finds the minimal number
+of transfers, which is n minus the maximal number of disjoint groups of accounts whose balances sum up to zero.
+Finding these groups is exponential in the number of accounts, therefore the exact mode is limited to small groups.
+"""
+
+import heapq
+from datetime import date
+from typing import Callable, Mapping
+
+import numpy as np
+from asyncpg import Pool
+from sftkit.database import Connection
+from sftkit.error import InvalidArgument
+from sftkit.service import Service, with_db_transaction
+
+from abrechnung.application.balances import BalanceService
+from abrechnung.application.transactions import TransactionService
+from abrechnung.config import Config
+from abrechnung.core.decorators import requires_group_permissions
+from abrechnung.domain.balances import (
+    GroupSettlement,
+    SettlementMode,
+    SettlementPlan,
+    SettlementPlanItem,
+)
+from abrechnung.domain.transactions import (
+    NewTransaction,
+    SplitMode,
+    Transaction,
+    TransactionBatch,
+    TransactionType,
+)
+from abrechnung.domain.users import User
+
+# the exact mode keeps an entry for every subset of the accounts with a non-zero balance, 20 accounts take ~0.4s
+EXACT_SETTLEMENT_MAX_ACCOUNTS = 20
+# the auto mode only uses the exact mode if it finishes within a few milliseconds
+AUTO_EXACT_SETTLEMENT_MAX_ACCOUNTS = 16
+
+# (paying account id, receiving account id, amount in cents)
+_Transfer = tuple[int, int, int]
+
+
+def _to_cents(balances: Mapping[int, float]) -> dict[int, int]:
+    cents = {account_id: round(balances[account_id] * 100) for account_id in sorted(balances)}
+    # rounding every balance on its own can leave a residual of a few cents, assigning it to the account with the
+    # largest balance makes the plan settle exactly
+    residual = sum(cents.values())
+    # rounding moves each balance by at most half a cent, anything beyond that is not a rounding error but e.g. a
+    # clearing account which still holds money, settling it would move real money to or from an arbitrary account
+    if abs(residual) > len(cents):
+        raise InvalidArgument(
+            f"The balances sum up to {residual / 100:.2f} instead of zero and therefore cannot be settled"
+        )
+    if residual != 0 and cents:
+        largest = max(cents, key=lambda account_id: abs(cents[account_id]))
+        cents[largest] -= residual
+    return {account_id: amount for account_id, amount in cents.items() if amount != 0}
+
+
+def _greedy_settlement(cents: Mapping[int, int]) -> list[_Transfer]:
+    remaining: dict[int, int] = {}
+    # accounts by their remaining balance for settling exact matches in a single transfer
+    by_amount: dict[int, list[int]] = {}
+    # max heaps of (-abs(remaining balance), account id), entries are stale once the balance of an account changed
+    payers: list[tuple[int, int]] = []
+    receivers: list[tuple[int, int]] = []
+    transfers: list[_Transfer] = []
+
+    def _settle(account_id: int, amount: int):
+        candidates = by_amount.get(-amount, [])
+        while candidates:
+            counterpart = candidates.pop()
+            if remaining.get(counterpart) != -amount:
+                continue
+            del remaining[counterpart]
+            if amount < 0:
+                transfers.append((account_id, counterpart, -amount))
+            else:
+                transfers.append((counterpart, account_id, amount))
+            return
+        remaining[account_id] = amount
+        by_amount.setdefault(amount, []).append(account_id)
+        heapq.heappush(payers if amount < 0 else receivers, (-abs(amount), account_id))
+
+    def _pop_largest(heap: list[tuple[int, int]]) -> tuple[int, int] | None:
+        while heap:
+            negated_amount, account_id = heapq.heappop(heap)
+            if account_id in remaining and abs(remaining[account_id]) == -negated_amount:
+                return account_id, remaining.pop(account_id)
+        return None
+
+    for account_id, amount in cents.items():
+        _settle(account_id, amount)
+
+    while True:
+        payer = _pop_largest(payers)
+        receiver = _pop_largest(receivers)
+        if payer is None or receiver is None:
+            # both heaps run empty at the same time as the balances sum up to zero
+            break
+        (payer_id, payer_amount), (receiver_id, receiver_amount) = payer, receiver
+        amount = min(-payer_amount, receiver_amount)
+        transfers.append((payer_id, receiver_id, amount))
+        if payer_amount + amount != 0:
+            _settle(payer_id, payer_amount + amount)
+        if receiver_amount - amount != 0:
+            _settle(receiver_id, receiver_amount - amount)
+
+    return transfers
+
+
+def _exact_settlement(cents: Mapping[int, int]) -> list[_Transfer]:
+    account_ids = list(cents.keys())
+    n_accounts = len(account_ids)
+    if n_accounts > EXACT_SETTLEMENT_MAX_ACCOUNTS:
+        raise InvalidArgument(
+            f"the exact settlement mode supports at most {EXACT_SETTLEMENT_MAX_ACCOUNTS} accounts with an open "
+            f"balance, this group has {n_accounts}"
+        )
+
+    # subsets of accounts are represented as bit masks, bit i standing for account_ids[i]
+    sums = np.zeros(1, dtype=np.int64)
+    sizes = np.zeros(1, dtype=np.int64)
+    for amount in cents.values():
+        sums = np.concatenate((sums, sums + amount))
+        sizes = np.concatenate((sizes, sizes + 1))
+    is_zero = (sums == 0).astype(np.int64)
+
+    # groups[mask] is the maximal number of disjoint zero sum groups the accounts in mask can be split into,
+    # computed in order of increasing subset size from the subsets with one account less
+    groups = np.zeros(len(sums), dtype=np.int64)
+    masks_by_size = np.argsort(sizes, kind="stable")
+    size_offsets = np.searchsorted(sizes[masks_by_size], np.arange(n_accounts + 2))
+    for size in range(1, n_accounts + 1):
+        masks = masks_by_size[size_offsets[size] : size_offsets[size + 1]]
+        best = np.zeros(len(masks), dtype=np.int64)
+        for i in range(n_accounts):
+            contained = (masks >> i) & 1 == 1
+            best[contained] = np.maximum(best[contained], groups[masks[contained] ^ (1 << i)])
+        groups[masks] = best + is_zero[masks]
+
+    # walk back from the full set, the accounts removed between two zero sum subsets form one group
+    transfers: list[_Transfer] = []
+    mask = len(sums) - 1
+    group: dict[int, int] = {}
+    while mask:
+        for i in range(n_accounts):
+            if (mask >> i) & 1 and groups[mask ^ (1 << i)] + is_zero[mask] == groups[mask]:
+                break
+        group[account_ids[i]] = cents[account_ids[i]]
+        mask ^= 1 << i
+        if is_zero[mask]:
+            # no subset of a group sums up to zero, so settling it greedily takes len(group) - 1 transfers
+            transfers.extend(_greedy_settlement(group))
+            group = {}
+
+    return transfers
+
+
+def _auto_settlement(cents: Mapping[int, int]) -> list[_Transfer]:
+    if len(cents) <= AUTO_EXACT_SETTLEMENT_MAX_ACCOUNTS:
+        return _exact_settlement(cents)
+    return _greedy_settlement(cents)
+
+
+SETTLEMENT_ALGORITHMS: dict[SettlementMode, Callable[[Mapping[int, int]], list[_Transfer]]] = {
+    SettlementMode.auto: _auto_settlement,
+    SettlementMode.exact: _exact_settlement,
+    SettlementMode.greedy: _greedy_settlement,
+}
+
+
+def compute_settlement_plan(
+    balances: Mapping[int, float], mode: SettlementMode = SettlementMode.auto
+) -> SettlementPlan:
+    """
+    Computes transfers which settle the given account balances, positive balances receive money.
+
+    Raises InvalidArgument if the balances do not sum up to zero, up to rounding.
+    """
+    transfers = SETTLEMENT_ALGORITHMS[mode](_to_cents(balances))
+    return [
+        SettlementPlanItem(creditor_id=payer_id, debitor_id=receiver_id, payment_amount=amount / 100)
+        for payer_id, receiver_id, amount in transfers
+    ]
+
+
+class SettlementService(Service[Config]):
+    def __init__(
+        self,
+        db_pool: Pool,
+        config: Config,
+        balance_service: BalanceService,
+        transaction_service: TransactionService,
+    ):
+        super().__init__(db_pool, config)
+
+        self.balance_service = balance_service
+        self.transaction_service = transaction_service
+
+    @with_db_transaction
+    @requires_group_permissions()
+    async def get_settlement_plan(
+        self, *, conn: Connection, user: User, group_id: int, mode: SettlementMode = SettlementMode.auto
+    ) -> SettlementPlan:
+        """Computes transfers which settle the current balances of all personal accounts in a group"""
+        balances = await self.balance_service.get_balances(conn=conn, user=user, group_id=group_id)
+        personal_account_ids = await conn.fetch(
+            "select account_id from group_account_state_valid_at($1) where not deleted and type = 'personal'",
+            group_id,
+        )
+        return compute_settlement_plan(
+            {
+                account["account_id"]: balances[account["account_id"]].balance
+                for account in personal_account_ids
+                if account["account_id"] in balances
+            },
+            mode,
+        )
+
+    @with_db_transaction
+    @requires_group_permissions(requires_write=True)
+    async def settle_group(
+        self, *, conn: Connection, user: User, group_id: int, settlement: GroupSettlement
+    ) -> list[Transaction]:
+        """Creates the transfers of the current settlement plan of a group in one batch and returns them"""
+        plan = await self.get_settlement_plan(conn=conn, user=user, group_id=group_id, mode=settlement.mode)
+        if not plan:
+            return []
+        currency_identifier = await conn.fetchval("select currency_identifier from grp where id = $1", group_id)
+        billed_at = settlement.billed_at or date.today()
+        batch = TransactionBatch(
+            new_transactions=[
+                NewTransaction(
+                    type=TransactionType.transfer,
+                    name=settlement.name,
+                    description="",
+                    value=item.payment_amount,
+                    currency_identifier=currency_identifier,
+                    currency_conversion_rate=1.0,
+                    billed_at=billed_at,
+                    creditor_shares={item.creditor_id: 1.0},
+                    debitor_shares={item.debitor_id: 1.0},
+                    split_mode=SplitMode.shares,
+                )
+                for item in plan
+            ]
+        )
+        return await self.transaction_service.batch_update_transactions(
+            conn=conn, user=user, group_id=group_id, batch=batch
+        )
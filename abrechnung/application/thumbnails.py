@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from sftkit.database import Connection, Pool
+from sftkit.error import InvalidArgument
+from sftkit.service import Service, with_db_transaction
+
+from abrechnung.application.blobs import BlobService, StoredBlob
+from abrechnung.config import Config
+from abrechnung.core.thumbnails import THUMBNAIL_MIME_TYPE, ThumbnailError, render_thumbnails
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailService(Service[Config]):
+    """
+    Generates webp thumbnails of blobs in a process pool, image decoding and resizing never runs on the event loop.
+
+    Thumbnails are generated right after a blob has been committed, triggered by the 'blob_created' database
+    notification, and lazily on their first request otherwise.
+    """
+
+    def __init__(self, db_pool: Pool, config: Config, blob_service: BlobService):
+        super().__init__(db_pool, config)
+
+        self.blob_service = blob_service
+        self.sizes = sorted(self.config.thumbnails.sizes)
+        self._executor = self._create_executor()
+        # bounds the number of blobs loaded into memory while waiting for a worker
+        self._semaphore = asyncio.Semaphore(2 * self.config.thumbnails.max_workers)
+        self._tasks: set[asyncio.Task] = set()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # spawned workers do not inherit the event loop, threads or database connections of the api process
+        return ProcessPoolExecutor(
+            max_workers=self.config.thumbnails.max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def get_size(self, requested_size: int) -> int:
+        """Returns the smallest thumbnail size at least as large as requested, the largest one otherwise"""
+        for size in self.sizes:
+            if size >= requested_size:
+                return size
+        return self.sizes[-1]
+
+    async def handle_blob_created_notification(self, payload: str | None):
+        """Handler for the 'blob_created' database notification, the payload is the id of the new blob"""
+        if payload is None:
+            return
+        task = asyncio.create_task(self._generate_new_blob_thumbnails(int(payload)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _generate_new_blob_thumbnails(self, blob_id: int):
+        # every api worker receives the notification, only the one claiming the blob generates its thumbnails
+        claimed = await self.db_pool.fetchval(
+            "update blob set thumbnailed_at = now() where id = $1 and thumbnailed_at is null returning id",
+            blob_id,
+        )
+        if claimed is None:
+            return
+        try:
+            await self.generate_thumbnails(blob_id=blob_id)
+        except Exception as e:
+            logger.warning(f"Generating the thumbnails of blob {blob_id} failed: {e}")
+
+    async def generate_thumbnails(self, *, blob_id: int):
+        async with self._semaphore:
+            async with self.db_pool.acquire() as conn:
+                _, content = await self.blob_service.read_blob(conn=conn, blob_id=blob_id)
+            try:
+                rendered = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, render_thumbnails, content, self.sizes
+                )
+            except ThumbnailError as e:
+                raise InvalidArgument(f"Cannot generate a thumbnail of this file: {e}")
+            except BrokenProcessPool:
+                # a worker died, e.g. killed for running out of memory, the pool cannot be used any more
+                broken_executor, self._executor = self._executor, self._create_executor()
+                broken_executor.shutdown(wait=False, cancel_futures=True)
+                raise
+        await self._store_thumbnails(blob_id=blob_id, thumbnails=rendered)
+
+    @with_db_transaction
+    async def _store_thumbnails(self, *, conn: Connection, blob_id: int, thumbnails: dict[int, bytes]):
+        # thumbnails generated concurrently in the meantime are kept, storing ours would leave unreferenced blobs
+        existing_sizes = await conn.fetch("select size from blob_thumbnail where source_blob_id = $1", blob_id)
+        for row in existing_sizes:
+            thumbnails.pop(row["size"], None)
+
+        for size, content in thumbnails.items():
+            thumbnail_blob_id = await self.blob_service.store_blob(
+                conn=conn, content=content, mime_type=THUMBNAIL_MIME_TYPE
+            )
+            # thumbnails do not get thumbnails of their own
+            await conn.execute(
+                "update blob set thumbnailed_at = coalesce(thumbnailed_at, now()) where id = $1", thumbnail_blob_id
+            )
+            await conn.execute(
+                "insert into blob_thumbnail (source_blob_id, size, blob_id) values ($1, $2, $3)",
+                blob_id,
+                size,
+                thumbnail_blob_id,
+            )
+
+    async def _fetch_thumbnail(self, *, blob_id: int, size: int) -> StoredBlob | None:
+        async with self.db_pool.acquire() as conn:
+            thumbnail_blob_id = await conn.fetchval(
+                "select blob_id from blob_thumbnail where source_blob_id = $1 and size = $2", blob_id, size
+            )
+            if thumbnail_blob_id is None:
+                return None
+            return await self.blob_service.get_blob(conn=conn, blob_id=thumbnail_blob_id)
+
+    async def get_thumbnail(self, *, blob_id: int, size: int) -> StoredBlob:
+        """
+        Returns the thumbnail of a blob, generating it if it does not exist yet.
+
+        Callers have to check the permissions of the user on the blob.
+        """
+        size = self.get_size(size)
+        thumbnail = await self._fetch_thumbnail(blob_id=blob_id, size=size)
+        if thumbnail is not None:
+            return thumbnail
+
+        await self.generate_thumbnails(blob_id=blob_id)
+        thumbnail = await self._fetch_thumbnail(blob_id=blob_id, size=size)
+        if thumbnail is None:
+            raise InvalidArgument("File not found")
+        return thumbnail
+
+    def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
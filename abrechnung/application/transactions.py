@@ -1,6 +1,6 @@
 import base64
 from datetime import date, datetime, timedelta
-from typing import Optional, Union
+from typing import AsyncIterator, Optional, Sequence, Union
 
 import asyncpg
 import httpx
@@ -9,24 +9,35 @@ from sftkit.database import Connection, Pool
 from sftkit.error import AccessDenied, InvalidArgument
 from sftkit.service import Service, with_db_connection, with_db_transaction
 
-from abrechnung.application.common import _get_or_create_tag_ids
+from abrechnung.application.balances import (
+    _fetch_transaction_balance_state,
+    _update_cached_balances,
+)
+from abrechnung.application.blobs import BlobService, StagedBlob, StoredBlob
+from abrechnung.application.common import (
+    _check_accounts_exist,
+    _get_or_create_tag_ids,
+)
 from abrechnung.config import Config
-from abrechnung.core.auth import create_group_log
+from abrechnung.core.auth import check_group_permissions, create_group_log, get_group_membership
 from abrechnung.core.decorators import (
     requires_group_permissions,
     with_group_last_changed_update,
 )
 from abrechnung.domain.transactions import (
+    ALLOWED_FILETYPES,
     CurrencyConversionRate,
     NewFile,
     NewTransaction,
     NewTransactionPosition,
     Transaction,
+    TransactionBatch,
     TransactionHistory,
     TransactionPosition,
     TransactionType,
     UpdateFile,
     UpdateTransaction,
+    UploadedFile,
 )
 from abrechnung.domain.users import User
 from abrechnung.util import timed_cache
@@ -60,10 +71,18 @@ class CurrencyConversionApi:
 
 
 class TransactionService(Service[Config]):
+    # number of rows fetched per round trip when streaming transactions
+    _STREAM_PREFETCH = 100
+
     def __init__(self, db_pool: Pool, config: Config, transaction_retries: int | None = None):
         super().__init__(db_pool, config, transaction_retries)
 
         self.currency_api = CurrencyConversionApi()
+        self.blob_service = BlobService(db_pool, config)
+
+    @property
+    def _file_host_url(self) -> str:
+        return self.config.api.base_url + "/api"
 
     @staticmethod
     async def _check_transaction_permissions(
@@ -74,17 +93,12 @@ class TransactionService(Service[Config]):
         transaction_type: Union[TransactionType, list[TransactionType]] | None = None,
     ) -> int:
         """returns group id of the transaction"""
-        result = await conn.fetchrow(
-            "select t.type, t.group_id, can_write, is_owner "
-            "from group_membership gm join transaction t on gm.group_id = t.group_id and gm.user_id = $1 "
-            "where t.id = $2",
-            user.id,
-            transaction_id,
-        )
-        if not result:
+        result = await conn.fetchrow("select type, group_id from transaction where id = $1", transaction_id)
+        membership = None if result is None else await get_group_membership(conn, result["group_id"], user)
+        if result is None or membership is None:
             raise InvalidArgument("user is not a member of this group")
 
-        if can_write and not (result["can_write"] or result["is_owner"]):
+        if can_write and not (membership.can_write or membership.is_owner):
             raise AccessDenied("user does not have write permissions")
 
         if transaction_type:
@@ -96,6 +110,47 @@ class TransactionService(Service[Config]):
 
         return result["group_id"]
 
+    @staticmethod
+    def _list_transactions_query(
+        group_id: int,
+        min_last_changed: Optional[datetime],
+        additional_transactions: Optional[list[int]],
+        after: Optional[tuple[datetime, int]],
+        limit: Optional[int],
+        json_file_host_url: Optional[str] = None,
+    ) -> tuple[str, list]:
+        """
+        Build the query listing the current state of all transactions in a group ordered by (last_changed, id).
+
+        `after` is a keyset cursor, i.e. the (last_changed, id) of the last transaction of the previous page.
+        If `json_file_host_url` is given the query returns a single column 'json' with the serialized api response
+        of each transaction instead of the raw columns.
+        """
+        args: list = [group_id]
+        if json_file_host_url is not None:
+            args.append(json_file_host_url)
+            query = (
+                "select transaction_json(cts, $2)::text as json from current_transaction_state cts where group_id = $1"
+            )
+        else:
+            query = "select * from current_transaction_state where group_id = $1"
+        if min_last_changed:
+            # if a minimum last changed value is specified we must also return all transactions the current
+            # user has pending changes with to properly sync state across different devices of the user
+            args.extend([min_last_changed, additional_transactions])
+            query += (
+                f" and (last_changed >= ${len(args) - 1} "
+                f"or ((${len(args)}::int[]) is not null and id = any(${len(args)}::int[])))"
+            )
+        if after is not None:
+            args.extend(after)
+            query += f" and (last_changed, id) > (${len(args) - 1}, ${len(args)})"
+        query += " order by last_changed, id"
+        if limit is not None:
+            args.append(limit)
+            query += f" limit ${len(args)}"
+        return query, args
+
     @with_db_transaction
     @requires_group_permissions()
     async def list_transactions(
@@ -106,31 +161,78 @@ class TransactionService(Service[Config]):
         group_id: int,
         min_last_changed: Optional[datetime] = None,
         additional_transactions: Optional[list[int]] = None,
+        after: Optional[tuple[datetime, int]] = None,
+        limit: Optional[int] = None,
     ) -> list[Transaction]:
-        if min_last_changed:
-            # if a minimum last changed value is specified we must also return all transactions the current
-            # user has pending changes with to properly sync state across different devices of the user
-            transactions = await conn.fetch_many(
-                Transaction,
-                "select * "
-                "from full_transaction_state_valid_at(now()) "
-                "where group_id = $1 "
-                "   and (last_changed >= $2 or (($3::int[]) is not null and id = any($3::int[])))",
-                group_id,
-                min_last_changed,
-                additional_transactions,
-            )
-        else:
-            transactions = await conn.fetch_many(
-                Transaction,
-                "select * from full_transaction_state_valid_at(now()) where group_id = $1",
-                group_id,
-            )
+        query, args = self._list_transactions_query(
+            group_id=group_id,
+            min_last_changed=min_last_changed,
+            additional_transactions=additional_transactions,
+            after=after,
+            limit=limit,
+        )
+        transactions = await conn.fetch_many(Transaction, query, *args)
         for transaction in transactions:
             for attachment in transaction.files:
-                attachment.host_url = self.config.api.base_url + "/api"
+                attachment.host_url = self._file_host_url
         return transactions
 
+    @with_db_transaction
+    @requires_group_permissions()
+    async def list_transactions_json(
+        self,
+        *,
+        conn: Connection,
+        user: User,
+        group_id: int,
+        min_last_changed: Optional[datetime] = None,
+        additional_transactions: Optional[list[int]] = None,
+        after: Optional[tuple[datetime, int]] = None,
+        limit: Optional[int] = None,
+    ) -> str:
+        """
+        Same as list_transactions but returns the json serialized list as built by the database.
+
+        This skips deserializing and validating the rows into pydantic models only to serialize them again.
+        """
+        query, args = self._list_transactions_query(
+            group_id=group_id,
+            min_last_changed=min_last_changed,
+            additional_transactions=additional_transactions,
+            after=after,
+            limit=limit,
+            json_file_host_url=self._file_host_url,
+        )
+        rows = await conn.fetch(query, *args)
+        return "[" + ",".join(row["json"] for row in rows) + "]"
+
+    async def stream_transactions_json(
+        self,
+        *,
+        user: User,
+        group_id: int,
+        min_last_changed: Optional[datetime] = None,
+        additional_transactions: Optional[list[int]] = None,
+        after: Optional[tuple[datetime, int]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Same as list_transactions_json but reads the transactions through a database cursor, yielding the json of
+        each transaction one by one instead of loading the whole group into memory.
+        """
+        query, args = self._list_transactions_query(
+            group_id=group_id,
+            min_last_changed=min_last_changed,
+            additional_transactions=additional_transactions,
+            after=after,
+            limit=None,
+            json_file_host_url=self._file_host_url,
+        )
+        async with self.db_pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                await check_group_permissions(conn=conn, group_id=group_id, user=user)
+                async for row in conn.cursor(query, *args, prefetch=self._STREAM_PREFETCH):
+                    yield row["json"]
+
     @with_db_transaction
     async def get_transaction_history(
         self, *, conn: Connection, user: User, transaction_id: int
@@ -150,12 +252,12 @@ class TransactionService(Service[Config]):
         group_id = await self._check_transaction_permissions(conn=conn, user=user, transaction_id=transaction_id)
         transaction = await conn.fetch_one(
             Transaction,
-            "select * from full_transaction_state_valid_at(now()) where group_id = $1 and id = $2",
+            "select * from current_transaction_state where group_id = $1 and id = $2",
             group_id,
             transaction_id,
         )
         for attachment in transaction.files:
-            attachment.host_url = self.config.api.base_url + "/api"
+            attachment.host_url = self._file_host_url
         return transaction
 
     @staticmethod
@@ -168,35 +270,41 @@ class TransactionService(Service[Config]):
     ):
         if len(tag_ids) <= 0:
             return
-        for tag_id in tag_ids:
-            await conn.execute(
-                "insert into transaction_to_tag (transaction_id, revision_id, tag_id) values ($1, $2, $3)",
-                transaction_id,
-                revision_id,
-                tag_id,
-            )
+        await conn.execute(
+            "insert into transaction_to_tag (transaction_id, revision_id, tag_id) select $1, $2, unnest($3::int[])",
+            transaction_id,
+            revision_id,
+            tag_ids,
+        )
 
     async def _add_file_to_revision(
         self,
         *,
         conn: Connection,
+        group_id: int,
         revision_id: int,
         transaction_id: int,
         attachment: NewFile,
     ) -> int:
-        content = base64.b64decode(attachment.content)
-        max_file_size = self.config.api.max_uploadable_file_size
-        if len(content) / 1024 > max_file_size:
-            raise InvalidArgument(f"File is too large, maximum is {max_file_size}KB")
-
         if "." in attachment.filename:
             raise InvalidArgument("Dots '.' are not allowed in file names")
 
-        blob_id = await conn.fetchval(
-            "insert into blob (content, mime_type) values ($1, $2) returning id",
-            content,
-            attachment.mime_type,
-        )
+        if attachment.blob_id is not None:
+            blob_id = await conn.fetchval(
+                "select blob_id from blob_upload where blob_id = $1 and group_id = $2 limit 1",
+                attachment.blob_id,
+                group_id,
+            )
+            if blob_id is None:
+                raise InvalidArgument("Uploaded file does not exist or has expired")
+        else:
+            content = base64.b64decode(attachment.content)
+            max_file_size = self.config.api.max_uploadable_file_size
+            if len(content) / 1024 > max_file_size:
+                raise InvalidArgument(f"File is too large, maximum is {max_file_size}KB")
+
+            blob_id = await self.blob_service.store_blob(conn=conn, content=content, mime_type=attachment.mime_type)
+
         file_id = await conn.fetchval(
             "insert into file (transaction_id) values ($1) returning id",
             transaction_id,
@@ -239,14 +347,43 @@ class TransactionService(Service[Config]):
         )
         return attachment.id
 
-    async def _create_transaction(
+    @staticmethod
+    async def _check_referenced_accounts(
+        conn: asyncpg.Connection, group_id: int, transactions: Sequence[NewTransaction]
+    ):
+        await _check_accounts_exist(
+            conn=conn,
+            group_id=group_id,
+            account_ids={account_id for t in transactions for account_id in t.debitor_shares.keys()},
+            error_message="one of the accounts referenced by a debitor share does not exist in this group",
+        )
+        await _check_accounts_exist(
+            conn=conn,
+            group_id=group_id,
+            account_ids={account_id for t in transactions for account_id in t.creditor_shares.keys()},
+            error_message="one of the accounts referenced by a creditor share does not exist in this group",
+        )
+        await _check_accounts_exist(
+            conn=conn,
+            group_id=group_id,
+            account_ids={
+                account_id
+                for t in transactions
+                for position in [*t.new_positions, *(t.changed_positions if isinstance(t, UpdateTransaction) else [])]
+                for account_id in position.usages.keys()
+            },
+            error_message="one of the accounts referenced by a position usage does not exist in this group",
+        )
+
+    async def _write_new_transaction(
         self,
         *,
         conn: Connection,
         user: User,
         group_id: int,
         transaction: NewTransaction,
-    ) -> int:
+    ) -> tuple[int, int]:
+        """Write a new transaction in an uncommitted revision, returns the transaction and revision id"""
         transaction_id = await conn.fetchval(
             "insert into transaction (group_id, type) values ($1, $2) returning id",
             group_id,
@@ -283,7 +420,6 @@ class TransactionService(Service[Config]):
         await self._put_transaction_debitor_shares(
             conn=conn,
             transaction_id=transaction_id,
-            group_id=group_id,
             revision_id=revision_id,
             debitor_shares=transaction.debitor_shares,
         )
@@ -291,31 +427,27 @@ class TransactionService(Service[Config]):
         await self._put_transaction_creditor_shares(
             conn=conn,
             transaction_id=transaction_id,
-            group_id=group_id,
             revision_id=revision_id,
             creditor_shares=transaction.creditor_shares,
         )
 
-        if transaction.new_positions:
-            for position in transaction.new_positions:
-                await self._create_transaction_position(
-                    conn=conn,
-                    group_id=group_id,
-                    transaction_id=transaction_id,
-                    revision_id=revision_id,
-                    position=position,
-                )
+        await self._put_transaction_positions(
+            conn=conn,
+            transaction_id=transaction_id,
+            revision_id=revision_id,
+            positions=transaction.new_positions,
+        )
 
         for attachment in transaction.new_files:
             await self._add_file_to_revision(
                 conn=conn,
+                group_id=group_id,
                 revision_id=revision_id,
                 transaction_id=transaction_id,
                 attachment=attachment,
             )
-        await self._commit_revision(conn=conn, revision_id=revision_id)
 
-        return transaction_id
+        return transaction_id, revision_id
 
     @with_db_transaction
     @requires_group_permissions(requires_write=True)
@@ -328,209 +460,187 @@ class TransactionService(Service[Config]):
         group_id: int,
         transaction: NewTransaction,
     ) -> int:
-        return await self._create_transaction(conn=conn, user=user, group_id=group_id, transaction=transaction)
+        await self._check_referenced_accounts(conn=conn, group_id=group_id, transactions=[transaction])
+        transaction_id, revision_id = await self._write_new_transaction(
+            conn=conn, user=user, group_id=group_id, transaction=transaction
+        )
+        await self.commit_revisions(conn=conn, revision_ids=[revision_id])
+        return transaction_id
 
     @staticmethod
     async def _put_transaction_debitor_shares(
         conn: asyncpg.Connection,
-        group_id: int,
         transaction_id: int,
         revision_id: int,
         debitor_shares: dict[int, float],
     ):
-        n_accounts = await conn.fetchval(
-            "select count(*) from account_state_valid_at() "
-            "where group_id = $1 and account_id = any($2::int[]) and not deleted",
-            group_id,
+        if len(debitor_shares) <= 0:
+            return
+        await conn.execute(
+            "insert into debitor_share(transaction_id, revision_id, account_id, shares) "
+            "select $1, $2, unnest($3::int[]), unnest($4::double precision[])",
+            transaction_id,
+            revision_id,
             list(debitor_shares.keys()),
+            list(debitor_shares.values()),
         )
-        if len(debitor_shares.keys()) != n_accounts:
-            raise InvalidArgument("one of the accounts referenced by a debitor share does not exist in this group")
-        for account_id, value in debitor_shares.items():
-            await conn.execute(
-                "insert into debitor_share(transaction_id, revision_id, account_id, shares) values ($1, $2, $3, $4)",
-                transaction_id,
-                revision_id,
-                account_id,
-                value,
-            )
 
     @staticmethod
     async def _put_transaction_creditor_shares(
         conn: asyncpg.Connection,
-        group_id: int,
         transaction_id: int,
         revision_id: int,
         creditor_shares: dict[int, float],
     ):
-        n_accounts = await conn.fetchval(
-            "select count(*) from account_state_valid_at() "
-            "where group_id = $1 and account_id = any($2::int[]) and not deleted",
-            group_id,
+        if len(creditor_shares) <= 0:
+            return
+        await conn.execute(
+            "insert into creditor_share(transaction_id, revision_id, account_id, shares) "
+            "select $1, $2, unnest($3::int[]), unnest($4::double precision[])",
+            transaction_id,
+            revision_id,
             list(creditor_shares.keys()),
+            list(creditor_shares.values()),
         )
-        if len(creditor_shares.keys()) != n_accounts:
-            raise InvalidArgument("one of the accounts referenced by a creditor share does not exist in this group")
-        for account_id, value in creditor_shares.items():
-            await conn.execute(
-                "insert into creditor_share(transaction_id, revision_id, account_id, shares) values ($1, $2, $3, $4)",
-                transaction_id,
-                revision_id,
-                account_id,
-                value,
-            )
 
-    @with_db_transaction
-    async def read_file_contents(
-        self, *, conn: Connection, user: User, file_id: int, blob_id: int
-    ) -> tuple[str, bytes]:
-        perms = await conn.fetchrow(
-            "select f.id "
-            "from group_membership gm "
-            "   join transaction t on gm.group_id = t.group_id and gm.user_id = $1 "
-            "   join file f on t.id = f.transaction_id and f.id = $2"
+    @staticmethod
+    async def _check_file_permissions(*, conn: Connection, user: User, file_id: int, blob_id: int):
+        group_id = await conn.fetchval(
+            "select t.group_id "
+            "from transaction t "
+            "   join file f on t.id = f.transaction_id and f.id = $1"
             "   join file_history fh on f.id = fh.id "
-            "where fh.blob_id = $3",
-            user.id,
+            "where fh.blob_id = $2 "
+            "limit 1",
             file_id,
             blob_id,
         )
-        if not perms:
+        if group_id is None or await get_group_membership(conn, group_id, user) is None:
             raise InvalidArgument("File not found")
 
-        blob = await conn.fetchrow("select content, mime_type from blob where id = $1", blob_id)
-        if not blob:
-            raise InvalidArgument("File not found")
+    @with_db_transaction
+    async def read_file_contents(
+        self, *, conn: Connection, user: User, file_id: int, blob_id: int
+    ) -> tuple[str, bytes]:
+        await self._check_file_permissions(conn=conn, user=user, file_id=file_id, blob_id=blob_id)
+        return await self.blob_service.read_blob(conn=conn, blob_id=blob_id)
 
-        return blob["mime_type"], blob["content"]
+    @with_db_transaction
+    async def get_file_blob(self, *, conn: Connection, user: User, file_id: int, blob_id: int) -> StoredBlob:
+        """Returns the metadata of a file attachment, its content can be streamed with blob_service.stream_blob"""
+        await self._check_file_permissions(conn=conn, user=user, file_id=file_id, blob_id=blob_id)
+        return await self.blob_service.get_blob(conn=conn, blob_id=blob_id)
 
-    @staticmethod
-    async def _put_position_usages(
-        conn: asyncpg.Connection,
-        group_id: int,
-        item_id: int,
-        revision_id: int,
-        usages: dict[int, float],
-    ):
-        n_accounts = await conn.fetchval(
-            "select count(*) from account_state_valid_at() "
-            "where group_id = $1 and account_id = any($2::int[]) and not deleted",
+    @with_db_transaction
+    @requires_group_permissions(requires_write=True)
+    async def _add_uploaded_blob(
+        self, *, conn: Connection, user: User, group_id: int, staged: StagedBlob, mime_type: str
+    ) -> int:
+        blob_id = await self.blob_service.add_staged_blob(conn=conn, staged=staged, mime_type=mime_type)
+        await conn.execute(
+            "insert into blob_upload (blob_id, group_id, user_id) values ($1, $2, $3)",
+            blob_id,
             group_id,
-            list(usages.keys()),
+            user.id,
         )
-        if len(usages.keys()) != n_accounts:
-            raise InvalidArgument("one of the accounts referenced by a position usage does not exist in this group")
-        for account_id, value in usages.items():
-            await conn.execute(
-                "insert into purchase_item_usage(item_id, revision_id, account_id, share_amount) "
-                "values ($1, $2, $3, $4)",
-                item_id,
-                revision_id,
-                account_id,
-                value,
-            )
+        return blob_id
 
-    async def _put_transaction_position(
-        self,
-        conn: asyncpg.Connection,
-        group_id: int,
-        item_id: int,
-        revision_id: int,
-        position: TransactionPosition,
-    ):
-        await conn.execute(
-            "insert into purchase_item_history(id, revision_id, name, price, communist_shares, deleted) "
-            "values ($1, $2, $3, $4, $5, $6) on conflict (id, revision_id) do update "
-            "set name = $3, price = $4, communist_shares = $5, deleted = $6",
-            item_id,
-            revision_id,
-            position.name,
-            position.price,
-            position.communist_shares,
-            position.deleted,
-        )
-        if position.usages:
-            await self._put_position_usages(
-                conn=conn,
-                group_id=group_id,
-                item_id=item_id,
-                revision_id=revision_id,
-                usages=position.usages,
-            )
+    async def upload_file(
+        self, *, user: User, group_id: int, mime_type: str, content: AsyncIterator[bytes]
+    ) -> UploadedFile:
+        """
+        Stores a file which transactions of the group can then attach by its blob id.
 
-    async def _create_transaction_position(
-        self,
-        conn: asyncpg.Connection,
-        group_id: int,
-        transaction_id: int,
-        revision_id: int,
-        position: NewTransactionPosition,
-    ) -> int:
-        item_id = await conn.fetchval(
-            "insert into purchase_item (transaction_id) values ($1) returning id",
-            transaction_id,
-        )
-        await conn.execute(
-            "insert into purchase_item_history(id, revision_id, name, price, communist_shares) "
-            "values ($1, $2, $3, $4, $5)",
-            item_id,
-            revision_id,
-            position.name,
-            position.price,
-            position.communist_shares,
-        )
-        if position.usages:
-            await self._put_position_usages(
-                conn=conn,
-                group_id=group_id,
-                item_id=item_id,
-                revision_id=revision_id,
-                usages=position.usages,
-            )
+        The content is streamed into the blob storage and its size limit enforced on the fly, no database
+        connection is held while receiving it.
+        """
+        if mime_type not in ALLOWED_FILETYPES:
+            raise InvalidArgument(f"File type {mime_type} is not an accepted file type")
 
-        return item_id
+        # write access is checked up front as well to not accept any content from users who cannot attach it
+        async with self.db_pool.acquire() as conn:
+            await check_group_permissions(conn=conn, group_id=group_id, user=user, can_write=True)
+        staged = await self.blob_service.stage_blob(content, max_size=self.config.api.max_uploadable_file_size * 1024)
+        blob_id = await self._add_uploaded_blob(user=user, group_id=group_id, staged=staged, mime_type=mime_type)
+        return UploadedFile(blob_id=blob_id, mime_type=mime_type, size=staged.size)
 
-    async def _process_position_update(
-        self,
-        *,
+    @staticmethod
+    async def _put_transaction_positions(
         conn: asyncpg.Connection,
         transaction_id: int,
-        group_id: int,
         revision_id: int,
-        position: NewTransactionPosition | TransactionPosition,
+        positions: Sequence[NewTransactionPosition],
     ):
-        if isinstance(position, TransactionPosition):
-            await self._put_transaction_position(
-                conn=conn,
-                group_id=group_id,
-                item_id=position.id,
-                revision_id=revision_id,
-                position=position,
+        """Write new and changed positions of a revision with a constant number of statements"""
+        if len(positions) <= 0:
+            return
+
+        # a position changed more than once in the same request is written once, the last change wins
+        last_changes = {
+            position.id: i for i, position in enumerate(positions) if isinstance(position, TransactionPosition)
+        }
+        positions = [
+            position
+            for i, position in enumerate(positions)
+            if not isinstance(position, TransactionPosition) or last_changes[position.id] == i
+        ]
+
+        n_new_positions = sum(1 for position in positions if not isinstance(position, TransactionPosition))
+        new_item_ids = iter(
+            await conn.fetchval(
+                "with new_item as ("
+                "   insert into purchase_item (transaction_id) select $1 from generate_series(1, $2) returning id"
+                ") select coalesce(array_agg(id order by id), array []::integer[]) from new_item",
+                transaction_id,
+                n_new_positions,
             )
-        else:
-            await self._create_transaction_position(
-                conn=conn,
-                group_id=group_id,
-                transaction_id=transaction_id,
-                revision_id=revision_id,
-                position=position,
+            if n_new_positions > 0
+            else []
+        )
+        item_ids = [
+            position.id if isinstance(position, TransactionPosition) else next(new_item_ids) for position in positions
+        ]
+
+        await conn.execute(
+            "insert into purchase_item_history(id, revision_id, name, price, communist_shares, deleted) "
+            "select unnest($2::int[]), $1, unnest($3::text[]), unnest($4::double precision[]), "
+            "   unnest($5::double precision[]), unnest($6::bool[]) "
+            "on conflict (id, revision_id) do update "
+            "set name = excluded.name, price = excluded.price, communist_shares = excluded.communist_shares, "
+            "   deleted = excluded.deleted",
+            revision_id,
+            item_ids,
+            [position.name for position in positions],
+            [position.price for position in positions],
+            [position.communist_shares for position in positions],
+            [isinstance(position, TransactionPosition) and position.deleted for position in positions],
+        )
+
+        usages = [
+            (item_id, account_id, value)
+            for item_id, position in zip(item_ids, positions)
+            for account_id, value in position.usages.items()
+        ]
+        if len(usages) > 0:
+            await conn.execute(
+                "insert into purchase_item_usage(item_id, revision_id, account_id, share_amount) "
+                "select unnest($2::int[]), $1, unnest($3::int[]), unnest($4::double precision[])",
+                revision_id,
+                [usage[0] for usage in usages],
+                [usage[1] for usage in usages],
+                [usage[2] for usage in usages],
             )
 
-    async def _update_transaction(
+    async def _write_transaction_update(
         self,
         *,
         conn: Connection,
         user: User,
+        group_id: int,
         transaction_id: int,
         transaction: UpdateTransaction,
-    ):
-        group_id = await self._check_transaction_permissions(
-            conn=conn,
-            user=user,
-            transaction_id=transaction_id,
-            can_write=True,
-            transaction_type=transaction.type,
-        )
+    ) -> int:
+        """Write a transaction update in an uncommitted revision, returns the revision id"""
         revision_id = await self._create_revision(conn=conn, user=user, transaction_id=transaction_id)
         await conn.execute(
             "insert into transaction_history (id, revision_id, currency_identifier, currency_conversion_rate, "
@@ -565,7 +675,6 @@ class TransactionService(Service[Config]):
         )
         await self._put_transaction_debitor_shares(
             conn=conn,
-            group_id=group_id,
             transaction_id=transaction_id,
             revision_id=revision_id,
             debitor_shares=transaction.debitor_shares,
@@ -578,35 +687,22 @@ class TransactionService(Service[Config]):
         )
         await self._put_transaction_creditor_shares(
             conn=conn,
-            group_id=group_id,
             transaction_id=transaction_id,
             revision_id=revision_id,
             creditor_shares=transaction.creditor_shares,
         )
 
-        if transaction.new_positions:
-            for position in transaction.new_positions:
-                await self._create_transaction_position(
-                    conn=conn,
-                    group_id=group_id,
-                    transaction_id=transaction_id,
-                    revision_id=revision_id,
-                    position=position,
-                )
-
-        if transaction.changed_positions:
-            for position in transaction.changed_positions:
-                await self._put_transaction_position(
-                    conn=conn,
-                    group_id=group_id,
-                    item_id=position.id,
-                    revision_id=revision_id,
-                    position=position,
-                )
+        await self._put_transaction_positions(
+            conn=conn,
+            transaction_id=transaction_id,
+            revision_id=revision_id,
+            positions=[*transaction.new_positions, *transaction.changed_positions],
+        )
 
         for new_attachment in transaction.new_files:
             await self._add_file_to_revision(
                 conn=conn,
+                group_id=group_id,
                 revision_id=revision_id,
                 transaction_id=transaction_id,
                 attachment=new_attachment,
@@ -619,7 +715,8 @@ class TransactionService(Service[Config]):
                 transaction_id=transaction_id,
                 attachment=updated_attachment,
             )
-        await self._commit_revision(conn=conn, revision_id=revision_id)
+
+        return revision_id
 
     @with_db_transaction
     @requires_group_permissions(requires_write=True)
@@ -632,12 +729,94 @@ class TransactionService(Service[Config]):
         transaction_id: int,
         transaction: UpdateTransaction,
     ):
-        await self._update_transaction(
+        group_id = await self._check_transaction_permissions(
+            conn=conn,
+            user=user,
+            transaction_id=transaction_id,
+            can_write=True,
+            transaction_type=transaction.type,
+        )
+        await self._check_referenced_accounts(conn=conn, group_id=group_id, transactions=[transaction])
+        revision_id = await self._write_transaction_update(
             conn=conn,
             user=user,
+            group_id=group_id,
             transaction_id=transaction_id,
             transaction=transaction,
         )
+        await self.commit_revisions(conn=conn, revision_ids=[revision_id])
+
+    @with_db_transaction
+    @requires_group_permissions(requires_write=True)
+    @with_group_last_changed_update
+    async def batch_update_transactions(
+        self,
+        *,
+        conn: Connection,
+        user: User,
+        group_id: int,
+        batch: TransactionBatch,
+    ) -> list[Transaction]:
+        """
+        Create and update multiple transactions of a group in one database transaction.
+
+        Permissions, referenced accounts and the group's last changed timestamp are checked / updated once for the
+        whole batch and all resulting revisions are committed together.
+        Returns the resulting transactions, new ones first, both in the order given in the batch.
+        """
+        changed_ids = [t.id for t in batch.changed_transactions]
+        if changed_ids:
+            existing_types = {
+                row["id"]: row["type"]
+                for row in await conn.fetch(
+                    "select id, type from transaction where group_id = $1 and id = any($2::int[])",
+                    group_id,
+                    changed_ids,
+                )
+            }
+            for changed in batch.changed_transactions:
+                if changed.id not in existing_types:
+                    raise InvalidArgument(f"Transaction {changed.id} does not exist in this group")
+                if existing_types[changed.id] != changed.type.value:
+                    raise InvalidArgument(
+                        f"Transaction type {existing_types[changed.id]} does not match the expected type "
+                        f"{changed.type.value}"
+                    )
+
+        await self._check_referenced_accounts(
+            conn=conn, group_id=group_id, transactions=[*batch.new_transactions, *batch.changed_transactions]
+        )
+
+        transaction_ids = []
+        revision_ids = []
+        for new in batch.new_transactions:
+            transaction_id, revision_id = await self._write_new_transaction(
+                conn=conn, user=user, group_id=group_id, transaction=new
+            )
+            transaction_ids.append(transaction_id)
+            revision_ids.append(revision_id)
+        for changed in batch.changed_transactions:
+            revision_id = await self._write_transaction_update(
+                conn=conn, user=user, group_id=group_id, transaction_id=changed.id, transaction=changed
+            )
+            transaction_ids.append(changed.id)
+            revision_ids.append(revision_id)
+
+        await self.commit_revisions(conn=conn, revision_ids=revision_ids)
+
+        transactions = await conn.fetch_many(
+            Transaction,
+            "select cts.* from unnest($2::int[]) with ordinality as ids(id, idx) "
+            "   join current_transaction_state cts on cts.id = ids.id "
+            "where cts.group_id = $1 "
+            "order by ids.idx",
+            group_id,
+            transaction_ids,
+        )
+        for transaction in transactions:
+            for attachment in transaction.files:
+                attachment.host_url = self._file_host_url
+        return transactions
 
     @with_db_transaction
     @requires_group_permissions(requires_write=True)
@@ -657,17 +836,21 @@ class TransactionService(Service[Config]):
             can_write=True,
             transaction_type=TransactionType.purchase,
         )
+        await _check_accounts_exist(
+            conn=conn,
+            group_id=group_id,
+            account_ids={account_id for position in positions for account_id in position.usages.keys()},
+            error_message="one of the accounts referenced by a position usage does not exist in this group",
+        )
         revision_id = await self._create_revision(conn=conn, user=user, transaction_id=transaction_id)
 
-        for position in positions:
-            await self._process_position_update(
-                conn=conn,
-                transaction_id=transaction_id,
-                group_id=group_id,
-                revision_id=revision_id,
-                position=position,
-            )
-        await self._commit_revision(conn=conn, revision_id=revision_id)
+        await self._put_transaction_positions(
+            conn=conn,
+            transaction_id=transaction_id,
+            revision_id=revision_id,
+            positions=positions,
+        )
+        await self.commit_revisions(conn=conn, revision_ids=[revision_id])
 
     @with_db_transaction
     @requires_group_permissions(requires_write=True)
@@ -682,8 +865,9 @@ class TransactionService(Service[Config]):
 
         row = await conn.fetchrow(
             "select name, description, revision_id, deleted "
-            "from transaction_state_valid_at() "
-            "where transaction_id = $1",
+            "from group_transaction_state_valid_at($1) "
+            "where transaction_id = $2",
+            group_id,
             transaction_id,
         )
         if row is None:
@@ -706,15 +890,33 @@ class TransactionService(Service[Config]):
             transaction_id,
             revision_id,
         )
-        await self._commit_revision(conn=conn, revision_id=revision_id)
+        await self.commit_revisions(conn=conn, revision_ids=[revision_id])
 
     @staticmethod
-    async def _commit_revision(conn: asyncpg.Connection, revision_id: int):
-        """Touches a revision to have all associated constraints run"""
+    async def commit_revisions(conn: asyncpg.Connection, revision_ids: list[int]):
+        """
+        Touches revisions to have all associated constraints run, refreshes the current transaction state
+        and applies the changes to the cached group balances
+        """
+        old_state = await _fetch_transaction_balance_state(
+            conn,
+            await conn.fetchval(
+                "select array_agg(transaction_id) from transaction_revision where id = any($1::bigint[])",
+                revision_ids,
+            ),
+        )
+        transaction_ids = await conn.fetchval(
+            "with committed as ("
+            "   update transaction_revision set created_at = now() where id = any($1::bigint[]) returning transaction_id"
+            ") select array_agg(transaction_id) from committed",
+            revision_ids,
+        )
         await conn.execute(
-            "update transaction_revision set created_at = now() where id = $1",
-            revision_id,
+            "select refresh_current_transaction_states($1::int[])",
+            transaction_ids,
         )
+        new_state = await _fetch_transaction_balance_state(conn, transaction_ids)
+        await _update_cached_balances(conn, old_transactions=old_state, new_transactions=new_state)
 
     @staticmethod
     async def _create_revision(conn: asyncpg.Connection, user: User, transaction_id: int) -> int:
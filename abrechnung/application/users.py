@@ -1,7 +1,8 @@
-from datetime import datetime, timezone
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 
-import bcrypt
 from asyncpg.pool import Pool
 from email_validator import EmailNotValidError, validate_email
 from jose import JWTError, jwt
@@ -11,6 +12,7 @@ from sftkit.error import AccessDenied, InvalidArgument, Unauthorized
 from sftkit.service import Service, with_db_transaction
 
 from abrechnung.config import Config
+from abrechnung.core.passwords import PasswordHasher
 from abrechnung.domain.users import Session, User
 from abrechnung.util import is_valid_uuid
 
@@ -30,6 +32,57 @@ class TokenMetadata(BaseModel):
     session_id: int
 
 
+class UserCache:
+    """
+    LRU cache of authenticated users by (session id, user id).
+
+    Entries expire after ttl. The cache stays disabled until enable is called, which the api does once it listens
+    for the user change notifications sent by the database.
+    """
+
+    def __init__(self, max_size: int, ttl: timedelta):
+        self.max_size = max_size
+        self.ttl = ttl.total_seconds()
+        self.enabled = False
+        # bumped on every invalidation, users read from the database before an invalidation must not be cached
+        self.generation = 0
+        self._entries: OrderedDict[tuple[int, int], tuple[float, User]] = OrderedDict()
+
+    def enable(self):
+        self.clear()
+        self.enabled = self.max_size > 0
+
+    def get(self, session_id: int, user_id: int) -> User | None:
+        if not self.enabled:
+            return None
+        entry = self._entries.get((session_id, user_id))
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self._entries[(session_id, user_id)]
+            return None
+        self._entries.move_to_end((session_id, user_id))
+        return user
+
+    def put(self, session_id: int, user_id: int, user: User, generation: int):
+        if not self.enabled or generation != self.generation:
+            return
+        self._entries[(session_id, user_id)] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end((session_id, user_id))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: int):
+        self.generation += 1
+        for key in [key for key in self._entries if key[1] == user_id]:
+            del self._entries[key]
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+
 async def _check_user_exists(*, conn: Connection, username: str, email: str):
     user_exists = await conn.fetchrow(
         "select "
@@ -57,12 +110,22 @@ class UserService(Service[Config]):
         self.allow_guest_users = self.config.registration.allow_guest_users
         self.valid_email_domains = self.config.registration.valid_email_domains
 
-    def _hash_password(self, password: str) -> str:
-        salt = bcrypt.gensalt()
-        return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
+        self.user_cache = UserCache(max_size=self.config.api.user_cache_size, ttl=self.config.api.user_cache_ttl)
+        self.password_hasher = PasswordHasher(self.config.password_hashing)
+
+    async def handle_user_change_notification(self, payload: str | None):
+        """Handler for the 'user_changed' database notification, the payload is the id of the changed user"""
+        if payload is None:
+            # (re)connected to the database, we might have missed notifications in the meantime
+            self.user_cache.enable()
+        else:
+            self.user_cache.invalidate_user(int(payload))
+
+    async def _hash_password(self, password: str) -> str:
+        return await self.password_hasher.hash(password)
 
-    def _check_password(self, password: str, hashed_password: str) -> bool:
-        return bcrypt.checkpw(password.encode("utf-8"), hashed_password.encode("utf-8"))
+    async def _check_password(self, password: str, hashed_password: str) -> bool:
+        return await self.password_hasher.verify(password, hashed_password)
 
     def _create_access_token(self, user_id: int, session_id: int):
         data = {
@@ -82,50 +145,57 @@ class UserService(Service[Config]):
         except JWTError:
             raise Unauthorized("invalid access token")
 
-    @with_db_transaction
-    async def get_user_from_token(self, *, conn: Connection, token: str) -> User:
+    async def get_user_from_token(self, *, token: str) -> User:
         token_metadata = self.decode_jwt_payload(token)
+        user = self.user_cache.get(token_metadata.session_id, token_metadata.user_id)
+        if user is not None:
+            return user
 
+        generation = self.user_cache.generation
+        user = await self._get_user_from_session(session_id=token_metadata.session_id, user_id=token_metadata.user_id)
+        self.user_cache.put(token_metadata.session_id, token_metadata.user_id, user, generation)
+        return user
+
+    @with_db_transaction
+    async def _get_user_from_session(self, *, conn: Connection, session_id: int, user_id: int) -> User:
         sess = await conn.fetchval(
             "select id from session where id = $1 and user_id = $2 and valid_until is null or valid_until > now()",
-            token_metadata.session_id,
-            token_metadata.user_id,
+            session_id,
+            user_id,
         )
         if not sess:
             raise Unauthorized("invalid access token")
-        return await self._get_user(conn=conn, user_id=token_metadata.user_id)
+        return await self._get_user(conn=conn, user_id=user_id)
 
     async def _verify_user_password(self, user_id: int, password: str) -> bool:
-        async with self.db_pool.acquire() as conn:
-            user = await conn.fetchrow(
-                "select hashed_password, pending, deleted from usr where id = $1",
-                user_id,
-            )
-            if user is None:
-                raise InvalidArgument(f"User with id {user_id} does not exist")
+        # the connection is released before hashing, waiting for a free hashing worker must not block the pool
+        user = await self.db_pool.fetchrow(
+            "select hashed_password, pending, deleted from usr where id = $1",
+            user_id,
+        )
+        if user is None:
+            raise InvalidArgument(f"User with id {user_id} does not exist")
 
-            if user["deleted"] or user["pending"]:
-                return False
+        if user["deleted"] or user["pending"]:
+            return False
 
-            return self._check_password(password, user["hashed_password"])
+        return await self._check_password(password, user["hashed_password"])
 
-    @with_db_transaction
-    async def login_user(
-        self, *, conn: Connection, username: str, password: str, session_name: str
-    ) -> tuple[int, int, str]:
+    async def login_user(self, *, username: str, password: str, session_name: str) -> tuple[int, int, str]:
         """
         validate whether a given user can login
 
         If successful return the user id, a new session id and a session token
         """
-        user = await conn.fetchrow(
+        # the password is checked outside of a transaction such that no connection is held while hashing
+        user = await self.db_pool.fetchrow(
             "select id, hashed_password, pending, deleted from usr where username = $1 or email = $1",
             username,
         )
         if user is None:
             raise InvalidArgument("Login failed")
 
-        if not self._check_password(password, user["hashed_password"]):
+        if not await self._check_password(password, user["hashed_password"]):
             raise InvalidArgument("Login failed")
 
         if user["deleted"]:
@@ -134,14 +204,44 @@ class UserService(Service[Config]):
         if user["pending"]:
             raise InvalidArgument("You need to confirm your email before logging in")
 
+        rehashed_password = None
+        if self.password_hasher.needs_rehash(user["hashed_password"]):
+            rehashed_password = await self._hash_password(password)
+
+        return await self._create_session(
+            user_id=user["id"],
+            session_name=session_name,
+            previous_hashed_password=user["hashed_password"],
+            rehashed_password=rehashed_password,
+        )
+
+    @with_db_transaction
+    async def _create_session(
+        self,
+        *,
+        conn: Connection,
+        user_id: int,
+        session_name: str,
+        previous_hashed_password: str,
+        rehashed_password: str | None,
+    ) -> tuple[int, int, str]:
+        if rehashed_password is not None:
+            # upgrade hashes created with a different work factor, unless the password was changed in the meantime
+            await conn.execute(
+                "update usr set hashed_password = $3 where id = $1 and hashed_password = $2",
+                user_id,
+                previous_hashed_password,
+                rehashed_password,
+            )
+
         session_id = await conn.fetchval(
             "insert into session (user_id, name) values ($1, $2) returning id",
-            user["id"],
+            user_id,
             session_name,
         )
-        access_token = self._create_access_token(user_id=user["id"], session_id=session_id)
+        access_token = self._create_access_token(user_id=user_id, session_id=session_id)
 
-        return user["id"], session_id, access_token
+        return user_id, session_id, access_token
 
     @with_db_transaction
     async def logout_user(self, *, conn: Connection, user: User, session_id: int):
@@ -152,11 +252,12 @@ class UserService(Service[Config]):
         )
         if sess_id is None:
             raise InvalidArgument("Already logged out")
+        self.user_cache.invalidate_user(user.id)
 
     @with_db_transaction
     async def demo_register_user(self, *, conn: Connection, username: str, email: str, password: str) -> int:
         await _check_user_exists(conn=conn, username=username, email=email)
-        hashed_password = self._hash_password(password)
+        hashed_password = await self._hash_password(password)
         user_id = await conn.fetchval(
             "insert into usr (username, email, hashed_password, pending) values ($1, $2, $3, false) returning id",
             username,
@@ -227,7 +328,7 @@ class UserService(Service[Config]):
                 f"Only users with emails out of the following domains are allowed: {self.valid_email_domains}"
             )
 
-        hashed_password = self._hash_password(password)
+        hashed_password = await self._hash_password(password)
         user_id = await conn.fetchval(
             "insert into usr (username, email, hashed_password, is_guest_user, pending) values ($1, $2, $3, $4, $5) returning id",
             username,
@@ -300,6 +401,7 @@ class UserService(Service[Config]):
         )
         if not sess_id:
             raise InvalidArgument(f"no such session found with id {session_id}")
+        self.user_cache.invalidate_user(user.id)
 
     @with_db_transaction
     async def rename_session(self, *, conn: Connection, user: User, session_id: int, name: str):
@@ -311,15 +413,15 @@ class UserService(Service[Config]):
         )
         if not sess_id:
             raise InvalidArgument(f"no such session found with id {session_id}")
+        self.user_cache.invalidate_user(user.id)
 
-    @with_db_transaction
-    async def change_password(self, *, conn: Connection, user: User, old_password: str, new_password: str):
+    async def change_password(self, *, user: User, old_password: str, new_password: str):
         valid_pw = await self._verify_user_password(user.id, old_password)
         if not valid_pw:
             raise InvalidPassword
 
-        hashed_password = self._hash_password(new_password)
-        await conn.execute(
+        hashed_password = await self._hash_password(new_password)
+        await self.db_pool.execute(
             "update usr set hashed_password = $1 where id = $2",
             hashed_password,
             user.id,
@@ -359,6 +461,7 @@ class UserService(Service[Config]):
 
         await conn.execute("delete from pending_email_change where user_id = $1", user_id)
         await conn.execute("update usr set email = $2 where id = $1", user_id, row["new_email"])
+        self.user_cache.invalidate_user(user_id)
 
         return user_id
 
@@ -388,7 +491,7 @@ class UserService(Service[Config]):
             raise AccessDenied("Invalid confirmation token")
 
         await conn.execute("delete from pending_password_recovery where user_id = $1", user_id)
-        hashed_password = self._hash_password(password=new_password)
+        hashed_password = await self._hash_password(password=new_password)
         await conn.execute(
             "update usr set hashed_password = $2 where id = $1",
             user_id,
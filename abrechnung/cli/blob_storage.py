@@ -0,0 +1,48 @@
+import asyncio
+from typing import Annotated
+
+import typer
+
+from abrechnung.application.blobs import BlobService
+from abrechnung.config import Config, DatabaseBlobStorageConfig
+from abrechnung.database.migrations import get_database
+
+blob_storage_cli = typer.Typer()
+
+
+async def _run_blob_service(cfg: Config, func):
+    db = get_database(cfg.database)
+    db_pool = await db.create_pool(n_connections=2)
+    blob_service = BlobService(db_pool=db_pool, config=cfg)
+    try:
+        return await func(blob_service)
+    finally:
+        await blob_service.close()
+        await db_pool.close()
+
+
+@blob_storage_cli.command()
+def migrate(
+    ctx: typer.Context,
+    batch_size: Annotated[int, typer.Option(help="Number of blobs moved per database transaction")] = 100,
+):
+    """Move the contents of all blobs stored in the database to the configured blob storage."""
+    if isinstance(ctx.obj.config.blob_storage, DatabaseBlobStorageConfig):
+        print("No blob storage is configured, blobs are kept in the database")
+        raise typer.Exit(1)
+
+    n_moved = asyncio.run(
+        _run_blob_service(ctx.obj.config, lambda blob_service: blob_service.move_blobs_to_storage(batch_size))
+    )
+    print(f"Moved {n_moved} blobs to the blob storage")
+
+
+async def _cleanup(blob_service: BlobService) -> tuple[int, int]:
+    return await blob_service.delete_expired_uploads(), await blob_service.delete_orphaned_blobs()
+
+
+@blob_storage_cli.command()
+def cleanup(ctx: typer.Context):
+    """Delete expired uploads and the objects of deleted blobs from the configured blob storage."""
+    n_uploads, n_deleted = asyncio.run(_run_blob_service(ctx.obj.config, _cleanup))
+    print(f"Deleted {n_uploads} expired uploads and {n_deleted} orphaned blobs from the blob storage")
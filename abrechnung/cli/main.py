@@ -11,6 +11,7 @@ from abrechnung.mailer import Mailer
 from abrechnung.util import log_setup
 
 from .admin import admin_cli
+from .blob_storage import blob_storage_cli
 from .database import database_cli
 from .demo import demo_cli
 
@@ -66,6 +67,7 @@ def show_openapi(ctx: typer.Context):
 cli.add_typer(database_cli, name="db", help="Manage everything related to the abrechnung database")
 cli.add_typer(demo_cli, name="demo", help="Manage abrechnung demo instances")
 cli.add_typer(admin_cli, name="admin", help="General administrative utilities")
+cli.add_typer(blob_storage_cli, name="blob-storage", help="Manage the storage of file attachments")
 
 
 def main():
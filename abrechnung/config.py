@@ -1,10 +1,10 @@
 import enum
 from datetime import timedelta
 from pathlib import Path
-from typing import List, Literal, Optional, Tuple, Type
+from typing import Annotated, List, Literal, Optional, Tuple, Type, Union
 
 import yaml
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from pydantic_settings import (
     BaseSettings,
     PydanticBaseSettingsSource,
@@ -46,6 +46,10 @@ class ApiConfig(HTTPServerConfig):
     id: str = "default"
     max_uploadable_file_size: int = 1024
     enable_cors: bool = True
+    # authenticated users are cached per session, changes are propagated through database notifications,
+    # the ttl bounds how long a missed notification can go unnoticed. A size of 0 disables the cache.
+    user_cache_size: int = 4096
+    user_cache_ttl: timedelta = timedelta(minutes=1)
 
 
 class RegistrationConfig(BaseModel):
@@ -65,6 +69,12 @@ class EmailConfig(BaseModel):
     port: int
     mode: Literal["local", "smtp-ssl", "smtp", "smtp-starttls"] = "smtp"
     auth: Optional[AuthConfig] = None
+    # number of sessions with the mail server kept open, mails are sent over them concurrently
+    max_connections: int = 2
+    # number of mails a mailer claims at once
+    batch_size: int = 20
+    # failed mails are given up on after this many attempts
+    max_attempts: int = 5
 
 
 class MetricsConfig(BaseModel):
@@ -72,6 +82,45 @@ class MetricsConfig(BaseModel):
     expose_money_amounts: bool = False
 
 
+class PasswordHashingConfig(BaseModel):
+    # bcrypt cost of newly hashed passwords, existing hashes are rehashed on the next login of their user
+    work_factor: int = 12
+    # number of passwords hashed or verified concurrently, further requests queue up
+    max_workers: int = 2
+
+
+class ThumbnailConfig(BaseModel):
+    # thumbnails fit into a square of these edge lengths in pixels
+    sizes: list[int] = [128, 256, 512]
+    # number of processes generating thumbnails
+    max_workers: int = 1
+
+
+class DatabaseBlobStorageConfig(BaseModel):
+    type: Literal["database"] = "database"
+
+
+class LocalBlobStorageConfig(BaseModel):
+    type: Literal["local"]
+    path: Path
+
+
+class S3BlobStorageConfig(BaseModel):
+    type: Literal["s3"]
+    endpoint_url: str
+    bucket: str
+    access_key_id: str
+    secret_access_key: str
+    region: str = "us-east-1"
+    # prepended to the storage key of all objects, allows sharing a bucket
+    prefix: str = ""
+
+
+BlobStorageConfig = Annotated[
+    Union[DatabaseBlobStorageConfig, LocalBlobStorageConfig, S3BlobStorageConfig], Field(discriminator="type")
+]
+
+
 class Config(BaseSettings):
     model_config = SettingsConfigDict(env_prefix="ABRECHNUNG_", env_nested_delimiter="__")
 
@@ -83,6 +132,9 @@ class Config(BaseSettings):
     demo: DemoConfig = DemoConfig()
     registration: RegistrationConfig = RegistrationConfig()
     metrics: MetricsConfig = MetricsConfig()
+    password_hashing: PasswordHashingConfig = PasswordHashingConfig()
+    blob_storage: BlobStorageConfig = DatabaseBlobStorageConfig()
+    thumbnails: ThumbnailConfig = ThumbnailConfig()
 
     @classmethod
     def settings_customise_sources(
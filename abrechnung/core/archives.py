@@ -0,0 +1,77 @@
+import tarfile
+import time
+import zipfile
+from typing import AsyncIterator, NamedTuple
+
+
+class ArchiveEntry(NamedTuple):
+    name: str
+    size: int
+    chunks: AsyncIterator[bytes]
+    # already compressed content, e.g. images, is stored as is
+    compress: bool = False
+
+
+class _StreamBuffer:
+    """Write-only file object collecting everything written to it until it is drained"""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def stream_zip(entries: AsyncIterator[ArchiveEntry]) -> AsyncIterator[bytes]:
+    """
+    Yields a zip archive of the given entries without buffering more than a chunk of any entry.
+
+    As the output is not seekable the sizes and checksums of entries are written in data descriptors after their
+    content, entry sizes have to be known upfront to decide whether they need zip64 extensions.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, mode="w") as archive:
+        async for entry in entries:
+            info = zipfile.ZipInfo(entry.name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED if entry.compress else zipfile.ZIP_STORED
+            info.file_size = entry.size
+            with archive.open(info, mode="w") as f:
+                async for chunk in entry.chunks:
+                    f.write(chunk)
+                    yield buffer.drain()
+            yield buffer.drain()
+    # closing the archive writes its central directory
+    yield buffer.drain()
+
+
+async def stream_tar(entries: AsyncIterator[ArchiveEntry]) -> AsyncIterator[bytes]:
+    """Yields an uncompressed tar archive of the given entries, entry sizes have to be known upfront"""
+    async for entry in entries:
+        info = tarfile.TarInfo(entry.name)
+        info.size = entry.size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+
+        written = 0
+        async for chunk in entry.chunks:
+            written += len(chunk)
+            yield chunk
+        if written != entry.size:
+            raise ValueError(f"archive entry {entry.name} has {written} bytes instead of the announced {entry.size}")
+
+        remainder = entry.size % tarfile.BLOCKSIZE
+        if remainder:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+    # the end of the archive is marked by two empty blocks, padded to a full record
+    yield tarfile.NUL * tarfile.RECORDSIZE
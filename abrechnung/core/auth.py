@@ -1,17 +1,48 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
 from sftkit.database import Connection
 from sftkit.error import AccessDenied, InvalidArgument
 
 from abrechnung.domain.groups import GroupMember
 from abrechnung.domain.users import User
 
+# (group id, user id) -> membership, None for users which are not a member of the group
+_group_membership_cache: ContextVar[dict[tuple[int, int], GroupMember | None] | None] = ContextVar(
+    "group_membership_cache", default=None
+)
+
+
+@contextmanager
+def group_membership_cache() -> Iterator[None]:
+    """
+    Caches the group memberships looked up by get_group_membership until the context is left.
+
+    The http api opens one cache per request such that a request checks the permissions of each group only once,
+    no matter how many service calls it consists of.
+    """
+    token = _group_membership_cache.set({})
+    try:
+        yield
+    finally:
+        _group_membership_cache.reset(token)
+
+
+def invalidate_group_membership_cache(group_id: int):
+    """Has to be called whenever the membership of any user in the group changes"""
+    cache = _group_membership_cache.get()
+    if cache is None:
+        return
+    for key in [key for key in cache if key[0] == group_id]:
+        del cache[key]
+
+
+async def get_group_membership(conn: Connection, group_id: int, user: User) -> GroupMember | None:
+    cache = _group_membership_cache.get()
+    if cache is not None and (group_id, user.id) in cache:
+        return cache[(group_id, user.id)]
 
-async def check_group_permissions(
-    conn: Connection,
-    group_id: int,
-    user: User,
-    is_owner: bool = False,
-    can_write: bool = False,
-) -> GroupMember:
     membership = await conn.fetch_maybe_one(
         GroupMember,
         "select g.*, u.username from group_membership g "
@@ -20,6 +51,19 @@ async def check_group_permissions(
         group_id,
         user.id,
     )
+    if cache is not None:
+        cache[(group_id, user.id)] = membership
+    return membership
+
+
+async def check_group_permissions(
+    conn: Connection,
+    group_id: int,
+    user: User,
+    is_owner: bool = False,
+    can_write: bool = False,
+) -> GroupMember:
+    membership = await get_group_membership(conn=conn, group_id=group_id, user=user)
     if membership is None:
         raise InvalidArgument("group not found")
 
@@ -40,6 +84,8 @@ async def create_group_log(
     message: str | None = None,
     affected_user_id: int | None = None,
 ):
+    # the log is part of the group contents, clients rely on grp.last_changed to notice new entries
+    await conn.execute("update grp set last_changed = now() where id = $1", group_id)
     await conn.execute(
         "insert into group_log (group_id, user_id, type, message, affected) values ($1, $2, $3, $4, $5)",
         group_id,
@@ -0,0 +1,217 @@
+import abc
+import asyncio
+import hashlib
+import hmac
+import os
+import tempfile
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator
+from urllib.parse import quote, urlsplit
+
+import httpx
+
+from abrechnung.config import BlobStorageConfig, LocalBlobStorageConfig, S3BlobStorageConfig
+
+# size of the chunks blobs are streamed in
+BLOB_CHUNK_SIZE = 256 * 1024
+
+
+class BlobStorage(abc.ABC):
+    """
+    Storage for the contents of blobs outside of the database.
+
+    Storage keys are never reused, an object is written once before the blob referencing it is committed and deleted
+    once that blob has been deleted.
+    """
+
+    @staticmethod
+    def new_key() -> str:
+        return uuid.uuid4().hex
+
+    @abc.abstractmethod
+    async def put(self, key: str, content: bytes):
+        pass
+
+    async def put_stream(self, key: str, chunks: AsyncIterator[bytes]):
+        """Stores the concatenated chunks under key, backends which cannot write incrementally buffer them"""
+        await self.put(key, b"".join([chunk async for chunk in chunks]))
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> bytes:
+        """Returns the content stored under key, raises FileNotFoundError if it does not exist"""
+
+    @abc.abstractmethod
+    def stream(self, key: str, start: int, end: int) -> AsyncIterator[bytes]:
+        """Yields the bytes [start, end) stored under key in chunks, raises FileNotFoundError if it does not exist"""
+
+    @abc.abstractmethod
+    async def delete(self, key: str):
+        """Deletes the content stored under key, deleting a non-existing key is not an error"""
+
+    async def close(self):
+        pass
+
+
+class LocalBlobStorage(BlobStorage):
+    """Stores blobs as files in a local directory, fanned out into subdirectories by the first two key characters"""
+
+    def __init__(self, config: LocalBlobStorageConfig):
+        self.path = config.path
+
+    def _path(self, key: str) -> Path:
+        return self.path / key[:2] / key
+
+    def _put(self, key: str, content: bytes):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first such that readers never see partially written blobs
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    async def put(self, key: str, content: bytes):
+        await asyncio.to_thread(self._put, key, content)
+
+    async def put_stream(self, key: str, chunks: AsyncIterator[bytes]):
+        path = self._path(key)
+        await asyncio.to_thread(path.parent.mkdir, parents=True, exist_ok=True)
+        fd, tmp_path = await asyncio.to_thread(tempfile.mkstemp, dir=path.parent, prefix=".tmp-")
+        f = os.fdopen(fd, "wb")
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(f.write, chunk)
+            await asyncio.to_thread(f.close)
+            await asyncio.to_thread(os.replace, tmp_path, path)
+        except BaseException:
+            f.close()
+            os.unlink(tmp_path)
+            raise
+
+    async def get(self, key: str) -> bytes:
+        return await asyncio.to_thread(self._path(key).read_bytes)
+
+    async def stream(self, key: str, start: int, end: int) -> AsyncIterator[bytes]:
+        f = await asyncio.to_thread(self._path(key).open, "rb")
+        try:
+            await asyncio.to_thread(f.seek, start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(BLOB_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._path(key).unlink, missing_ok=True)
+
+
+def _sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hmac_sha256(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+class S3BlobStorage(BlobStorage):
+    """
+    Stores blobs in an S3 compatible object store.
+
+    Objects are addressed path style, i.e. <endpoint_url>/<bucket>/<prefix><key>, which all S3 compatible stores
+    support. Requests are signed with AWS signature version 4. Streamed uploads are buffered in memory as plain PUT
+    requests need to know their length upfront, their size is limited by max_uploadable_file_size.
+    """
+
+    def __init__(self, config: S3BlobStorageConfig, transport: httpx.AsyncBaseTransport | None = None):
+        self.config = config
+        self.endpoint_url = config.endpoint_url.rstrip("/")
+        self.host = urlsplit(self.endpoint_url).netloc
+        self.client = httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(30.0))
+
+    def _object_path(self, key: str) -> str:
+        return "/" + quote(f"{self.config.bucket}/{self.config.prefix}{key}", safe="/-_.~")
+
+    def _signed_headers(self, method: str, path: str, payload: bytes) -> dict[str, str]:
+        now = datetime.now(tz=timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date_stamp = now.strftime("%Y%m%d")
+        payload_hash = _sha256_hex(payload)
+        headers = {"host": self.host, "x-amz-content-sha256": payload_hash, "x-amz-date": amz_date}
+
+        signed_headers = ";".join(sorted(headers))
+        canonical_headers = "".join(f"{name}:{headers[name]}\n" for name in sorted(headers))
+        canonical_request = "\n".join([method, path, "", canonical_headers, signed_headers, payload_hash])
+        scope = f"{date_stamp}/{self.config.region}/s3/aws4_request"
+        string_to_sign = "\n".join(
+            ["AWS4-HMAC-SHA256", amz_date, scope, _sha256_hex(canonical_request.encode("utf-8"))]
+        )
+
+        signing_key = ("AWS4" + self.config.secret_access_key).encode("utf-8")
+        for part in (date_stamp, self.config.region, "s3", "aws4_request"):
+            signing_key = _hmac_sha256(signing_key, part)
+        signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.config.access_key_id}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
+        )
+        del headers["host"]
+        return headers
+
+    async def _request(self, method: str, key: str, content: bytes = b"") -> httpx.Response:
+        path = self._object_path(key)
+        return await self.client.request(
+            method,
+            self.endpoint_url + path,
+            content=content,
+            headers=self._signed_headers(method, path, content),
+        )
+
+    async def put(self, key: str, content: bytes):
+        response = await self._request("PUT", key, content)
+        response.raise_for_status()
+
+    async def get(self, key: str) -> bytes:
+        response = await self._request("GET", key)
+        if response.status_code == 404:
+            raise FileNotFoundError(f"blob {key} does not exist in bucket {self.config.bucket}")
+        response.raise_for_status()
+        return response.content
+
+    async def stream(self, key: str, start: int, end: int) -> AsyncIterator[bytes]:
+        path = self._object_path(key)
+        headers = self._signed_headers("GET", path, b"")
+        headers["range"] = f"bytes={start}-{end - 1}"
+        async with self.client.stream("GET", self.endpoint_url + path, headers=headers) as response:
+            if response.status_code == 404:
+                raise FileNotFoundError(f"blob {key} does not exist in bucket {self.config.bucket}")
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(BLOB_CHUNK_SIZE):
+                yield chunk
+
+    async def delete(self, key: str):
+        response = await self._request("DELETE", key)
+        if response.status_code != 404:
+            response.raise_for_status()
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_blob_storage(config: BlobStorageConfig) -> BlobStorage | None:
+    """Returns the configured blob storage, None if blobs are stored in the database"""
+    if isinstance(config, LocalBlobStorageConfig):
+        return LocalBlobStorage(config)
+    if isinstance(config, S3BlobStorageConfig):
+        return S3BlobStorage(config)
+    return None
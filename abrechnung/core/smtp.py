@@ -0,0 +1,107 @@
+import asyncio
+import email.message
+import smtplib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Type, TypeVar
+
+from abrechnung.config import EmailConfig
+
+R = TypeVar("R")
+
+# seconds to wait for the mail server before a connection attempt or command fails
+SMTP_TIMEOUT = 30
+# idle sessions are closed instead of being reused after this many seconds, mail servers drop them eventually anyway
+SMTP_IDLE_TIMEOUT = 60
+
+
+class SmtpPool:
+    """
+    Keeps up to max_connections sessions with the mail server open and sends messages over them concurrently.
+
+    smtplib is blocking, every command runs in a thread of its own pool such that a slow mail server never stalls the
+    event loop. Sessions closed by the server while idle are transparently replaced by new ones.
+    """
+
+    def __init__(self, config: EmailConfig):
+        self.config = config
+        self._executor = ThreadPoolExecutor(max_workers=config.max_connections, thread_name_prefix="smtp")
+        self._semaphore = asyncio.Semaphore(config.max_connections)
+        # idle sessions together with the time they were last used, only touched from the event loop
+        self._idle: list[tuple[smtplib.SMTP, float]] = []
+
+    async def _run(self, func: Callable[..., R], *args) -> R:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _connect(self) -> smtplib.SMTP:
+        mode = self.config.mode
+        if mode == "local":
+            mail_sender_class: Type[smtplib.SMTP] | Type[smtplib.LMTP] | Type[smtplib.SMTP_SSL] = smtplib.LMTP
+        elif mode == "smtp-ssl":
+            mail_sender_class = smtplib.SMTP_SSL
+        else:
+            mail_sender_class = smtplib.SMTP
+
+        session = mail_sender_class(host=self.config.host, port=self.config.port, timeout=SMTP_TIMEOUT)
+        try:
+            if mode == "smtp-starttls":
+                session.starttls()
+            if self.config.auth:
+                session.login(user=self.config.auth.username, password=self.config.auth.password)
+        except BaseException:
+            session.close()
+            raise
+        return session
+
+    @staticmethod
+    def _disconnect(session: smtplib.SMTP):
+        try:
+            session.quit()
+        except (smtplib.SMTPException, OSError):
+            session.close()
+
+    async def _acquire(self) -> tuple[smtplib.SMTP, bool]:
+        """Returns an idle session or a new one if there is none, together with whether it has been used before"""
+        while self._idle:
+            session, last_used = self._idle.pop()
+            if time.monotonic() - last_used < SMTP_IDLE_TIMEOUT:
+                return session, True
+            await self._run(self._disconnect, session)
+        return await self._run(self._connect), False
+
+    def _release(self, session: smtplib.SMTP):
+        self._idle.append((session, time.monotonic()))
+
+    async def check(self):
+        """Connects to the mail server once, raises if that is not possible"""
+        async with self._semaphore:
+            session, _ = await self._acquire()
+            self._release(session)
+
+    async def send(self, message: email.message.EmailMessage):
+        async with self._semaphore:
+            session, reused = await self._acquire()
+            try:
+                await self._run(session.send_message, message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                await self._run(session.close)
+                if not reused:
+                    raise
+                # the server closed the idle session in the meantime, nothing has been sent over it
+                session = await self._run(self._connect)
+                try:
+                    await self._run(session.send_message, message)
+                except BaseException:
+                    await self._run(self._disconnect, session)
+                    raise
+            except BaseException:
+                # the session might be in the middle of a transaction, it is not reused
+                await self._run(self._disconnect, session)
+                raise
+            self._release(session)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for session, _ in idle:
+            await self._run(self._disconnect, session)
+        self._executor.shutdown(wait=False)
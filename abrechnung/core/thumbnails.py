@@ -0,0 +1,42 @@
+"""
+Rendering of image thumbnails.
+
+This module is imported by the thumbnail worker processes, it must stay free of any api or database imports.
+"""
+
+import io
+import warnings
+
+from PIL import Image, ImageOps
+
+THUMBNAIL_MIME_TYPE = "image/webp"
+THUMBNAIL_QUALITY = 80
+
+
+class ThumbnailError(Exception):
+    pass
+
+
+def render_thumbnails(content: bytes, sizes: list[int]) -> dict[int, bytes]:
+    """Renders webp thumbnails fitting into a square of each size, keeping the aspect ratio and exif orientation"""
+    try:
+        with warnings.catch_warnings():
+            # refuse decompression bombs instead of only warning about them
+            warnings.simplefilter("error", Image.DecompressionBombWarning)
+            with Image.open(io.BytesIO(content)) as original:
+                # lets jpeg decode at a reduced scale, which is a lot faster for large photos
+                original.draft("RGB", (max(sizes), max(sizes)))
+                image = ImageOps.exif_transpose(original)
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+
+                thumbnails = {}
+                # every thumbnail is downscaled from the next larger one
+                for size in sorted(sizes, reverse=True):
+                    image.thumbnail((size, size))
+                    buffer = io.BytesIO()
+                    image.save(buffer, format="WEBP", quality=THUMBNAIL_QUALITY)
+                    thumbnails[size] = buffer.getvalue()
+                return thumbnails
+    except (OSError, ValueError, Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+        raise ThumbnailError(str(e)) from e
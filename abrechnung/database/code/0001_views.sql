@@ -1,10 +1,45 @@
+-- json values rendered exactly like the pydantic api models serialize them, such that json built by the database can
+-- be passed through as api response. The functions are plain sql without a search path such that they get inlined.
+
+-- floats always have a fractional part or an exponent, i.e. 1.0 instead of 1
+create or replace function float_json(
+    value double precision
+) returns json
+    immutable
+    language sql
+as
+$$
+select
+    case
+        when value in ('NaN', 'Infinity', '-Infinity') then 'null'
+        when value::text ~ '[.e]' then value::text
+        else value::text || '.0'
+    end::json
+$$;
+
+-- timestamps in utc with a Z suffix, fractional seconds are only given if there are any
+create or replace function timestamp_json(
+    value timestamptz
+) returns json
+    stable
+    language sql
+as
+$$
+select
+    to_json(
+        to_char(value at time zone 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS')
+        || case when date_trunc('second', value) = value then '' else to_char(value at time zone 'UTC', '.US') end
+        || 'Z'
+    )
+$$;
+
 create view clearing_account_shares_as_json(revision_id, account_id, n_shares, involved_accounts, shares) as
     SELECT
         cas.revision_id,
         cas.account_id,
         sum(cas.shares)                 AS n_shares,
         array_agg(cas.share_account_id) AS involved_accounts,
-        json_object_agg(cas.share_account_id, cas.shares) AS shares
+        json_object_agg(cas.share_account_id, float_json(cas.shares)) AS shares
     FROM
         clearing_account_share cas
     GROUP BY
@@ -16,7 +51,7 @@ create view creditor_shares_as_json(revision_id, transaction_id, n_shares, invol
         cs.transaction_id,
         sum(cs.shares)           AS n_shares,
         array_agg(cs.account_id) AS involved_accounts,
-        json_object_agg(cs.account_id, cs.shares) AS shares
+        json_object_agg(cs.account_id, float_json(cs.shares)) AS shares
     FROM
         creditor_share cs
     GROUP BY
@@ -28,7 +63,7 @@ create view debitor_shares_as_json(revision_id, transaction_id, n_shares, involv
         ds.transaction_id,
         sum(ds.shares)           AS n_shares,
         array_agg(ds.account_id) AS involved_accounts,
-        json_object_agg(ds.account_id, ds.shares) AS shares
+        json_object_agg(ds.account_id, float_json(ds.shares)) AS shares
     FROM
         debitor_share ds
     GROUP BY
@@ -40,7 +75,7 @@ create view purchase_item_usages_as_json(revision_id, item_id, n_usages, involve
         piu.item_id,
         sum(piu.share_amount)     AS n_usages,
         array_agg(piu.account_id) AS involved_accounts,
-        json_object_agg(piu.account_id, piu.share_amount) AS usages
+        json_object_agg(piu.account_id, float_json(piu.share_amount)) AS usages
     FROM
         purchase_item_usage piu
     GROUP BY
@@ -68,6 +103,8 @@ create or replace view account_tags (account_id, revision_id, tag_names) as
     group by
         att.account_id, att.revision_id;
 
+-- all history views include the group id as leading window partition key such that filters on group_id can be
+-- pushed down into the window computations, see the group_*_state_valid_at functions
 create or replace view aggregated_account_history as
     (
     select
@@ -109,13 +146,14 @@ create or replace view aggregated_account_history as
                 left join account_history ah on ah.id = a.id and ar.id = ah.revision_id
                 left join clearing_account_shares_as_json cas on a.id = cas.account_id and ar.id = cas.revision_id
                 left join account_tags t on a.id = t.account_id and ar.id = t.revision_id
-            window wnd as (partition by a.id order by created_at asc)
-        ) as sub window outer_window as (partition by sub.account_id, sub.id_partition order by sub.revision_id) );
+            window wnd as (partition by a.group_id, a.id order by created_at asc)
+        ) as sub window outer_window as (partition by sub.group_id, sub.account_id, sub.id_partition order by sub.revision_id) );
 
 create or replace view aggregated_transaction_position_history as
     SELECT
         sub.revision_id,
         sub.transaction_id,
+        sub.group_id,
         sub.item_id,
         sub.user_id,
         sub.created_at,
@@ -133,6 +171,7 @@ create or replace view aggregated_transaction_position_history as
                 tr.transaction_id,
                 tr.user_id,
                 tr.created_at,
+                t.group_id,
                 pi.id                                                AS item_id,
                 count(pi.id) OVER wnd                                AS id_partition,
                 pih.name,
@@ -144,11 +183,12 @@ create or replace view aggregated_transaction_position_history as
                 COALESCE(piu.involved_accounts, ARRAY []::integer[]) AS involved_accounts
             FROM
                 transaction_revision tr
+                JOIN transaction t ON tr.transaction_id = t.id
                 JOIN purchase_item pi ON tr.transaction_id = pi.transaction_id
                 LEFT JOIN purchase_item_history pih ON pih.id = pi.id AND tr.id = pih.revision_id
                 LEFT JOIN purchase_item_usages_as_json piu ON pi.id = piu.item_id AND tr.id = piu.revision_id
-            WINDOW wnd AS (PARTITION BY pi.id ORDER BY tr.created_at)
-        ) sub WINDOW outer_window AS (PARTITION BY sub.item_id, sub.id_partition ORDER BY sub.revision_id);
+            WINDOW wnd AS (PARTITION BY t.group_id, pi.id ORDER BY tr.created_at)
+        ) sub WINDOW outer_window AS (PARTITION BY sub.group_id, sub.item_id, sub.id_partition ORDER BY sub.revision_id);
 
 create or replace view aggregated_transaction_history as
     SELECT
@@ -203,13 +243,14 @@ create or replace view aggregated_transaction_history as
                 LEFT JOIN creditor_shares_as_json csaj ON t.id = csaj.transaction_id AND tr.id = csaj.revision_id
                 LEFT JOIN debitor_shares_as_json dsaj ON t.id = dsaj.transaction_id AND tr.id = dsaj.revision_id
                 left join transaction_tags tt on tt.transaction_id = t.id and tt.revision_id = tr.id
-            WINDOW wnd AS (PARTITION BY tr.transaction_id ORDER BY tr.created_at)
-        ) sub WINDOW outer_window AS (PARTITION BY sub.transaction_id, sub.id_partition ORDER BY sub.revision_id);
+            WINDOW wnd AS (PARTITION BY t.group_id, tr.transaction_id ORDER BY tr.created_at)
+        ) sub WINDOW outer_window AS (PARTITION BY sub.group_id, sub.transaction_id, sub.id_partition ORDER BY sub.revision_id);
 
 create or replace view aggregated_file_history as
     SELECT
         sub.revision_id,
         sub.transaction_id,
+        sub.group_id,
         sub.id,
         sub.user_id,
         sub.created_at,
@@ -224,6 +265,7 @@ create or replace view aggregated_file_history as
                 tr.transaction_id,
                 tr.user_id,
                 tr.created_at,
+                t.group_id,
                 f.id,
                 count(f.id) OVER wnd AS id_partition,
                 fh.filename,
@@ -232,8 +274,9 @@ create or replace view aggregated_file_history as
                 fh.deleted
             FROM
                 transaction_revision tr
+                JOIN transaction t ON tr.transaction_id = t.id
                 JOIN file f ON tr.transaction_id = f.transaction_id
                 LEFT JOIN file_history fh ON fh.id = f.id AND tr.id = fh.revision_id
                 LEFT JOIN blob ON blob.id = fh.blob_id
-            WINDOW wnd AS (PARTITION BY f.id ORDER BY tr.created_at)
-        ) sub WINDOW outer_window AS (PARTITION BY sub.id, sub.id_partition ORDER BY sub.revision_id);
+            WINDOW wnd AS (PARTITION BY t.group_id, f.id ORDER BY tr.created_at)
+        ) sub WINDOW outer_window AS (PARTITION BY sub.group_id, sub.id, sub.id_partition ORDER BY sub.revision_id);
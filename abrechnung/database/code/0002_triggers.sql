@@ -1,5 +1,6 @@
 
--- notify the mailer service on inserts or updates in the above tables
+-- notify the mailer service on inserts or updates in the above tables which make a mail due, claims and retries by
+-- the mailer itself postpone mail_next_attempt and do not wake it up
 create or replace function pending_registration_updated() returns trigger as
 $$
 begin
@@ -11,9 +12,10 @@ $$ language plpgsql
 set search_path = "$user", public;
 
 create trigger pending_registration_trig
-    after insert or update
+    after insert or update of mail_next_attempt
     on pending_registration
     for each row
+    when (new.mail_next_attempt <= now())
 execute function pending_registration_updated();
 
 create or replace function pending_password_recovery_updated() returns trigger as
@@ -27,9 +29,10 @@ $$ language plpgsql
 set search_path = "$user", public;
 
 create trigger pending_password_recovery_trig
-    after insert or update
+    after insert or update of mail_next_attempt
     on pending_password_recovery
     for each row
+    when (new.mail_next_attempt <= now())
 execute function pending_password_recovery_updated();
 
 create or replace function pending_email_change_updated() returns trigger as
@@ -43,7 +46,148 @@ $$ language plpgsql
 set search_path = "$user", public;
 
 create trigger pending_email_change_trig
-    after insert or update
+    after insert or update of mail_next_attempt
     on pending_email_change
     for each row
+    when (new.mail_next_attempt <= now())
 execute function pending_email_change_updated();
+
+-- notify api workers, which cache authenticated users, whenever a user or one of its sessions changes
+create or replace function usr_changed() returns trigger as
+$$
+begin
+    perform pg_notify('user_changed', old.id::text);
+
+    return null;
+end;
+$$ language plpgsql
+set search_path = "$user", public;
+
+create trigger usr_changed_trig
+    after update or delete
+    on usr
+    for each row
+execute function usr_changed();
+
+create or replace function session_changed() returns trigger as
+$$
+begin
+    if tg_op = 'INSERT' then
+        perform pg_notify('user_changed', new.user_id::text);
+    else
+        perform pg_notify('user_changed', old.user_id::text);
+    end if;
+
+    return null;
+end;
+$$ language plpgsql
+set search_path = "$user", public;
+
+create trigger session_changed_trig
+    after insert or update or delete
+    on session
+    for each row
+execute function session_changed();
+
+-- notify api workers about changes of a group, which they push to subscribed clients
+-- all changes to the contents of a group bump grp.last_changed, membership changes are notified on their own
+create or replace function group_changed() returns trigger as
+$$
+begin
+    if tg_table_name = 'grp' then
+        perform pg_notify('group_changed', coalesce(new.id, old.id)::text);
+    elsif tg_op = 'DELETE' then
+        perform pg_notify('group_changed', old.group_id::text);
+    else
+        perform pg_notify('group_changed', new.group_id::text);
+    end if;
+
+    return null;
+end;
+$$ language plpgsql
+set search_path = "$user", public;
+
+create trigger grp_changed_trig
+    after update of last_changed or delete
+    on grp
+    for each row
+execute function group_changed();
+
+create trigger group_membership_changed_trig
+    after insert or update or delete
+    on group_membership
+    for each row
+execute function group_changed();
+
+-- keep the number of file revisions, uploads and thumbnails referencing a blob up to date, blobs are deleted once they
+-- are no longer referenced
+create or replace function blob_ref_count() returns trigger as
+$$
+begin
+    if tg_op in ('INSERT', 'UPDATE') and new.blob_id is not null then
+        update blob set ref_count = ref_count + 1 where id = new.blob_id;
+    end if;
+
+    if tg_op in ('UPDATE', 'DELETE') and old.blob_id is not null then
+        update blob set ref_count = ref_count - 1 where id = old.blob_id;
+        delete from blob where id = old.blob_id and ref_count <= 0;
+    end if;
+
+    return null;
+end;
+$$ language plpgsql
+set search_path = "$user", public;
+
+create trigger file_history_blob_ref_count_trig
+    after insert or update of blob_id or delete
+    on file_history
+    for each row
+execute function blob_ref_count();
+
+create trigger blob_upload_blob_ref_count_trig
+    after insert or update of blob_id or delete
+    on blob_upload
+    for each row
+execute function blob_ref_count();
+
+create trigger blob_thumbnail_blob_ref_count_trig
+    after insert or update of blob_id or delete
+    on blob_thumbnail
+    for each row
+execute function blob_ref_count();
+
+-- objects in the blob storage cannot be deleted from within the database, they are queued for deletion instead
+create or replace function blob_deleted() returns trigger as
+$$
+begin
+    if old.storage_key is not null then
+        insert into orphaned_blob (storage_key) values (old.storage_key);
+    end if;
+
+    return null;
+end;
+$$ language plpgsql
+set search_path = "$user", public;
+
+create trigger blob_deleted_trig
+    after delete
+    on blob
+    for each row
+execute function blob_deleted();
+
+-- notify api workers about new blobs such that they generate their thumbnails once the upload has been committed
+create or replace function blob_created() returns trigger as
+$$
+begin
+    perform pg_notify('blob_created', new.id::text);
+
+    return null;
+end;
+$$ language plpgsql
+set search_path = "$user", public;
+
+create trigger blob_created_trig
+    after insert
+    on blob
+    for each row
+execute function blob_created();
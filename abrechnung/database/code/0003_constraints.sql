@@ -130,7 +130,8 @@ begin
         transaction_history th
         join transaction t on t.id = th.id
     where
-        th.revision_id = check_committed_transactions.revision_id;
+        th.id = check_committed_transactions.transaction_id
+        and th.revision_id = check_committed_transactions.revision_id;
 
     if locals.transaction_deleted then -- if the transaction is deleted we simply accept anything as we dont care
         return true;
@@ -45,6 +45,55 @@ $$ language sql
     stable
     set search_path = "$user", public;
 
+create or replace function group_account_state_valid_at(
+    grp_id integer,
+    valid_at timestamptz = now()
+)
+    returns table (
+        account_id         int,
+        revision_id        bigint,
+        type               text,
+        changed_by         int,
+        group_id           int,
+        created_at         timestamptz,
+        name               text,
+        description        text,
+        date_info          date,
+        deleted            bool,
+        n_clearing_shares  int,
+        clearing_shares    json,
+        involved_accounts  int[],
+        tags               varchar(255)[]
+    )
+as
+$$
+select distinct on (acah.account_id)
+    acah.account_id,
+    acah.revision_id,
+    acah.type,
+    acah.user_id,
+    acah.group_id,
+    acah.created_at,
+    acah.name,
+    acah.description,
+    acah.date_info,
+    acah.deleted,
+    acah.n_clearing_shares,
+    acah.clearing_shares,
+    acah.involved_accounts,
+    acah.tags
+from
+    aggregated_account_history acah
+where
+    acah.group_id = group_account_state_valid_at.grp_id
+    and acah.created_at <= group_account_state_valid_at.valid_at
+order by
+    acah.account_id, acah.created_at desc
+$$ language sql
+    security invoker
+    stable
+    set search_path = "$user", public;
+
 create or replace function full_account_state_valid_at(
     valid_at timestamp with time zone default now()
 )
@@ -87,6 +136,53 @@ from
 $$
 set search_path = "$user", public;
 
+create or replace function group_full_account_state_valid_at(
+    grp_id integer,
+    valid_at timestamp with time zone default now()
+)
+    returns table (
+        id                integer,
+        type              text,
+        group_id          integer,
+        last_changed      timestamptz,
+        changed_by        int,
+        name              text,
+        description       text,
+        date_info         date,
+        deleted           bool,
+        n_clearing_shares int,
+        clearing_shares   json,
+        involved_accounts int[],
+        tags              varchar(255)[]
+    )
+    stable
+    language sql
+as
+$$
+select
+    a.id,
+    a.type,
+    a.group_id,
+    details.created_at as last_changed,
+    details.changed_by,
+    details.name,
+    details.description,
+    details.date_info,
+    details.deleted,
+    details.n_clearing_shares,
+    details.clearing_shares,
+    details.involved_accounts,
+    details.tags
+from
+    account a
+    join group_account_state_valid_at(
+        group_full_account_state_valid_at.grp_id, group_full_account_state_valid_at.valid_at
+    ) details on a.id = details.account_id
+where
+    a.group_id = group_full_account_state_valid_at.grp_id
+$$
+set search_path = "$user", public;
+
 create or replace function file_state_valid_at(
     valid_at timestamp with time zone default now()
 )
@@ -125,6 +221,46 @@ order by
     id, created_at desc
 $$;
 
+create or replace function group_file_state_valid_at(
+    grp_id integer,
+    valid_at timestamp with time zone default now()
+)
+    returns table (
+        id                  integer,
+        revision_id         bigint,
+        transaction_id      integer,
+        changed_by          integer,
+        created_at          timestamptz,
+        filename            text,
+        mime_type           text,
+        blob_id             integer,
+        deleted             boolean
+    )
+    stable
+    language sql
+    set search_path = "$user", public
+as
+$$
+select distinct on (afh.id)
+    afh.id,
+    afh.revision_id,
+    afh.transaction_id,
+    afh.user_id as changed_by,
+    afh.created_at,
+    afh.filename,
+    afh.mime_type,
+    afh.blob_id,
+    afh.deleted
+from
+    aggregated_file_history afh
+where
+    afh.group_id = group_file_state_valid_at.grp_id
+    and afh.created_at <= group_file_state_valid_at.valid_at
+    and afh.filename is not null
+order by
+    afh.id, afh.created_at desc
+$$;
+
 create or replace function transaction_position_state_valid_at(
     valid_at timestamp with time zone default now()
 )
@@ -169,6 +305,52 @@ order by
     acph.item_id, acph.created_at desc
 $$;
 
+create or replace function group_transaction_position_state_valid_at(
+    grp_id integer,
+    valid_at timestamp with time zone default now()
+)
+    returns table (
+        id                      integer,
+        revision_id             bigint,
+        transaction_id          integer,
+        changed_by              integer,
+        created_at              timestamptz,
+        name                    text,
+        price                   double precision,
+        communist_shares        double precision,
+        deleted                 boolean,
+        n_usages                integer,
+        usages                  json,
+        involved_accounts       integer[]
+    )
+    stable
+    language sql
+    set search_path = "$user", public
+as
+$$
+select distinct on (acph.item_id)
+    acph.item_id as id,
+    acph.revision_id,
+    acph.transaction_id,
+    acph.user_id as changed_by,
+    acph.created_at,
+    acph.name,
+    acph.price,
+    acph.communist_shares,
+    acph.deleted,
+    acph.n_usages,
+    acph.usages,
+    acph.involved_accounts
+from
+    aggregated_transaction_position_history acph
+where
+    acph.group_id = group_transaction_position_state_valid_at.grp_id
+    and acph.created_at <= group_transaction_position_state_valid_at.valid_at
+    and acph.name is not null
+order by
+    acph.item_id, acph.created_at desc
+$$;
+
 create or replace function transaction_state_valid_at(
     valid_at timestamp with time zone default now()
 )
@@ -228,6 +410,67 @@ order by
     acth.transaction_id, acth.created_at desc
 $$;
 
+create or replace function group_transaction_state_valid_at(
+    grp_id integer,
+    valid_at timestamp with time zone default now()
+)
+    returns table (
+        revision_id              bigint,
+        transaction_id           integer,
+        changed_by               integer,
+        created_at               timestamptz,
+        group_id                 integer,
+        type                     text,
+        value                    double precision,
+        currency_identifier      text,
+        currency_conversion_rate double precision,
+        split_mode               text,
+        name                     text,
+        description              text,
+        billed_at                date,
+        deleted                  boolean,
+        n_creditor_shares        integer,
+        creditor_shares          json,
+        n_debitor_shares         integer,
+        debitor_shares           json,
+        involved_accounts        integer[],
+        tags                     varchar(255)[]
+    )
+    stable
+    language sql
+    set search_path = "$user", public
+as
+$$
+select distinct on (acth.transaction_id)
+    acth.revision_id,
+    acth.transaction_id,
+    acth.user_id as changed_by,
+    acth.created_at,
+    acth.group_id,
+    acth.type,
+    acth.value,
+    acth.currency_identifier,
+    acth.currency_conversion_rate,
+    acth.split_mode,
+    acth.name,
+    acth.description,
+    acth.billed_at,
+    acth.deleted,
+    acth.n_creditor_shares,
+    acth.creditor_shares,
+    acth.n_debitor_shares,
+    acth.debitor_shares,
+    acth.involved_accounts,
+    acth.tags
+from
+    aggregated_transaction_history acth
+where
+    acth.group_id = group_transaction_state_valid_at.grp_id
+    and acth.created_at <= group_transaction_state_valid_at.valid_at
+order by
+    acth.transaction_id, acth.created_at desc
+$$;
+
 create or replace function full_transaction_state_valid_at(
     valid_at timestamp with time zone default now()
 )
@@ -306,3 +549,316 @@ from
         group by cfsva.transaction_id
     ) aggregated_files on t.id = aggregated_files.transaction_id
 $$;
+
+-- recompute the rows of the given transactions in current_transaction_state from their committed revisions
+create or replace function refresh_current_transaction_states(
+    transaction_ids integer[]
+) returns void
+    language plpgsql
+    set search_path = "$user", public
+as
+$$
+<<locals>> declare
+    item_ids int[];
+    file_ids int[];
+begin
+    -- positions and files are stored in the shape of the api response (without the file host url)
+    -- such that transaction_json can pass them through as is
+    --
+    -- resolve the item and file ids first, filtering the history views on their partitioning keys lets the planner
+    -- restrict the window computations to the rows of the given transactions
+    select array_agg(pi.id)
+    into locals.item_ids
+    from purchase_item pi
+    where pi.transaction_id = any(refresh_current_transaction_states.transaction_ids);
+
+    select array_agg(f.id)
+    into locals.file_ids
+    from file f
+    where f.transaction_id = any(refresh_current_transaction_states.transaction_ids);
+
+    insert into current_transaction_state (
+        id, type, group_id, last_changed, value, currency_identifier, currency_conversion_rate, split_mode, name,
+        description, billed_at, deleted, n_creditor_shares, creditor_shares, n_debitor_shares, debitor_shares,
+        involved_accounts, tags, positions, files
+    )
+    select
+        t.id,
+        t.type,
+        t.group_id,
+        greatest(
+            details.created_at,
+            aggregated_positions.created_at,
+            aggregated_files.created_at
+        ),
+        details.value,
+        details.currency_identifier,
+        details.currency_conversion_rate,
+        details.split_mode,
+        details.name,
+        details.description,
+        details.billed_at,
+        details.deleted,
+        details.n_creditor_shares,
+        details.creditor_shares,
+        details.n_debitor_shares,
+        details.debitor_shares,
+        details.involved_accounts,
+        details.tags,
+        coalesce(aggregated_positions.json_state, '[]'::json),
+        coalesce(aggregated_files.json_state, '[]'::json)
+    from
+        transaction t
+        join (
+            select distinct on (acth.transaction_id) *
+            from aggregated_transaction_history acth
+            where
+                acth.transaction_id = any(refresh_current_transaction_states.transaction_ids)
+                and acth.created_at <= now()
+            order by acth.transaction_id, acth.created_at desc
+        ) details on t.id = details.transaction_id
+        left join (
+            select
+                positions.transaction_id,
+                json_agg(
+                    json_build_object(
+                        'id', positions.id,
+                        'name', positions.name,
+                        'price', float_json(positions.price),
+                        'communist_shares', float_json(positions.communist_shares),
+                        'usages', positions.usages,
+                        'deleted', positions.deleted
+                    ) order by positions.id
+                )                         as json_state,
+                max(positions.created_at) as created_at
+            from (
+                select distinct on (acph.item_id)
+                    acph.item_id as id,
+                    acph.transaction_id,
+                    acph.created_at,
+                    acph.name,
+                    acph.price,
+                    acph.communist_shares,
+                    acph.deleted,
+                    acph.usages
+                from
+                    aggregated_transaction_position_history acph
+                where
+                    acph.item_id = any(locals.item_ids)
+                    and acph.created_at <= now()
+                    and acph.name is not null
+                order by
+                    acph.item_id, acph.created_at desc
+            ) positions
+            group by positions.transaction_id
+        ) aggregated_positions on t.id = aggregated_positions.transaction_id
+        left join (
+            select
+                files.transaction_id,
+                json_agg(
+                    json_build_object(
+                        'id', files.id,
+                        'filename', files.filename,
+                        'blob_id', files.blob_id,
+                        'mime_type', files.mime_type,
+                        'deleted', files.deleted
+                    ) order by files.id
+                )                     as json_state,
+                max(files.created_at) as created_at
+            from (
+                select distinct on (afh.id)
+                    afh.id,
+                    afh.transaction_id,
+                    afh.created_at,
+                    afh.filename,
+                    afh.mime_type,
+                    afh.blob_id,
+                    afh.deleted
+                from
+                    aggregated_file_history afh
+                where
+                    afh.id = any(locals.file_ids)
+                    and afh.created_at <= now()
+                    and afh.filename is not null
+                order by
+                    afh.id, afh.created_at desc
+            ) files
+            group by files.transaction_id
+        ) aggregated_files on t.id = aggregated_files.transaction_id
+    where t.id = any(refresh_current_transaction_states.transaction_ids)
+    on conflict (id) do update set
+        type                     = excluded.type,
+        group_id                 = excluded.group_id,
+        last_changed             = excluded.last_changed,
+        value                    = excluded.value,
+        currency_identifier      = excluded.currency_identifier,
+        currency_conversion_rate = excluded.currency_conversion_rate,
+        split_mode               = excluded.split_mode,
+        name                     = excluded.name,
+        description              = excluded.description,
+        billed_at                = excluded.billed_at,
+        deleted                  = excluded.deleted,
+        n_creditor_shares        = excluded.n_creditor_shares,
+        creditor_shares          = excluded.creditor_shares,
+        n_debitor_shares         = excluded.n_debitor_shares,
+        debitor_shares           = excluded.debitor_shares,
+        involved_accounts        = excluded.involved_accounts,
+        tags                     = excluded.tags,
+        positions                = excluded.positions,
+        files                    = excluded.files;
+
+    -- flat arrays of the non-deleted positions and their usages for computing balances without parsing the json,
+    -- usage_positions are 1-based indices into the position arrays
+    with positions as (
+        select
+            cts.id                                          as transaction_id,
+            row_number() over (partition by cts.id order by p.ord) as idx,
+            p.value                                         as position
+        from
+            current_transaction_state cts
+            cross join json_array_elements(cts.positions) with ordinality p(value, ord)
+        where
+            cts.id = any(refresh_current_transaction_states.transaction_ids)
+            and not (p.value ->> 'deleted')::boolean
+    ),
+    usages as (
+        select
+            p.transaction_id,
+            p.idx::integer            as idx,
+            u.key::integer            as account_id,
+            u.value::double precision as shares
+        from
+            positions p
+            cross join json_each_text(p.position -> 'usages') u
+    ),
+    position_arrays as (
+        select
+            p.transaction_id,
+            array_agg((p.position ->> 'price')::double precision order by p.idx)            as prices,
+            array_agg((p.position ->> 'communist_shares')::double precision order by p.idx) as communist_shares
+        from positions p
+        group by p.transaction_id
+    ),
+    usage_arrays as (
+        select
+            u.transaction_id,
+            array_agg(u.idx order by u.idx, u.account_id)        as positions,
+            array_agg(u.account_id order by u.idx, u.account_id) as account_ids,
+            array_agg(u.shares order by u.idx, u.account_id)     as shares
+        from usages u
+        group by u.transaction_id
+    )
+    update current_transaction_state cts
+    set
+        position_prices           = coalesce(pa.prices, '{}'),
+        position_communist_shares = coalesce(pa.communist_shares, '{}'),
+        usage_positions           = coalesce(ua.positions, '{}'),
+        usage_account_ids         = coalesce(ua.account_ids, '{}'),
+        usage_shares              = coalesce(ua.shares, '{}')
+    from
+        (select distinct unnest(refresh_current_transaction_states.transaction_ids) as id) ids
+        left join position_arrays pa on pa.transaction_id = ids.id
+        left join usage_arrays ua on ua.transaction_id = ids.id
+    where cts.id = ids.id;
+end
+$$;
+
+-- recompute the row of a single transaction in current_transaction_state from its committed revisions
+create or replace function refresh_current_transaction_state(
+    transaction_id integer
+) returns void
+    language sql
+    set search_path = "$user", public
+as
+$$
+select refresh_current_transaction_states(array [refresh_current_transaction_state.transaction_id]);
+$$;
+
+-- json representation of a transaction as returned by the api, see abrechnung.domain.transactions.Transaction
+-- this allows list endpoints to pass the json built by the database through without deserializing it
+create or replace function transaction_json(
+    t current_transaction_state,
+    file_host_url text
+) returns json
+    stable
+    language sql
+    set search_path = "$user", public
+as
+$$
+select
+    json_build_object(
+        'id', t.id,
+        'group_id', t.group_id,
+        'type', t.type,
+        'name', t.name,
+        'description', t.description,
+        'value', float_json(t.value),
+        'currency_identifier', t.currency_identifier,
+        'currency_conversion_rate', float_json(t.currency_conversion_rate),
+        'billed_at', t.billed_at,
+        'tags', t.tags,
+        'deleted', t.deleted,
+        'creditor_shares', t.creditor_shares,
+        'debitor_shares', t.debitor_shares,
+        'split_mode', t.split_mode,
+        'last_changed', timestamp_json(t.last_changed),
+        'positions', t.positions,
+        'files', case
+            when json_array_length(t.files) = 0 then t.files
+            else (
+                select json_agg(json_build_object(
+                    'id', f -> 'id',
+                    'filename', f -> 'filename',
+                    'blob_id', f -> 'blob_id',
+                    'mime_type', f -> 'mime_type',
+                    'host_url', transaction_json.file_host_url,
+                    'deleted', f -> 'deleted'
+                ))
+                from json_array_elements(t.files) f
+            )
+        end
+    )
+$$;
+
+-- json representation of the current state of all accounts in a group as returned by the api,
+-- see abrechnung.domain.accounts.Account
+create or replace function group_account_json(
+    grp_id integer
+)
+    returns table (
+        id   integer,
+        data json
+    )
+    stable
+    language sql
+    set search_path = "$user", public
+as
+$$
+select
+    a.id,
+    case
+        when a.type = 'clearing' then json_build_object(
+            'id', a.id,
+            'group_id', a.group_id,
+            'type', a.type,
+            'name', a.name,
+            'description', a.description,
+            'date_info', a.date_info,
+            'tags', a.tags,
+            'clearing_shares', a.clearing_shares,
+            'last_changed', timestamp_json(a.last_changed),
+            'deleted', a.deleted
+        )
+        else json_build_object(
+            'id', a.id,
+            'group_id', a.group_id,
+            'type', a.type,
+            'name', a.name,
+            'description', a.description,
+            'deleted', a.deleted,
+            'last_changed', timestamp_json(a.last_changed)
+        )
+    end
+from
+    group_full_account_state_valid_at(group_account_json.grp_id) a
+$$;
@@ -0,0 +1,145 @@
+-- migration: d1d0a2c7
+-- requires: b59de5c4
+
+-- incrementally maintained copy of full_transaction_state_valid_at(now()), one row per transaction
+-- which has at least one committed revision. Rows are refreshed whenever a transaction revision is committed.
+create table current_transaction_state (
+    id                       integer primary key references transaction (id) on delete cascade,
+    type                     text             not null,
+    group_id                 integer          not null references grp (id) on delete cascade,
+    last_changed             timestamptz      not null,
+    value                    double precision not null,
+    currency_identifier      text             not null,
+    currency_conversion_rate double precision not null,
+    split_mode               text             not null,
+    name                     text             not null,
+    description              text             not null,
+    billed_at                date             not null,
+    deleted                  boolean          not null,
+    n_creditor_shares        integer          not null,
+    creditor_shares          json             not null,
+    n_debitor_shares         integer          not null,
+    debitor_shares           json             not null,
+    involved_accounts        integer[]        not null,
+    tags                     varchar(255)[]   not null,
+    positions                json             not null,
+    files                    json             not null
+);
+
+create index current_transaction_state_group_id_last_changed_idx on current_transaction_state (group_id, last_changed);
+
+-- initial population, mirrors the semantics of the *_state_valid_at functions at the time of this migration
+with committed_revision as (
+    select tr.id, tr.transaction_id, tr.user_id, tr.created_at
+    from transaction_revision tr
+    where tr.created_at is not null
+),
+latest_revision as (
+    select distinct on (cr.transaction_id) cr.transaction_id, cr.created_at
+    from committed_revision cr
+    order by cr.transaction_id, cr.created_at desc
+),
+latest_data_revision as (
+    select distinct on (cr.transaction_id) cr.transaction_id, cr.id as revision_id
+    from
+        committed_revision cr
+        join transaction_history th on th.id = cr.transaction_id and th.revision_id = cr.id
+    order by cr.transaction_id, cr.created_at desc
+),
+shares as (
+    select
+        ldr.transaction_id,
+        coalesce((select sum(cs.shares) from creditor_share cs
+                  where cs.transaction_id = ldr.transaction_id and cs.revision_id = ldr.revision_id), 0) as n_creditor_shares,
+        coalesce((select json_object_agg(cs.account_id, cs.shares) from creditor_share cs
+                  where cs.transaction_id = ldr.transaction_id and cs.revision_id = ldr.revision_id), json_build_object()) as creditor_shares,
+        coalesce((select array_agg(cs.account_id) from creditor_share cs
+                  where cs.transaction_id = ldr.transaction_id and cs.revision_id = ldr.revision_id), array []::int[]) as creditor_accounts,
+        coalesce((select sum(ds.shares) from debitor_share ds
+                  where ds.transaction_id = ldr.transaction_id and ds.revision_id = ldr.revision_id), 0) as n_debitor_shares,
+        coalesce((select json_object_agg(ds.account_id, ds.shares) from debitor_share ds
+                  where ds.transaction_id = ldr.transaction_id and ds.revision_id = ldr.revision_id), json_build_object()) as debitor_shares,
+        coalesce((select array_agg(ds.account_id) from debitor_share ds
+                  where ds.transaction_id = ldr.transaction_id and ds.revision_id = ldr.revision_id), array []::int[]) as debitor_accounts,
+        coalesce((select array_agg(tag.name) from transaction_to_tag ttt join tag on ttt.tag_id = tag.id
+                  where ttt.transaction_id = ldr.transaction_id and ttt.revision_id = ldr.revision_id), array []::varchar(255)[]) as tags
+    from latest_data_revision ldr
+),
+latest_positions as (
+    select distinct on (pih.id)
+        pih.id,
+        cr.id                                                 as revision_id,
+        cr.transaction_id,
+        cr.user_id                                            as changed_by,
+        cr.created_at,
+        pih.name,
+        pih.price,
+        pih.communist_shares,
+        pih.deleted,
+        coalesce(piu.n_usages, 0)::integer                    as n_usages,
+        coalesce(piu.usages, json_build_object())             as usages,
+        coalesce(piu.involved_accounts, array []::integer[])  as involved_accounts
+    from
+        purchase_item_history pih
+        join committed_revision cr on cr.id = pih.revision_id
+        left join (
+            select
+                u.revision_id,
+                u.item_id,
+                sum(u.share_amount)                         as n_usages,
+                array_agg(u.account_id)                     as involved_accounts,
+                json_object_agg(u.account_id, u.share_amount) as usages
+            from purchase_item_usage u
+            group by u.revision_id, u.item_id
+        ) piu on piu.item_id = pih.id and piu.revision_id = pih.revision_id
+    order by pih.id, cr.created_at desc
+),
+latest_files as (
+    select distinct on (fh.id)
+        fh.id,
+        cr.id         as revision_id,
+        cr.transaction_id,
+        cr.user_id    as changed_by,
+        cr.created_at,
+        fh.filename,
+        blob.mime_type,
+        fh.blob_id,
+        fh.deleted
+    from
+        file_history fh
+        join committed_revision cr on cr.id = fh.revision_id
+        left join blob on blob.id = fh.blob_id
+    order by fh.id, cr.created_at desc
+)
+insert into current_transaction_state (
+    id, type, group_id, last_changed, value, currency_identifier, currency_conversion_rate, split_mode, name,
+    description, billed_at, deleted, n_creditor_shares, creditor_shares, n_debitor_shares, debitor_shares,
+    involved_accounts, tags, positions, files
+)
+select
+    t.id,
+    t.type,
+    t.group_id,
+    lr.created_at,
+    th.value,
+    th.currency_identifier,
+    th.currency_conversion_rate,
+    th.split_mode,
+    th.name,
+    th.description,
+    th.billed_at,
+    th.deleted,
+    s.n_creditor_shares,
+    s.creditor_shares,
+    s.n_debitor_shares,
+    s.debitor_shares,
+    s.creditor_accounts || s.debitor_accounts,
+    s.tags,
+    coalesce((select json_agg(p) from latest_positions p where p.transaction_id = t.id), '[]'::json),
+    coalesce((select json_agg(f) from latest_files f where f.transaction_id = t.id), '[]'::json)
+from
+    transaction t
+    join latest_revision lr on lr.transaction_id = t.id
+    join latest_data_revision ldr on ldr.transaction_id = t.id
+    join transaction_history th on th.id = t.id and th.revision_id = ldr.revision_id
+    join shares s on s.transaction_id = t.id;
@@ -0,0 +1,12 @@
+-- migration: ffef5c5b
+-- requires: d1d0a2c7
+
+-- support group scoped lookups of the current account / transaction state, see the group_*_state_valid_at functions
+create index account_group_id_id_idx on account (group_id, id);
+create index account_revision_account_id_created_at_idx on account_revision (account_id, created_at);
+
+create index transaction_group_id_id_idx on transaction (group_id, id);
+create index transaction_revision_transaction_id_created_at_idx on transaction_revision (transaction_id, created_at);
+
+create index purchase_item_transaction_id_idx on purchase_item (transaction_id);
+create index file_transaction_id_idx on file (transaction_id);
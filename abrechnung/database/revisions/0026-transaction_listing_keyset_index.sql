@@ -0,0 +1,6 @@
+-- migration: 3a9e61f0
+-- requires: ffef5c5b
+
+-- transactions are listed ordered by (last_changed, id) to support keyset pagination
+drop index current_transaction_state_group_id_last_changed_idx;
+create index current_transaction_state_group_id_last_changed_id_idx on current_transaction_state (group_id, last_changed, id);
@@ -0,0 +1,39 @@
+-- migration: 5c0d7be2
+-- requires: 3a9e61f0
+
+-- store positions and files of current_transaction_state in the shape of the api response
+update current_transaction_state
+set
+    positions = (
+        select
+            coalesce(
+                json_agg(
+                    json_build_object(
+                        'id', p -> 'id',
+                        'name', p -> 'name',
+                        'price', p -> 'price',
+                        'communist_shares', p -> 'communist_shares',
+                        'usages', p -> 'usages',
+                        'deleted', p -> 'deleted'
+                    )
+                ),
+                '[]'::json
+            )
+        from json_array_elements(positions) p
+    ),
+    files = (
+        select
+            coalesce(
+                json_agg(
+                    json_build_object(
+                        'id', f -> 'id',
+                        'filename', f -> 'filename',
+                        'blob_id', f -> 'blob_id',
+                        'mime_type', f -> 'mime_type',
+                        'deleted', f -> 'deleted'
+                    )
+                ),
+                '[]'::json
+            )
+        from json_array_elements(files) f
+    );
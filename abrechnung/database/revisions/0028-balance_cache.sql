@@ -0,0 +1,34 @@
+-- migration: 8e41b7d3
+-- requires: 5c0d7be2
+
+-- groups whose account balances are cached in account_balance and account_clearing_resolution.
+-- Groups without an entry have not been computed yet or were invalidated and are recomputed on the next read.
+create table balance_cache (
+    group_id integer primary key references grp (id) on delete cascade
+);
+
+-- cached balance of an account, transaction commits apply their changes to these rows incrementally
+create table account_balance (
+    account_id               integer primary key references account (id) on delete cascade,
+    group_id                 integer          not null references balance_cache (group_id) on delete cascade,
+    balance                  double precision not null,
+    before_clearing          double precision not null,
+    -- purchase and transfer totals of the transactions of this account, excluding clearing account redistributions
+    total_consumed_purchases double precision not null,
+    total_paid_purchases     double precision not null,
+    total_received_transfers double precision not null,
+    total_paid_transfers     double precision not null
+);
+
+create index account_balance_group_id_idx on account_balance (group_id);
+
+-- amount a clearing account has redistributed onto one of the accounts it clears to
+create table account_clearing_resolution (
+    clearing_account_id integer          not null references account (id) on delete cascade,
+    account_id          integer          not null references account (id) on delete cascade,
+    group_id            integer          not null references balance_cache (group_id) on delete cascade,
+    amount              double precision not null,
+    primary key (clearing_account_id, account_id)
+);
+
+create index account_clearing_resolution_group_id_idx on account_clearing_resolution (group_id);
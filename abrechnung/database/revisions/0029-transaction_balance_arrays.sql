@@ -0,0 +1,53 @@
+-- migration: b41f9a2c
+-- requires: 8e41b7d3
+
+-- flat arrays of the non-deleted positions of a transaction and their usages, in the order of the positions json.
+-- They allow computing the balances of a whole group without deserializing the positions json of every transaction.
+-- usage_positions are 1-based indices into position_prices and position_communist_shares.
+alter table current_transaction_state add column position_prices double precision[] not null default '{}';
+alter table current_transaction_state add column position_communist_shares double precision[] not null default '{}';
+alter table current_transaction_state add column usage_positions integer[] not null default '{}';
+alter table current_transaction_state add column usage_account_ids integer[] not null default '{}';
+alter table current_transaction_state add column usage_shares double precision[] not null default '{}';
+
+with positions as (
+    select
+        cts.id                                                 as transaction_id,
+        row_number() over (partition by cts.id order by p.ord) as idx,
+        p.value                                                as position
+    from
+        current_transaction_state cts
+        cross join json_array_elements(cts.positions) with ordinality p(value, ord)
+    where not (p.value ->> 'deleted')::boolean
+),
+position_arrays as (
+    select
+        p.transaction_id,
+        array_agg((p.position ->> 'price')::double precision order by p.idx)            as prices,
+        array_agg((p.position ->> 'communist_shares')::double precision order by p.idx) as communist_shares
+    from positions p
+    group by p.transaction_id
+),
+usage_arrays as (
+    select
+        p.transaction_id,
+        array_agg(p.idx::integer order by p.idx, u.key::integer)            as positions,
+        array_agg(u.key::integer order by p.idx, u.key::integer)            as account_ids,
+        array_agg(u.value::double precision order by p.idx, u.key::integer) as shares
+    from
+        positions p
+        cross join json_each_text(p.position -> 'usages') u
+    group by p.transaction_id
+)
+update current_transaction_state cts
+set
+    position_prices           = coalesce(pa.prices, '{}'),
+    position_communist_shares = coalesce(pa.communist_shares, '{}'),
+    usage_positions           = coalesce(ua.positions, '{}'),
+    usage_account_ids         = coalesce(ua.account_ids, '{}'),
+    usage_shares              = coalesce(ua.shares, '{}')
+from
+    current_transaction_state t
+    left join position_arrays pa on pa.transaction_id = t.id
+    left join usage_arrays ua on ua.transaction_id = t.id
+where cts.id = t.id;
@@ -0,0 +1,31 @@
+-- migration: 3d6e0a95
+-- requires: b41f9a2c
+
+-- blobs are addressed by the sha256 hash of their content, all files with the same content share one blob.
+-- ref_count is the number of file_history rows referencing a blob, blobs are deleted with their last reference.
+alter table blob add column sha256 bytea;
+alter table blob add column size bigint;
+alter table blob add column ref_count integer not null default 0;
+
+update blob set sha256 = sha256(content), size = octet_length(content);
+
+-- point all files to the oldest blob with their content, the duplicates are dropped below
+with canonical_blob as (
+    select
+        id,
+        min(id) over (partition by sha256) as canonical_id
+    from blob
+)
+update file_history fh
+set blob_id = cb.canonical_id
+from canonical_blob cb
+where fh.blob_id = cb.id and cb.id <> cb.canonical_id;
+
+update blob b
+set ref_count = (select count(*) from file_history fh where fh.blob_id = b.id);
+
+delete from blob where ref_count = 0;
+
+alter table blob alter column sha256 set not null;
+alter table blob alter column size set not null;
+alter table blob add constraint blob_sha256_key unique (sha256);
@@ -0,0 +1,13 @@
+-- migration: 7c2f5e18
+-- requires: 3d6e0a95
+
+-- the content of a blob is either stored in the database or in the configured blob storage under storage_key
+alter table blob alter column content drop not null;
+alter table blob add column storage_key text unique;
+alter table blob add constraint blob_content_stored check (content is not null or storage_key is not null);
+
+-- storage keys of deleted blobs whose objects still need to be deleted from the blob storage
+create table orphaned_blob (
+    storage_key text primary key,
+    deleted_at  timestamptz not null default now()
+);
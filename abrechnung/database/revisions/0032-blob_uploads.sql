@@ -0,0 +1,15 @@
+-- migration: e1a04b6d
+-- requires: 7c2f5e18
+
+-- blobs uploaded on their own, transactions of the group can reference them as attachments until the upload expires.
+-- Uploads count as references of their blob, uploaded blobs are kept until they are attached or the upload expires.
+create table blob_upload (
+    id          serial primary key,
+    blob_id     integer     not null references blob (id) on delete cascade,
+    group_id    integer     not null references grp (id) on delete cascade,
+    user_id     integer     not null references usr (id) on delete cascade,
+    uploaded_at timestamptz not null default now()
+);
+
+create index blob_upload_blob_id_group_id_idx on blob_upload (blob_id, group_id);
+create index blob_upload_uploaded_at_idx on blob_upload (uploaded_at);
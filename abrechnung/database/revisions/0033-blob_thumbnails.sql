@@ -0,0 +1,16 @@
+-- migration: 5a9d31c7
+-- requires: e1a04b6d
+
+-- set once thumbnail generation for a blob has been claimed by an api worker, thumbnails of blobs whose generation
+-- failed or which existed before are generated on their first request
+alter table blob add column thumbnailed_at timestamptz;
+
+-- thumbnails are blobs of their own, referenced by the blob they are a thumbnail of
+create table blob_thumbnail (
+    source_blob_id integer not null references blob (id) on delete cascade,
+    size           integer not null,
+    blob_id        integer not null references blob (id) on delete cascade,
+    primary key (source_blob_id, size)
+);
+
+create index blob_thumbnail_blob_id_idx on blob_thumbnail (blob_id);
@@ -0,0 +1,23 @@
+-- migration: d6377a76
+-- requires: 5a9d31c7
+
+-- the pending_* tables serve as outbox of the mailer, mail_next_attempt is also set while a mailer has claimed a row
+alter table pending_registration add column mail_attempts integer not null default 0;
+alter table pending_registration add column mail_last_error text;
+-- set once the mailer gave up on sending the mail
+alter table pending_registration add column mail_failed_at timestamptz;
+
+alter table pending_password_recovery add column mail_attempts integer not null default 0;
+alter table pending_password_recovery add column mail_last_error text;
+alter table pending_password_recovery add column mail_failed_at timestamptz;
+
+alter table pending_email_change add column mail_attempts integer not null default 0;
+alter table pending_email_change add column mail_last_error text;
+alter table pending_email_change add column mail_failed_at timestamptz;
+
+create index pending_registration_mail_next_attempt_idx on pending_registration (mail_next_attempt)
+    where mail_next_attempt is not null;
+create index pending_password_recovery_mail_next_attempt_idx on pending_password_recovery (mail_next_attempt)
+    where mail_next_attempt is not null;
+create index pending_email_change_mail_next_attempt_idx on pending_email_change (mail_next_attempt)
+    where mail_next_attempt is not null;
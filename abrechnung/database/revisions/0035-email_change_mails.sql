@@ -0,0 +1,6 @@
+-- migration: 905218ce
+-- requires: d6377a76
+
+-- an email change consists of two mails, set once the confirmation to the new address has been sent such that
+-- retrying the notice to the old address does not send the confirmation again
+alter table pending_email_change add column mail_confirmation_sent boolean not null default false;
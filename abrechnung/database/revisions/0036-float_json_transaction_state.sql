@@ -0,0 +1,47 @@
+-- migration: 782e2bda
+-- requires: 905218ce
+
+-- render the floats stored in the json of current_transaction_state with a fractional part, i.e. 1.0 instead of 1,
+-- as the pydantic api models serialize them, new rows are written this way by refresh_current_transaction_states
+create function pg_temp.float_json(
+    value json
+) returns json
+    immutable
+    language sql
+as
+$$
+select case when json_typeof(value) = 'number' and value::text !~ '[.e]' then (value::text || '.0')::json else value end
+$$;
+
+create function pg_temp.float_values_json(
+    shares json
+) returns json
+    immutable
+    language sql
+as
+$$
+select coalesce(json_object_agg(s.key, pg_temp.float_json(s.value)), '{}'::json)
+from json_each(shares) s
+$$;
+
+update current_transaction_state
+set
+    creditor_shares = pg_temp.float_values_json(creditor_shares),
+    debitor_shares = pg_temp.float_values_json(debitor_shares),
+    positions = (
+        select
+            coalesce(
+                json_agg(
+                    json_build_object(
+                        'id', p.value -> 'id',
+                        'name', p.value -> 'name',
+                        'price', pg_temp.float_json(p.value -> 'price'),
+                        'communist_shares', pg_temp.float_json(p.value -> 'communist_shares'),
+                        'usages', pg_temp.float_values_json(p.value -> 'usages'),
+                        'deleted', p.value -> 'deleted'
+                    ) order by p.ordinality
+                ),
+                '[]'::json
+            )
+        from json_array_elements(positions) with ordinality p
+    );
@@ -0,0 +1,57 @@
+from datetime import date
+from enum import Enum
+
+from pydantic import BaseModel
+
+
+class TransactionAccountBalance(BaseModel):
+    """Effect of a single transaction on the balance of one account"""
+
+    total: float = 0.0
+    positions: float = 0.0
+    common_creditors: float = 0.0
+    common_debitors: float = 0.0
+
+
+TransactionBalanceEffect = dict[int, TransactionAccountBalance]
+
+
+class AccountBalance(BaseModel):
+    balance: float = 0.0
+    # balance of the account before redistributing clearing accounts
+    before_clearing: float = 0.0
+    total_consumed_purchases: float = 0.0
+    total_paid_purchases: float = 0.0
+    total_received_transfers: float = 0.0
+    total_paid_transfers: float = 0.0
+    # only set for clearing accounts, maps account IDs to the amount they received from this clearing account
+    clearing_resolution: dict[int, float] = {}
+
+
+AccountBalanceMap = dict[int, AccountBalance]
+
+
+class SettlementMode(Enum):
+    # exact for groups small enough to search for the minimal number of transfers, greedy otherwise
+    auto = "auto"
+    exact = "exact"
+    greedy = "greedy"
+
+
+class SettlementPlanItem(BaseModel):
+    # the account paying the amount, i.e. the creditor of the resulting transfer
+    creditor_id: int
+    # the account receiving the amount
+    debitor_id: int
+    payment_amount: float
+
+
+SettlementPlan = list[SettlementPlanItem]
+
+
+class GroupSettlement(BaseModel):
+    mode: SettlementMode = SettlementMode.auto
+    # name of the created transfers
+    name: str = "Settlement"
+    # defaults to today
+    billed_at: date | None = None
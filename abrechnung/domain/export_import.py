@@ -1,4 +1,5 @@
 from datetime import date
+from enum import Enum
 from typing import Literal
 
 from pydantic import BaseModel
@@ -23,11 +24,21 @@ class ClearingAccountJsonExportV1(BaseModel):
     clearing_shares: ClearingShares
 
 
+class ExportFormat(Enum):
+    # a single json document with base64 encoded file attachments, can be imported again
+    json = "json"
+    # archives of a json document and the file attachments as separate entries
+    zip = "zip"
+    tar = "tar"
+
+
 class FileAttachmentJsonExportV1(BaseModel):
     filename: str
     mime_type: str
-    # base64 encoded file content
-    content: str
+    # base64 encoded file content, not included in archive exports
+    content: str | None = None
+    # path of the file content within archive exports
+    path: str | None = None
 
 
 class TransactionPositionJsonExportV1(BaseModel):
@@ -47,17 +47,33 @@ class FileAttachment(BaseModel):
 
 class NewFile(BaseModel):
     filename: str
-    mime_type: str
+    # id of a blob uploaded to the group via upload_file, alternatively the file content can be given inline
+    blob_id: int | None = None
+    mime_type: str | None = None
     # base64 encoded file content
-    content: str
+    content: str | None = None
 
     @field_validator("mime_type")
     @classmethod
-    def check_mime_type_is_allowed(cls, v: str) -> str:
-        if v not in ALLOWED_FILETYPES:
+    def check_mime_type_is_allowed(cls, v: str | None) -> str | None:
+        if v is not None and v not in ALLOWED_FILETYPES:
             raise ValueError(f"File type {v} is not an accepted file type")
         return v
 
+    @model_validator(mode="after")
+    def check_content_is_given(self):
+        if (self.blob_id is None) == (self.content is None):
+            raise ValueError("exactly one of blob_id and content must be given")
+        if self.content is not None and self.mime_type is None:
+            raise ValueError("the mime type is required for inline file contents")
+        return self
+
+
+class UploadedFile(BaseModel):
+    blob_id: int
+    mime_type: str
+    size: int
+
 
 class UpdateFile(BaseModel):
     id: int
@@ -101,6 +117,21 @@ class UpdateTransaction(NewTransaction):
         return self
 
 
+class ChangedTransaction(UpdateTransaction):
+    id: int
+
+
+class TransactionBatch(BaseModel):
+    new_transactions: list[NewTransaction] = []
+    changed_transactions: list[ChangedTransaction] = []
+
+    @model_validator(mode="after")
+    def check_changed_transactions_are_unique(self):
+        if len({t.id for t in self.changed_transactions}) != len(self.changed_transactions):
+            raise ValueError("a transaction can only be changed once per batch")
+        return self
+
+
 class Transaction(BaseModel):
     id: int
     group_id: int
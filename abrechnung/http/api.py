@@ -1,13 +1,20 @@
+import asyncio
 import json
 import logging
+from datetime import timedelta
 
 from prometheus_fastapi_instrumentator import Instrumentator
+from sftkit.database import DatabaseHook
 from sftkit.http import Server
 
 from abrechnung import __version__
 from abrechnung.application.accounts import AccountService
+from abrechnung.application.balances import BalanceService
 from abrechnung.application.export_import import ExportImportService
+from abrechnung.application.group_changes import GroupChangeService
 from abrechnung.application.groups import GroupService
+from abrechnung.application.settlement import SettlementService
+from abrechnung.application.thumbnails import ThumbnailService
 from abrechnung.application.transactions import TransactionService
 from abrechnung.application.users import UserService
 from abrechnung.config import Config
@@ -15,7 +22,11 @@ from abrechnung.database.migrations import check_revision_version, get_database
 
 from . import metrics
 from .context import Context
-from .routers import accounts, auth, common, groups, transactions
+from .middleware import GroupMembershipCacheMiddleware
+from .routers import accounts, auth, balances, common, groups, transactions
+
+# how often the api deletes expired uploads and the storage objects of deleted blobs
+BLOB_CLEANUP_INTERVAL = timedelta(minutes=10)
 
 
 def get_server(config: Config):
@@ -26,11 +37,13 @@ def get_server(config: Config):
         version=__version__,
         cors=True,
     )
+    server.api.add_middleware(GroupMembershipCacheMiddleware)
 
     server.add_router(transactions.router)
     server.add_router(groups.router)
     server.add_router(auth.router)
     server.add_router(accounts.router)
+    server.add_router(balances.router)
     server.add_router(common.router)
     return server
 
@@ -55,6 +68,13 @@ class Api:
         self.user_service = UserService(db_pool=self.db_pool, config=self.cfg)
         self.transaction_service = TransactionService(db_pool=self.db_pool, config=self.cfg)
         self.account_service = AccountService(db_pool=self.db_pool, config=self.cfg)
+        self.balance_service = BalanceService(db_pool=self.db_pool, config=self.cfg)
+        self.settlement_service = SettlementService(
+            db_pool=self.db_pool,
+            config=self.cfg,
+            balance_service=self.balance_service,
+            transaction_service=self.transaction_service,
+        )
         self.group_service = GroupService(db_pool=self.db_pool, config=self.cfg)
         self.export_import_service = ExportImportService(
             db_pool=self.db_pool,
@@ -63,17 +83,49 @@ class Api:
             account_service=self.account_service,
             transaction_service=self.transaction_service,
         )
+        self.group_change_service = GroupChangeService(
+            db_pool=self.db_pool, config=self.cfg, group_service=self.group_service
+        )
+        self.thumbnail_service = ThumbnailService(
+            db_pool=self.db_pool, config=self.cfg, blob_service=self.transaction_service.blob_service
+        )
+        # keeps the user cache consistent with changes made through other api workers
+        self.user_change_hook = DatabaseHook(
+            self.db_pool,
+            channel="user_changed",
+            event_handler=self.user_service.handle_user_change_notification,
+            initial_run=True,
+        )
+        self.blob_created_hook = DatabaseHook(
+            self.db_pool,
+            channel="blob_created",
+            event_handler=self.thumbnail_service.handle_blob_created_notification,
+            initial_run=True,
+        )
+        # a single connection per api worker listens for the changes of all groups its clients are subscribed to
+        self.group_changed_hook = DatabaseHook(
+            self.db_pool,
+            channel="group_changed",
+            event_handler=self.group_change_service.handle_group_changed_notification,
+        )
         self.context = Context(
             config=self.cfg,
             user_service=self.user_service,
             transaction_service=self.transaction_service,
             account_service=self.account_service,
+            balance_service=self.balance_service,
+            settlement_service=self.settlement_service,
             group_service=self.group_service,
             export_import_service=self.export_import_service,
+            group_change_service=self.group_change_service,
+            thumbnail_service=self.thumbnail_service,
         )
 
     async def _teardown(self):
         await self.db_pool.close()
+        self.user_service.password_hasher.shutdown()
+        self.thumbnail_service.shutdown()
+        await self.transaction_service.blob_service.close()
 
     def _instrument_api(self):
         if not self.cfg.metrics.enabled:
@@ -85,10 +137,24 @@ class Api:
             instrumentor.add(metrics.abrechnung_total_amount_of_money(self.transaction_service))
         instrumentor.instrument(self.server.api).expose(self.server.api, endpoint="/api/metrics")
 
+    async def _cleanup_blobs(self):
+        blob_service = self.transaction_service.blob_service
+        while True:
+            try:
+                await blob_service.delete_expired_uploads()
+                await blob_service.delete_orphaned_blobs()
+            except Exception as e:
+                self.logger.error(f"Cleaning up blobs failed: {e}")
+            await asyncio.sleep(BLOB_CLEANUP_INTERVAL.total_seconds())
+
     async def run(self):
         await self._setup()
         try:
             self._instrument_api()
+            self.server.add_task(asyncio.create_task(self.user_change_hook.run()))
+            self.server.add_task(asyncio.create_task(self.blob_created_hook.run()))
+            self.server.add_task(asyncio.create_task(self.group_changed_hook.run()))
+            self.server.add_task(asyncio.create_task(self._cleanup_blobs()))
             await self.server.run(self.context)
         finally:
             await self._teardown()
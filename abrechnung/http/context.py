@@ -1,8 +1,12 @@
 from dataclasses import dataclass
 
 from abrechnung.application.accounts import AccountService
+from abrechnung.application.balances import BalanceService
 from abrechnung.application.export_import import ExportImportService
+from abrechnung.application.group_changes import GroupChangeService
 from abrechnung.application.groups import GroupService
+from abrechnung.application.settlement import SettlementService
+from abrechnung.application.thumbnails import ThumbnailService
 from abrechnung.application.transactions import TransactionService
 from abrechnung.application.users import UserService
 from abrechnung.config import Config
@@ -19,5 +23,9 @@ class Context:
     user_service: UserService
     transaction_service: TransactionService
     account_service: AccountService
+    balance_service: BalanceService
+    settlement_service: SettlementService
     group_service: GroupService
     export_import_service: ExportImportService
+    group_change_service: GroupChangeService
+    thumbnail_service: ThumbnailService
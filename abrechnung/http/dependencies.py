@@ -4,8 +4,12 @@ import asyncpg
 from fastapi import Depends, Request
 
 from abrechnung.application.accounts import AccountService
+from abrechnung.application.balances import BalanceService
 from abrechnung.application.export_import import ExportImportService
+from abrechnung.application.group_changes import GroupChangeService
 from abrechnung.application.groups import GroupService
+from abrechnung.application.settlement import SettlementService
+from abrechnung.application.thumbnails import ThumbnailService
 from abrechnung.application.transactions import TransactionService
 from abrechnung.application.users import UserService
 from abrechnung.config import Config
@@ -46,9 +50,25 @@ def get_account_service(request: Request) -> AccountService:
     return request.state.context.account_service
 
 
+def get_balance_service(request: Request) -> BalanceService:
+    return request.state.context.balance_service
+
+
+def get_settlement_service(request: Request) -> SettlementService:
+    return request.state.context.settlement_service
+
+
 def get_transaction_service(request: Request) -> TransactionService:
     return request.state.context.transaction_service
 
 
 def get_export_import_service(request: Request) -> ExportImportService:
     return request.state.context.export_import_service
+
+
+def get_group_change_service(request: Request) -> GroupChangeService:
+    return request.state.context.group_change_service
+
+
+def get_thumbnail_service(request: Request) -> ThumbnailService:
+    return request.state.context.thumbnail_service
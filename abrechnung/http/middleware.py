@@ -0,0 +1,24 @@
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from abrechnung.core.auth import group_membership_cache
+
+
+class GroupMembershipCacheMiddleware:
+    """
+    Scopes the group membership cache to a single request.
+
+    Implemented as a plain ASGI middleware such that the cache also covers dependencies and streamed response
+    bodies. Long lived connections such as websockets are not cached as group memberships can change meanwhile,
+    long lived http responses such as group change subscriptions open a fresh cache for every permission check.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with group_membership_cache():
+            await self.app(scope, receive, send)
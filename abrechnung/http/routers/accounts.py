@@ -1,12 +1,14 @@
-from typing import List
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Header, Response, status
 
 from abrechnung.application.accounts import AccountService
+from abrechnung.application.groups import GroupService
 from abrechnung.domain.accounts import Account, NewAccount
 from abrechnung.domain.users import User
 from abrechnung.http.auth import get_current_user
-from abrechnung.http.dependencies import get_account_service
+from abrechnung.http.dependencies import get_account_service, get_group_service
+from abrechnung.http.utils import GROUP_LIST_CACHE_CONTROL, etag_matches, group_etag
 
 router = APIRouter(
     prefix="/api",
@@ -23,14 +25,25 @@ router = APIRouter(
     r"/v1/groups/{group_id}/accounts",
     summary="list all accounts in a group",
     response_model=List[Account],
+    responses={status.HTTP_304_NOT_MODIFIED: {"description": "the group has not changed since the given etag"}},
     operation_id="list_accounts",
 )
 async def list_accounts(
     group_id: int,
+    if_none_match: Optional[str] = Header(default=None),
     user: User = Depends(get_current_user),
     account_service: AccountService = Depends(get_account_service),
+    group_service: GroupService = Depends(get_group_service),
 ):
-    return await account_service.list_accounts(user=user, group_id=group_id)
+    # the etag is determined before the accounts such that a concurrent change can only ever make it stale
+    etag = group_etag(group_id, user.id, await group_service.get_last_changed(user=user, group_id=group_id))
+    headers = {"ETag": etag, "Cache-Control": GROUP_LIST_CACHE_CONTROL}
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # the response json is built by the database, returning it as is skips the response model round trip
+    content = await account_service.list_accounts_json(user=user, group_id=group_id)
+    return Response(content=content, media_type="application/json", headers=headers)
 
 
 @router.post(
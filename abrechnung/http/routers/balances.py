@@ -0,0 +1,73 @@
+from fastapi import APIRouter, Depends, status
+
+from abrechnung.application.balances import BalanceService
+from abrechnung.application.settlement import SettlementService
+from abrechnung.domain.balances import (
+    AccountBalanceMap,
+    GroupSettlement,
+    SettlementMode,
+    SettlementPlan,
+)
+from abrechnung.domain.transactions import Transaction
+from abrechnung.domain.users import User
+from abrechnung.http.auth import get_current_user
+from abrechnung.http.dependencies import get_balance_service, get_settlement_service
+
+router = APIRouter(
+    prefix="/api",
+    tags=["balances"],
+    responses={
+        status.HTTP_401_UNAUTHORIZED: {"description": "unauthorized"},
+        status.HTTP_403_FORBIDDEN: {"description": "forbidden"},
+        status.HTTP_404_NOT_FOUND: {"description": "Not found"},
+    },
+)
+
+
+@router.get(
+    r"/v1/groups/{group_id}/balances",
+    summary="compute the balances of all accounts in a group",
+    description="Maps account ids to the current balance of all non-deleted accounts, "
+    "clearing accounts are already redistributed.",
+    response_model=AccountBalanceMap,
+    operation_id="get_balances",
+)
+async def get_balances(
+    group_id: int,
+    user: User = Depends(get_current_user),
+    balance_service: BalanceService = Depends(get_balance_service),
+):
+    return await balance_service.get_balances(user=user, group_id=group_id)
+
+
+@router.get(
+    r"/v1/groups/{group_id}/settlement",
+    summary="compute transfers which settle the balances of all personal accounts in a group",
+    description="In the exact mode the plan consists of the minimal number of transfers, which is only feasible for "
+    "groups with few open balances. The greedy mode needs at most one transfer less than there are accounts with an "
+    "open balance, auto chooses between both depending on the group size.",
+    response_model=SettlementPlan,
+    operation_id="get_settlement_plan",
+)
+async def get_settlement_plan(
+    group_id: int,
+    mode: SettlementMode = SettlementMode.auto,
+    user: User = Depends(get_current_user),
+    settlement_service: SettlementService = Depends(get_settlement_service),
+):
+    return await settlement_service.get_settlement_plan(user=user, group_id=group_id, mode=mode)
+
+
+@router.post(
+    r"/v1/groups/{group_id}/settlement",
+    summary="settle the balances of a group by creating the transfers of its settlement plan",
+    response_model=list[Transaction],
+    operation_id="settle_group",
+)
+async def settle_group(
+    group_id: int,
+    payload: GroupSettlement,
+    user: User = Depends(get_current_user),
+    settlement_service: SettlementService = Depends(get_settlement_service),
+):
+    return await settlement_service.settle_group(user=user, group_id=group_id, settlement=payload)
@@ -1,13 +1,16 @@
 from datetime import datetime, timezone
-from typing import List
+from typing import AsyncIterator, List, Optional
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Header, Query, Response, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from sftkit.error import InvalidArgument, NotFound
 
 from abrechnung.application.export_import import ExportImportService
+from abrechnung.application.group_changes import GroupChangeService
 from abrechnung.application.groups import GroupService
 from abrechnung.application.users import UserService
-from abrechnung.domain.export_import import GroupJsonExportV1
+from abrechnung.domain.export_import import ExportFormat, GroupJsonExportV1
 from abrechnung.domain.groups import (
     Group,
     GroupInvite,
@@ -17,7 +20,13 @@ from abrechnung.domain.groups import (
 )
 from abrechnung.domain.users import User
 from abrechnung.http.auth import get_current_user
-from abrechnung.http.dependencies import get_export_import_service, get_group_service, get_user_service
+from abrechnung.http.dependencies import (
+    get_export_import_service,
+    get_group_change_service,
+    get_group_service,
+    get_user_service,
+)
+from abrechnung.http.utils import GROUP_LIST_CACHE_CONTROL, etag_matches, group_etag
 
 router = APIRouter(
     prefix="/api",
@@ -75,6 +84,43 @@ async def join_group(
     return await group_service.get_group(user=user, group_id=group_id)
 
 
+async def _group_change_events(changes: AsyncIterator[Group | None]) -> AsyncIterator[str]:
+    try:
+        async for group in changes:
+            if group is None:
+                # comment lines keep idle connections open
+                yield ": keepalive\n\n"
+            else:
+                yield f"event: group_changed\ndata: {group.model_dump_json()}\n\n"
+    except (InvalidArgument, NotFound):
+        # the user is no longer a member of the group or it has been deleted, reconnecting fails accordingly
+        return
+
+
+@router.get(
+    r"/v1/groups/{group_id}/changes",
+    summary="subscribe to changes of a group",
+    description="Server-sent event stream with a 'group_changed' event carrying the current group right away and "
+    "whenever anything in the group changed, e.g. transactions, accounts or members. Clients fetch the changed "
+    "transactions and accounts with min_last_changed set to the last_changed of the previous event.",
+    operation_id="subscribe_to_group_changes",
+    response_class=StreamingResponse,
+    tags=["groups"],
+)
+async def subscribe_to_group_changes(
+    group_id: int,
+    user: User = Depends(get_current_user),
+    group_change_service: GroupChangeService = Depends(get_group_change_service),
+):
+    changes = await group_change_service.subscribe(user=user, group_id=group_id)
+    return StreamingResponse(
+        _group_change_events(changes),
+        media_type="text/event-stream",
+        # proxies must neither cache nor buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.get(
     "/v1/groups",
     summary="list the current users groups",
@@ -192,14 +238,23 @@ async def leave_group(
     r"/v1/groups/{group_id}/members",
     summary="list all members of a group",
     response_model=List[GroupMember],
+    responses={status.HTTP_304_NOT_MODIFIED: {"description": "the group has not changed since the given etag"}},
     operation_id="list_members",
     tags=["groups", "group_members"],
 )
 async def list_members(
     group_id: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(default=None),
     user: User = Depends(get_current_user),
     group_service: GroupService = Depends(get_group_service),
 ):
+    etag = group_etag(group_id, user.id, await group_service.get_last_changed(user=user, group_id=group_id))
+    headers = {"ETag": etag, "Cache-Control": GROUP_LIST_CACHE_CONTROL}
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response.headers.update(headers)
     return await group_service.list_members(
         user=user,
         group_id=group_id,
@@ -210,14 +265,23 @@ async def list_members(
     r"/v1/groups/{group_id}/logs",
     summary="fetch the group log",
     response_model=List[GroupLog],
+    responses={status.HTTP_304_NOT_MODIFIED: {"description": "the group has not changed since the given etag"}},
     operation_id="list_log",
     tags=["groups", "group_logs"],
 )
 async def list_log(
     group_id: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(default=None),
     user: User = Depends(get_current_user),
     group_service: GroupService = Depends(get_group_service),
 ):
+    etag = group_etag(group_id, user.id, await group_service.get_last_changed(user=user, group_id=group_id))
+    headers = {"ETag": etag, "Cache-Control": GROUP_LIST_CACHE_CONTROL}
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response.headers.update(headers)
     return await group_service.list_log(user=user, group_id=group_id)
 
 
@@ -410,9 +474,16 @@ async def unarchive_group(
     )
 
 
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.json: "application/json",
+    ExportFormat.zip: "application/zip",
+    ExportFormat.tar: "application/x-tar",
+}
+
+
 @router.post(
     r"/v1/groups/{group_id}/export-json",
-    summary="un-archive a group",
+    summary="export a group as json",
     operation_id="export_group_json",
     response_model=GroupJsonExportV1,
     tags=["groups"],
@@ -422,9 +493,30 @@ async def export_group_json(
     user: User = Depends(get_current_user),
     export_import_service: ExportImportService = Depends(get_export_import_service),
 ):
-    return await export_import_service.export_group_as_json(
-        user=user,
-        group_id=group_id,
+    chunks = await export_import_service.export_group(user=user, group_id=group_id, export_format=ExportFormat.json)
+    return StreamingResponse(chunks, media_type=EXPORT_MEDIA_TYPES[ExportFormat.json])
+
+
+@router.get(
+    r"/v1/groups/{group_id}/export",
+    summary="download an export of a group",
+    description="The json format can be imported again. The zip and tar formats contain the json document as "
+    "'group.json' without the file contents, file attachments are separate entries at the paths given in it.",
+    operation_id="download_group_export",
+    response_class=StreamingResponse,
+    tags=["groups"],
+)
+async def download_group_export(
+    group_id: int,
+    export_format: ExportFormat = Query(default=ExportFormat.json, alias="format"),
+    user: User = Depends(get_current_user),
+    export_import_service: ExportImportService = Depends(get_export_import_service),
+):
+    chunks = await export_import_service.export_group(user=user, group_id=group_id, export_format=export_format)
+    return StreamingResponse(
+        chunks,
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="group-{group_id}.{export_format.value}"'},
     )
 
 
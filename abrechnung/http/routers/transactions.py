@@ -1,21 +1,41 @@
 from datetime import datetime
 from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Response, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+from abrechnung.application.blobs import BlobService, StoredBlob
+from abrechnung.application.groups import GroupService
+from abrechnung.application.thumbnails import ThumbnailService
 from abrechnung.application.transactions import TransactionService
+from abrechnung.config import Config
 from abrechnung.domain.transactions import (
+    ALLOWED_FILETYPES,
     CurrencyConversionRate,
     NewTransaction,
     Transaction,
+    TransactionBatch,
     TransactionHistory,
     TransactionPosition,
     UpdateTransaction,
+    UploadedFile,
 )
 from abrechnung.domain.users import User
 from abrechnung.http.auth import get_current_user
-from abrechnung.http.dependencies import get_transaction_service
+from abrechnung.http.dependencies import (
+    get_config,
+    get_group_service,
+    get_thumbnail_service,
+    get_transaction_service,
+)
+from abrechnung.http.utils import (
+    GROUP_LIST_CACHE_CONTROL,
+    RangeNotSatisfiable,
+    etag_matches,
+    group_etag,
+    parse_byte_range,
+)
 
 router = APIRouter(
     prefix="/api",
@@ -27,36 +47,151 @@ router = APIRouter(
     },
 )
 
+# blobs are immutable, clients may cache them as long as they like but shared caches must not as they require auth
+FILE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+async def _blob_response(
+    blob_service: BlobService,
+    blob: StoredBlob,
+    range_header: Optional[str],
+    if_range: Optional[str],
+    if_none_match: Optional[str],
+) -> Response:
+    etag = f'"{blob.sha256}"'
+    headers = {"ETag": etag, "Cache-Control": FILE_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    start, end = 0, blob.size
+    status_code = status.HTTP_200_OK
+    # a range is only served if the client's copy, identified by If-Range, is still the current one
+    if range_header is not None and (if_range is None or if_range == etag):
+        try:
+            byte_range = parse_byte_range(range_header, blob.size)
+        except RangeNotSatisfiable:
+            headers["Content-Range"] = f"bytes */{blob.size}"
+            return Response(status_code=status.HTTP_416_RANGE_NOT_SATISFIABLE, headers=headers)
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = status.HTTP_206_PARTIAL_CONTENT
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{blob.size}"
+    headers["Content-Length"] = str(end - start)
+
+    chunks = blob_service.stream_blob(blob, start, end)
+    # fetch the first chunk before sending the response headers such that missing blobs result in an error response
+    first = await anext(chunks, None)
+
+    async def _stream():
+        if first is not None:
+            yield first
+        async for chunk in chunks:
+            yield chunk
+
+    return StreamingResponse(_stream(), status_code=status_code, media_type=blob.mime_type, headers=headers)
+
+
+def _parse_transaction_ids(transaction_ids: Optional[str]) -> Optional[list[int]]:
+    if not transaction_ids:
+        return None
+    try:
+        return [int(x) for x in transaction_ids.split(",")]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Invalid query param 'transaction_ids', must be a comma separated list of integers",
+        )
+
+
+def _parse_keyset_cursor(
+    after_last_changed: Optional[datetime], after_id: Optional[int]
+) -> Optional[tuple[datetime, int]]:
+    if after_last_changed is None and after_id is None:
+        return None
+    if after_last_changed is None or after_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Query params 'after_last_changed' and 'after_id' must be given together",
+        )
+    return after_last_changed, after_id
+
 
 @router.get(
     "/v1/groups/{group_id}/transactions",
     summary="list all transactions in a group",
+    description="Transactions are ordered by (last_changed, id). To paginate pass the 'last_changed' and 'id' of the "
+    "last transaction of the previous page as 'after_last_changed' and 'after_id'.",
     response_model=list[Transaction],
+    responses={status.HTTP_304_NOT_MODIFIED: {"description": "the group has not changed since the given etag"}},
     operation_id="list_transactions",
 )
 async def list_transactions(
     group_id: int,
     min_last_changed: Optional[datetime] = None,
     transaction_ids: Optional[str] = None,
+    after_last_changed: Optional[datetime] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = Query(default=None, ge=1),
+    if_none_match: Optional[str] = Header(default=None),
     user: User = Depends(get_current_user),
     transaction_service: TransactionService = Depends(get_transaction_service),
+    group_service: GroupService = Depends(get_group_service),
 ):
-    forced_transaction_ids = None
-    if transaction_ids:
-        try:
-            forced_transaction_ids = [int(x) for x in transaction_ids.split(",")]
-        except ValueError:
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail="Invalid query param 'transaction_ids', must be a comma separated list of integers",
-            )
-
-    return await transaction_service.list_transactions(
+    # the etag is determined before the transactions such that a concurrent change can only ever make it stale,
+    # the query parameters are part of the url clients keep their copy under
+    etag = group_etag(group_id, user.id, await group_service.get_last_changed(user=user, group_id=group_id))
+    headers = {"ETag": etag, "Cache-Control": GROUP_LIST_CACHE_CONTROL}
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # the response json is built by the database, returning it as is skips the response model round trip
+    content = await transaction_service.list_transactions_json(
         user=user,
         group_id=group_id,
         min_last_changed=min_last_changed,
-        additional_transactions=forced_transaction_ids,
+        additional_transactions=_parse_transaction_ids(transaction_ids),
+        after=_parse_keyset_cursor(after_last_changed, after_id),
+        limit=limit,
     )
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+@router.get(
+    "/v1/groups/{group_id}/transactions/stream",
+    summary="stream all transactions in a group as newline delimited json",
+    description="Same as list_transactions but the transactions are streamed as one json object per line.",
+    response_class=StreamingResponse,
+    responses={status.HTTP_200_OK: {"content": {"application/x-ndjson": {}}}},
+    operation_id="stream_transactions",
+)
+async def stream_transactions(
+    group_id: int,
+    min_last_changed: Optional[datetime] = None,
+    transaction_ids: Optional[str] = None,
+    after_last_changed: Optional[datetime] = None,
+    after_id: Optional[int] = None,
+    user: User = Depends(get_current_user),
+    transaction_service: TransactionService = Depends(get_transaction_service),
+):
+    transactions = transaction_service.stream_transactions_json(
+        user=user,
+        group_id=group_id,
+        min_last_changed=min_last_changed,
+        additional_transactions=_parse_transaction_ids(transaction_ids),
+        after=_parse_keyset_cursor(after_last_changed, after_id),
+    )
+    # fetch the first transaction before sending the response headers such that permission errors
+    # still result in a proper error response
+    first = await anext(transactions, None)
+
+    async def _serialize():
+        if first is None:
+            return
+        yield first + "\n"
+        async for transaction in transactions:
+            yield transaction + "\n"
+
+    return StreamingResponse(_serialize(), media_type="application/x-ndjson")
 
 
 @router.post(
@@ -80,6 +215,21 @@ async def create_transaction(
     return await transaction_service.get_transaction(user=user, transaction_id=transaction_id)
 
 
+@router.post(
+    "/v1/groups/{group_id}/transactions/batch",
+    summary="create and update multiple transactions at once",
+    response_model=list[Transaction],
+    operation_id="batch_update_transactions",
+)
+async def batch_update_transactions(
+    group_id: int,
+    payload: TransactionBatch,
+    user: User = Depends(get_current_user),
+    transaction_service: TransactionService = Depends(get_transaction_service),
+):
+    return await transaction_service.batch_update_transactions(user=user, group_id=group_id, batch=payload)
+
+
 @router.get(
     "/v1/groups/{group_id}/transactions/{transaction_id}",
     summary="get transaction details",
@@ -178,22 +328,120 @@ async def delete_transaction(
 @router.get(
     "/v1/files/{file_id}/{blob_id}",
     summary="fetch the (binary) contents of a transaction attachment",
+    description="The contents of a blob never change, responses carry a strong ETag and can be cached indefinitely. "
+    "Supports conditional requests via If-None-Match and single byte ranges via Range.",
     operation_id="get_file_contents",
-    response_class=Response,
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_206_PARTIAL_CONTENT: {"description": "the requested byte range of the file"},
+        status.HTTP_304_NOT_MODIFIED: {"description": "the cached file contents are still valid"},
+        status.HTTP_416_RANGE_NOT_SATISFIABLE: {"description": "the requested byte range is not satisfiable"},
+    },
 )
 async def get_file_contents(
     file_id: int,
     blob_id: int,
+    range_header: Optional[str] = Header(default=None, alias="range"),
+    if_range: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None),
+    user: User = Depends(get_current_user),
+    transaction_service: TransactionService = Depends(get_transaction_service),
+):
+    blob = await transaction_service.get_file_blob(
+        user=user,
+        file_id=file_id,
+        blob_id=blob_id,
+    )
+
+    return await _blob_response(
+        transaction_service.blob_service,
+        blob,
+        range_header=range_header,
+        if_range=if_range,
+        if_none_match=if_none_match,
+    )
+
+
+@router.get(
+    "/v1/files/{file_id}/{blob_id}/thumbnail",
+    summary="fetch a webp thumbnail of an image attachment",
+    description="Returns the smallest available thumbnail at least as large as the requested size, the largest one "
+    "if none is. Thumbnails are cacheable and support range requests like the file contents.",
+    operation_id="get_file_thumbnail",
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_206_PARTIAL_CONTENT: {"description": "the requested byte range of the thumbnail"},
+        status.HTTP_304_NOT_MODIFIED: {"description": "the cached thumbnail is still valid"},
+        status.HTTP_416_RANGE_NOT_SATISFIABLE: {"description": "the requested byte range is not satisfiable"},
+    },
+)
+async def get_file_thumbnail(
+    file_id: int,
+    blob_id: int,
+    size: int = Query(default=256, gt=0),
+    range_header: Optional[str] = Header(default=None, alias="range"),
+    if_range: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None),
     user: User = Depends(get_current_user),
     transaction_service: TransactionService = Depends(get_transaction_service),
+    thumbnail_service: ThumbnailService = Depends(get_thumbnail_service),
 ):
-    mime_type, content = await transaction_service.read_file_contents(
+    # also checks the permissions of the user on the file
+    blob = await transaction_service.get_file_blob(
         user=user,
         file_id=file_id,
         blob_id=blob_id,
     )
+    thumbnail = await thumbnail_service.get_thumbnail(blob_id=blob.id, size=size)
+    return await _blob_response(
+        transaction_service.blob_service,
+        thumbnail,
+        range_header=range_header,
+        if_range=if_range,
+        if_none_match=if_none_match,
+    )
+
+
+@router.post(
+    "/v1/groups/{group_id}/files",
+    summary="upload a file which transactions of the group can then attach by its blob id",
+    description="The raw file content is sent as request body with the file's mime type as content type. "
+    "Uploads which are not attached to a transaction within a day are discarded.",
+    response_model=UploadedFile,
+    operation_id="upload_file",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                mime_type: {"schema": {"type": "string", "format": "binary"}} for mime_type in ALLOWED_FILETYPES
+            },
+        }
+    },
+)
+async def upload_file(
+    group_id: int,
+    request: Request,
+    content_type: str = Header(),
+    content_length: Optional[int] = Header(default=None),
+    user: User = Depends(get_current_user),
+    config: Config = Depends(get_config),
+    transaction_service: TransactionService = Depends(get_transaction_service),
+):
+    max_file_size = config.api.max_uploadable_file_size
+    # reject uploads which announce their size upfront before receiving them, the size of all others is checked while
+    # they are received
+    if content_length is not None and content_length > max_file_size * 1024:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File is too large, maximum is {max_file_size}KB",
+        )
 
-    return Response(content=content, media_type=mime_type)
+    return await transaction_service.upload_file(
+        user=user,
+        group_id=group_id,
+        mime_type=content_type.split(";")[0].strip(),
+        content=request.stream(),
+    )
 
 
 @router.get(
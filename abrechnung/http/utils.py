@@ -1,4 +1,4 @@
-from datetime import date, datetime
+from datetime import date, datetime, timedelta, timezone
 from uuid import UUID
 
 
@@ -9,3 +9,58 @@ def encode_json(obj):
         return str(obj)
 
     raise TypeError(f"Type {type(obj)} is not serializable")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_byte_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parses a http Range header into the byte range [start, end) of a resource of the given size.
+
+    Returns None if the header is to be ignored, i.e. if it is malformed or requests multiple ranges, in which case the
+    whole resource is returned. Raises RangeNotSatisfiable if the range lies outside of the resource.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep or not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+        return None
+
+    if first == "":
+        # suffix range, the last n bytes
+        if last == "":
+            return None
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable
+        return max(size - length, 0), size
+
+    start = int(first)
+    end = int(last) + 1 if last else size
+    if last and end <= start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable
+    return start, min(end, size)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header matches the given etag, using the weak comparison required for it"""
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in if_none_match.split(","))
+
+
+# lists derived from a group may be kept by clients but have to be revalidated with their etag before every use
+GROUP_LIST_CACHE_CONTROL = "private, no-cache"
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def group_etag(group_id: int, user_id: int, last_changed: datetime) -> str:
+    """Weak etag of a list derived from a group as seen by a user, valid as long as the group has not changed"""
+    version = (last_changed - _EPOCH) // timedelta(microseconds=1)
+    return f'W/"{group_id}-{user_id}-{version}"'
@@ -3,104 +3,134 @@ import email.message
 import email.utils
 import itertools
 import logging
-import smtplib
-from typing import Optional, Type
+from datetime import timedelta
+from typing import Awaitable, Callable, Optional
 
 import asyncpg
-from sftkit.database import Connection
+from sftkit.database import Connection, Pool
 
 from .config import Config
+from .core.smtp import SmtpPool
 from .database.migrations import get_database
 
+# claimed mails are offered to other workers again after this long, e.g. if the claiming worker died while sending
+MAIL_CLAIM_TIMEOUT = timedelta(minutes=5)
+# failed mails are retried with exponential backoff starting at the base delay
+MAIL_RETRY_BASE_DELAY = timedelta(seconds=30)
+MAIL_RETRY_MAX_DELAY = timedelta(hours=1)
+# seconds between checks for mails whose retry is due, new mails are announced by notifications
+MAIL_RETRY_POLL_INTERVAL = 30
+# seconds a delivery waits before claiming mails, notifications arriving in the meantime are handled by it as well
+MAIL_NOTIFICATION_DEBOUNCE = 0.1
+
 
 class Mailer:
+    """
+    Delivers the mails of the pending_registration, pending_password_recovery and pending_email_change tables.
+
+    These tables serve as outbox, their rows are claimed in batches with 'for update skip locked' such that any
+    number of mailers can run side by side. A claim only lasts for MAIL_CLAIM_TIMEOUT, no transaction is held open
+    while talking to the mail server. Failed mails are retried with exponential backoff and given up on after
+    email.max_attempts attempts, which is recorded in mail_failed_at.
+    """
+
     def __init__(self, config: Config):
         self.config = config
         self.events: Optional[asyncio.Queue] = None
+        self.db_pool: Pool | None = None
         self.db_connection: Connection | None = None
         self.database = get_database(config.database)
-        self.mailer = None
+        self.smtp = SmtpPool(config.email)
         self.logger = logging.getLogger(__name__)
-
-        self.event_handlers = {
-            (
-                "mailer",
-                "pending_registration",
-            ): self.on_pending_registration_notification,
-            (
-                "mailer",
-                "pending_password_recovery",
-            ): self.on_user_password_recovery_notification,
-            ("mailer", "pending_email_change"): self.on_user_email_update_notification,
+        # at most one delivery runs per outbox table, tables notified while their delivery is running are delivered again
+        # once it is done, such that a burst of notifications results in a single pass over the pending mails
+        self._deliveries: dict[str, asyncio.Task] = {}
+        self._redeliver: set[str] = set()
+
+        # outbox tables by the payload of their 'mailer' notifications
+        self.mail_senders: dict[str, Callable[[asyncpg.Record], Awaitable[None]]] = {
+            "pending_registration": self._send_registration_mail,
+            "pending_password_recovery": self._send_password_recovery_mail,
+            "pending_email_change": self._send_email_change_mails,
         }
 
     async def _mailer_loop(self):
         assert self.events is not None
-        # run all of the events manually once
-        for event_handler in self.event_handlers.values():
-            await event_handler()
-
-        # handle events
+        retry_task = asyncio.create_task(self._retry_loop())
+        try:
+            # handle events
+            while True:
+                event = await self.events.get()
+                if isinstance(event, StopIteration):
+                    return False
+                channel, payload = event
+                if channel != "mailer" or payload not in self.mail_senders:
+                    self.logger.info(f"unhandled event {event!r}")
+                else:
+                    self._start_delivery(payload)
+        finally:
+            retry_task.cancel()
+
+    async def _retry_loop(self):
+        """Delivers all mails which are due once on startup and then periodically, which covers retries"""
+        while True:
+            for table in self.mail_senders:
+                self._start_delivery(table)
+            await asyncio.sleep(MAIL_RETRY_POLL_INTERVAL)
+
+    def _start_delivery(self, table: str):
+        running = self._deliveries.get(table)
+        if running is not None and not running.done():
+            self._redeliver.add(table)
+            return
+        # deliveries run in the background such that a slow mail server does not hold up the notification handling
+        self._deliveries[table] = asyncio.create_task(self._deliver_in_background(table))
+
+    async def _deliver_in_background(self, table: str):
+        await asyncio.sleep(MAIL_NOTIFICATION_DEBOUNCE)
         while True:
-            event = await self.events.get()
-            if isinstance(event, StopIteration):
-                return False
-            handler = self.event_handlers.get(event)
-            if handler is None:
-                self.logger.info(f"unhandled event {event!r}")
-            else:
-                await handler()
+            # mails announced by notifications from here on are claimed by the pass below at the earliest
+            self._redeliver.discard(table)
+            try:
+                await self.deliver_pending_mails(table)
+            except Exception as e:
+                self.logger.error(f"Delivering the mails of {table} failed: {e}")
+            if table not in self._redeliver:
+                return
 
     async def run(self):
         # just try to connect to the mailing server once
-        _ = self.get_mailer_instance()
+        await self.smtp.check()
         # only initialize the event queue once we are in a proper async context otherwise weird errors happen
         self.events = asyncio.Queue()
 
         if self.events is None:
             raise RuntimeError("something unexpected happened, self.events is None")
 
-        stopped = False
-        while not stopped:
-            db_pool = await self.database.create_pool(n_connections=1)
-            self.db_connection = await db_pool.acquire()
-            assert self.db_connection is not None
-            self.db_connection.add_termination_listener(self.terminate_callback)
-            self.db_connection.add_log_listener(self.log_callback)
-            await self.db_connection.add_listener("mailer", self.notification_callback)
-
-            try:
-                # if this returns it means the database connection was closed -> retry opening the db pool
-                await self._mailer_loop()
-            except Exception:  # pylint: disable=bare-except
-                await self.db_connection.remove_listener("mailer", self.notification_callback)
-                await self.db_connection.close()
-                await db_pool.close()
-                stopped = True
-
-    def get_mailer_instance(self):
-        mode = self.config.email.mode
-
-        if mode == "local":
-            mail_sender_class: Type[smtplib.SMTP] | Type[smtplib.LMTP] | Type[smtplib.SMTP_SSL] = smtplib.LMTP
-        elif mode == "smtp-ssl":
-            mail_sender_class = smtplib.SMTP_SSL
-        else:
-            mail_sender_class = smtplib.SMTP
-
-        mailer = mail_sender_class(
-            host=self.config.email.host,
-            port=self.config.email.port,
-        )
-        if mode == "smtp-starttls":
-            mailer.starttls()
-
-        if self.config.email.auth:
-            mailer.login(
-                user=self.config.email.auth.username,
-                password=self.config.email.auth.password,
-            )
-        return mailer
+        try:
+            stopped = False
+            while not stopped:
+                # one connection listens for notifications, the others are used for delivering mails
+                db_pool = await self.database.create_pool(n_connections=3)
+                self.db_pool = db_pool
+                self.db_connection = await db_pool.acquire()
+                assert self.db_connection is not None
+                self.db_connection.add_termination_listener(self.terminate_callback)
+                self.db_connection.add_log_listener(self.log_callback)
+                await self.db_connection.add_listener("mailer", self.notification_callback)
+
+                try:
+                    # if this returns it means the database connection was closed -> retry opening the db pool
+                    await self._mailer_loop()
+                except Exception:  # pylint: disable=bare-except
+                    await self.db_connection.remove_listener("mailer", self.notification_callback)
+                    await self.db_connection.close()
+                    await db_pool.close()
+                    stopped = True
+        finally:
+            for task in self._deliveries.values():
+                task.cancel()
+            await self.smtp.close()
 
     def notification_callback(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str):
         """runs whenever we get a psql notification"""
@@ -126,12 +156,9 @@ class Mailer:
         del connection  # unused
         self.logger.info(f"psql log message: {message}")
 
-    def send_email(self, *text_lines: str, subject: str, dest_address: str, dest_name: str):
+    async def send_email(self, *text_lines: str, subject: str, dest_address: str, dest_name: str):
         self.logger.info(f"sending email to {dest_address}, subject: {subject}")
 
-        # we do this to not have one long hanging open connection with the mail server
-        mailer = self.get_mailer_instance()
-
         from_addr = self.config.email.address
         msg = email.message.EmailMessage()
         msg.set_content(
@@ -148,7 +175,7 @@ class Mailer:
         msg["From"] = from_addr
         msg["Date"] = email.utils.localtime()
         msg["Message-ID"] = email.utils.make_msgid(domain=from_addr.split("@")[-1])
-        mailer.send_message(msg)
+        await self.smtp.send(msg)
 
     def greeting_lines(self, name: str):
         return f"Beloved {name},", ""
@@ -156,123 +183,139 @@ class Mailer:
     def closing_lines(self):
         return "", "Thoughtfully yours", "", f"    {self.config.service.name}"
 
-    async def on_pending_registration_notification(self):
-        assert self.db_connection is not None
-        unsent_mails = await self.db_connection.fetch(
-            "select usr.id, usr.email, usr.username, pr.token, pr.valid_until "
-            "from pending_registration pr join usr on usr.id = pr.user_id "
-            "where pr.mail_next_attempt is not null and pr.mail_next_attempt < NOW() and pr.valid_until > NOW()"
+    async def _claim_pending_mails(self, table: str) -> list[asyncpg.Record]:
+        assert self.db_pool is not None
+        # the table name is one of our own outbox tables, never user input
+        return await self.db_pool.fetch(
+            f"update {table} p set mail_attempts = p.mail_attempts + 1, mail_next_attempt = now() + $2::interval "
+            f"from usr "
+            f"where usr.id = p.user_id and p.token in ("
+            f"   select token from {table} "
+            f"   where mail_next_attempt <= now() and valid_until > now() "
+            f"   order by mail_next_attempt "
+            f"   limit $1 "
+            f"   for update skip locked"
+            f") "
+            f"returning p.*, usr.username, usr.email",
+            self.config.email.batch_size,
+            MAIL_CLAIM_TIMEOUT,
         )
 
-        if not unsent_mails:
-            self.logger.info("no pending_registration mails are pending")
+    async def deliver_pending_mails(self, table: str) -> int:
+        """Claims and sends batches of due mails of an outbox table until none are left, returns the number sent"""
+        assert self.db_pool is not None
+        send = self.mail_senders[table]
 
-        for row in unsent_mails:
+        async def _send(row: asyncpg.Record) -> str | None:
+            """Returns the error if sending failed"""
             try:
-                self.send_email(
-                    "it looks like you are attempting to create a user account.",
-                    "",
-                    "To complete your registration, visit",
-                    "",
-                    f"{self.config.api.base_url}/confirm-registration/{row['token']}",
-                    "",
-                    f"Your request will time out {row['valid_until']}.",
-                    "If you do not want to create a user account, just ignore this email.",
-                    subject="Confirm user account",
-                    dest_address=row["email"],
-                    dest_name=row["username"],
-                )
+                await send(row)
+                return None
+            except Exception as e:
+                self.logger.warning(f"Failed to send email to user {row['username']}: {e}")
+                return str(e) or type(e).__name__
 
-                await self.db_connection.execute(
-                    "update pending_registration set mail_next_attempt = null where token = $1",
-                    row["token"],
+        n_sent = 0
+        while True:
+            rows = await self._claim_pending_mails(table)
+            if not rows:
+                return n_sent
+
+            errors = await asyncio.gather(*(_send(row) for row in rows))
+            sent_tokens = [row["token"] for row, error in zip(rows, errors) if error is None]
+            failed = [(row["token"], error) for row, error in zip(rows, errors) if error is not None]
+            await self.db_pool.execute(
+                f"update {table} set mail_next_attempt = null, mail_last_error = null where token = any($1)",
+                sent_tokens,
+            )
+            if failed:
+                failed_tokens = await self.db_pool.fetch(
+                    f"update {table} p set "
+                    f"   mail_last_error = f.error, "
+                    f"   mail_next_attempt = case when p.mail_attempts < $3 "
+                    f"       then now() + least($4::interval * 2 ^ (p.mail_attempts - 1), $5::interval) "
+                    f"   end, "
+                    f"   mail_failed_at = case when p.mail_attempts >= $3 then now() end "
+                    f"from unnest($1::uuid[], $2::text[]) f(token, error) "
+                    f"where p.token = f.token "
+                    f"returning p.token, p.mail_failed_at",
+                    [token for token, _ in failed],
+                    [error for _, error in failed],
+                    self.config.email.max_attempts,
+                    MAIL_RETRY_BASE_DELAY,
+                    MAIL_RETRY_MAX_DELAY,
                 )
-            except smtplib.SMTPException as e:
-                self.logger.warning(f"Failed to send email to user {row['username']} with email {row['email']}: {e}")
-
-    async def on_user_password_recovery_notification(self):
-        assert self.db_connection is not None
-        unsent_mails = await self.db_connection.fetch(
-            "select usr.id, usr.username, usr.email, ppr.token, ppr.valid_until "
-            "from pending_password_recovery ppr join usr on usr.id = ppr.user_id "
-            "where ppr.mail_next_attempt is not null and ppr.mail_next_attempt < NOW() and ppr.valid_until > NOW()"
+                for row in failed_tokens:
+                    if row["mail_failed_at"] is not None:
+                        self.logger.error(f"Giving up on sending the {table} mail with token {row['token']}")
+            n_sent += len(sent_tokens)
+
+    async def _send_registration_mail(self, row: asyncpg.Record):
+        await self.send_email(
+            "it looks like you are attempting to create a user account.",
+            "",
+            "To complete your registration, visit",
+            "",
+            f"{self.config.api.base_url}/confirm-registration/{row['token']}",
+            "",
+            f"Your request will time out {row['valid_until']}.",
+            "If you do not want to create a user account, just ignore this email.",
+            subject="Confirm user account",
+            dest_address=row["email"],
+            dest_name=row["username"],
         )
 
-        if not unsent_mails:
-            self.logger.info("no user_password_recovery mails are pending")
-
-        for row in unsent_mails:
-            try:
-                self.send_email(
-                    "it looks like you forgot your password; how embarrasing.",
-                    "",
-                    "To set a new one, visit",
-                    "",
-                    f"{self.config.api.base_url}/confirm-password-recovery/{row['token']}",
-                    "",
-                    f"Your request will time out {row['valid_until']}.",
-                    "If you do not want to reset your password, just ignore this email.",
-                    subject="Reset password",
-                    dest_address=row["email"],
-                    dest_name=row["username"],
-                )
-
-                await self.db_connection.execute(
-                    "update pending_password_recovery set mail_next_attempt = null where token = $1",
-                    row["token"],
-                )
-            except smtplib.SMTPException as e:
-                self.logger.warning(f"Failed to send email to user {row['username']} with email {row['email']}: {e}")
-
-    async def on_user_email_update_notification(self):
-        assert self.db_connection is not None
-        unsent_mails = await self.db_connection.fetch(
-            "select usr.id, usr.username, usr.email as old_email, pec.new_email as new_email, pec.token, "
-            "   pec.valid_until "
-            "from pending_email_change pec join usr on usr.id = pec.user_id "
-            "where pec.mail_next_attempt is not null and pec.mail_next_attempt < NOW() and pec.valid_until > NOW()"
+    async def _send_password_recovery_mail(self, row: asyncpg.Record):
+        await self.send_email(
+            "it looks like you forgot your password; how embarrasing.",
+            "",
+            "To set a new one, visit",
+            "",
+            f"{self.config.api.base_url}/confirm-password-recovery/{row['token']}",
+            "",
+            f"Your request will time out {row['valid_until']}.",
+            "If you do not want to reset your password, just ignore this email.",
+            subject="Reset password",
+            dest_address=row["email"],
+            dest_name=row["username"],
         )
 
-        if not unsent_mails:
-            self.logger.info("no user_email_update mails are pending")
-
-        for row in unsent_mails:
-            try:
-                self.send_email(
-                    "you want to change your email address",
-                    "",
-                    f"Your current email is: {row['old_email']}",
-                    f"You want to change it to: {row['new_email']}",
-                    "",
-                    "To confirm, see the mail that was sent to the new address.",
-                    "",
-                    f"Your request will time out {row['valid_until']}.",
-                    "If you do not want to change your email, just ignore this email.",
-                    subject="Change email",
-                    dest_address=row["old_email"],
-                    dest_name=row["username"],
-                )
-
-                self.send_email(
-                    "you want to change your email address",
-                    "",
-                    f"Your current email is: {row['old_email']}",
-                    f"You want to change it to: {row['new_email']}",
-                    "",
-                    "To confirm, visit",
-                    "",
-                    f"{self.config.api.base_url}/confirm-email-change/{row['token']}",
-                    "",
-                    f"Your request will time out {row['valid_until']}.",
-                    "If you do not want to change your email, just ignore this email.",
-                    subject="Change email",
-                    dest_address=row["new_email"],
-                    dest_name=row["username"],
-                )
+    async def _send_email_change_mails(self, row: asyncpg.Record):
+        assert self.db_pool is not None
+        # the confirmation is sent first and only once, a retry after the notice to the old address failed must not
+        # send it again
+        if not row["mail_confirmation_sent"]:
+            await self.send_email(
+                "you want to change your email address",
+                "",
+                f"Your current email is: {row['email']}",
+                f"You want to change it to: {row['new_email']}",
+                "",
+                "To confirm, visit",
+                "",
+                f"{self.config.api.base_url}/confirm-email-change/{row['token']}",
+                "",
+                f"Your request will time out {row['valid_until']}.",
+                "If you do not want to change your email, just ignore this email.",
+                subject="Change email",
+                dest_address=row["new_email"],
+                dest_name=row["username"],
+            )
+            await self.db_pool.execute(
+                "update pending_email_change set mail_confirmation_sent = true where token = $1", row["token"]
+            )
 
-                await self.db_connection.execute(
-                    "update pending_email_change set mail_next_attempt = null where token = $1",
-                    row["token"],
-                )
-            except smtplib.SMTPException as e:
-                self.logger.warning(f"Failed to send email to user {row['username']} with email {row['email']}: {e}")
+        await self.send_email(
+            "you want to change your email address",
+            "",
+            f"Your current email is: {row['email']}",
+            f"You want to change it to: {row['new_email']}",
+            "",
+            "To confirm, see the mail that was sent to the new address.",
+            "",
+            f"Your request will time out {row['valid_until']}.",
+            "If you do not want to change your email, just ignore this email.",
+            subject="Change email",
+            dest_address=row["email"],
+            dest_name=row["username"],
+        )
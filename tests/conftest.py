@@ -1,22 +1,31 @@
 # pylint: disable=attribute-defined-outside-init,missing-kwoa
+import atexit
 import os
 import secrets
+import shutil
+import tempfile
 from datetime import date
-from typing import Awaitable, Protocol
+from typing import AsyncIterator, Awaitable, Protocol
 
 import pytest
 from asyncpg.pool import Pool
 from sftkit.database import DatabaseConfig
 
 from abrechnung.application.accounts import AccountService
+from abrechnung.application.balances import BalanceService
 from abrechnung.application.export_import import ExportImportService
+from abrechnung.application.group_changes import GroupChangeService
 from abrechnung.application.groups import GroupService
+from abrechnung.application.settlement import SettlementService
+from abrechnung.application.thumbnails import ThumbnailService
 from abrechnung.application.transactions import TransactionService
 from abrechnung.application.users import UserService
 from abrechnung.config import (
     ApiConfig,
     Config,
     EmailConfig,
+    LocalBlobStorageConfig,
+    PasswordHashingConfig,
     RegistrationConfig,
     ServiceConfig,
 )
@@ -46,6 +55,9 @@ def get_test_db_config() -> DatabaseConfig:
     )
 
 
+TEST_BLOB_STORAGE_PATH = tempfile.mkdtemp(prefix="abrechnung-test-blobs-")
+atexit.register(shutil.rmtree, TEST_BLOB_STORAGE_PATH, ignore_errors=True)
+
 TEST_CONFIG = Config(
     email=EmailConfig(
         host="localhost",
@@ -59,6 +71,9 @@ TEST_CONFIG = Config(
         base_url="https://abrechnung.example.lol",
     ),
     registration=RegistrationConfig(enabled=True),
+    # the lowest work factor bcrypt supports keeps the tests fast
+    password_hashing=PasswordHashingConfig(work_factor=4),
+    blob_storage=LocalBlobStorageConfig(type="local", path=TEST_BLOB_STORAGE_PATH),
     database=get_test_db_config(),
     service=ServiceConfig(
         name="Test Abrechnung",
@@ -90,16 +105,42 @@ async def group_service(db_pool: Pool) -> GroupService:
     return GroupService(db_pool, config=TEST_CONFIG)
 
 
+@pytest.fixture
+async def group_change_service(db_pool: Pool, group_service: GroupService) -> GroupChangeService:
+    return GroupChangeService(db_pool, config=TEST_CONFIG, group_service=group_service)
+
+
 @pytest.fixture
 async def account_service(db_pool: Pool) -> AccountService:
     return AccountService(db_pool, config=TEST_CONFIG)
 
 
+@pytest.fixture
+async def balance_service(db_pool: Pool) -> BalanceService:
+    return BalanceService(db_pool, config=TEST_CONFIG)
+
+
 @pytest.fixture
 async def transaction_service(db_pool: Pool) -> TransactionService:
     return TransactionService(db_pool, config=TEST_CONFIG)
 
 
+@pytest.fixture
+async def settlement_service(
+    db_pool: Pool, balance_service: BalanceService, transaction_service: TransactionService
+) -> SettlementService:
+    return SettlementService(
+        db_pool, config=TEST_CONFIG, balance_service=balance_service, transaction_service=transaction_service
+    )
+
+
+@pytest.fixture
+async def thumbnail_service(db_pool: Pool, transaction_service: TransactionService) -> AsyncIterator[ThumbnailService]:
+    service = ThumbnailService(db_pool, config=TEST_CONFIG, blob_service=transaction_service.blob_service)
+    yield service
+    service.shutdown()
+
+
 @pytest.fixture
 async def export_import_service(
     db_pool: Pool, group_service: GroupService, account_service: AccountService, transaction_service: TransactionService
@@ -122,7 +163,7 @@ async def create_test_user(db_pool: Pool, user_service: UserService) -> CreateTe
     async def _create() -> tuple[User, str]:
         async with db_pool.acquire() as conn:
             password = "asdf1234"
-            hashed_password = user_service._hash_password(password)  # pylint: disable=protected-access
+            hashed_password = await user_service._hash_password(password)  # pylint: disable=protected-access
             user_id = await conn.fetchval(
                 "insert into usr (username, email, hashed_password, pending) values ($1, $2, $3, false) returning id",
                 secrets.token_hex(20),
@@ -1,10 +1,12 @@
 # pylint: disable=attribute-defined-outside-init,missing-kwoa
+import asyncio
 import secrets
 from datetime import datetime, timedelta
 
 import pytest
 from asyncpg import Pool
-from sftkit.error import AccessDenied, InvalidArgument
+from sftkit.database import DatabaseHook
+from sftkit.error import AccessDenied, InvalidArgument, Unauthorized
 
 from abrechnung.application.groups import GroupService
 from abrechnung.application.users import UserService
@@ -150,3 +152,86 @@ async def test_password_recovery(user_service: UserService, db_pool: Pool, creat
     await user_service.confirm_password_recovery(token=str(confirmation_token), new_password=new_password)
 
     await user_service.login_user(username=user.username, password=new_password, session_name=secrets.token_hex(16))
+
+
+async def test_user_cache(db_pool: Pool, user_service: UserService, create_test_user: CreateTestUser):
+    # log in before listening for notifications, the notifications of the new sessions would race the assertions below
+    user, password = await create_test_user()
+    _, session_id, token = await user_service.login_user(
+        username=user.username, password=password, session_name="session"
+    )
+    _, other_session_id, other_token = await user_service.login_user(
+        username=user.username, password=password, session_name="other session"
+    )
+
+    hook = DatabaseHook(
+        db_pool,
+        channel="user_changed",
+        event_handler=user_service.handle_user_change_notification,
+        initial_run=True,
+    )
+    hook_task = asyncio.create_task(hook.run())
+    try:
+        for _ in range(100):
+            if user_service.user_cache.enabled:
+                break
+            await asyncio.sleep(0.01)
+        assert user_service.user_cache.enabled
+
+        cached = await user_service.get_user_from_token(token=token)
+        assert await user_service.get_user_from_token(token=token) is cached
+
+        # changes made through the service invalidate the cache right away
+        await user_service.logout_user(user=cached, session_id=other_session_id)
+        with pytest.raises(Unauthorized):
+            await user_service.get_user_from_token(token=other_token)
+
+        # changes made by other api workers arrive through the database notification
+        await user_service.get_user_from_token(token=token)
+        await db_pool.execute("delete from session where id = $1", session_id)
+        for _ in range(100):
+            if user_service.user_cache.get(session_id, user.id) is None:
+                break
+            await asyncio.sleep(0.01)
+        with pytest.raises(Unauthorized):
+            await user_service.get_user_from_token(token=token)
+    finally:
+        hook.stop()
+        await hook_task
+
+
+async def test_login_rehashes_password(db_pool: Pool, user_service: UserService, create_test_user: CreateTestUser):
+    user, password = await create_test_user()
+    hashed_password = await db_pool.fetchval("select hashed_password from usr where id = $1", user.id)
+    assert not user_service.password_hasher.needs_rehash(hashed_password)
+
+    user_service.password_hasher.work_factor = 5
+    try:
+        await user_service.login_user(username=user.username, password=password, session_name="session")
+        rehashed_password = await db_pool.fetchval("select hashed_password from usr where id = $1", user.id)
+        assert rehashed_password != hashed_password
+        assert not user_service.password_hasher.needs_rehash(rehashed_password)
+        await user_service.login_user(username=user.username, password=password, session_name="other session")
+    finally:
+        user_service.password_hasher.work_factor = TEST_CONFIG.password_hashing.work_factor
+
+
+async def test_password_hashing_does_not_block_event_loop(user_service: UserService):
+    ticks = 0
+
+    async def _tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+
+    ticker = asyncio.create_task(_tick())
+    try:
+        user_service.password_hasher.work_factor = 10
+        await asyncio.gather(
+            *(user_service._hash_password("password") for _ in range(4))  # pylint: disable=protected-access
+        )
+    finally:
+        user_service.password_hasher.work_factor = TEST_CONFIG.password_hashing.work_factor
+        ticker.cancel()
+    assert ticks > 10
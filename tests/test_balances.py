@@ -0,0 +1,267 @@
+# pylint: disable=attribute-defined-outside-init,missing-kwoa,unexpected-keyword-arg
+from datetime import date
+
+import pytest
+from asyncpg import Pool
+
+from abrechnung.application.accounts import AccountService
+from abrechnung.application.balances import (
+    BalanceService,
+    compute_account_balances,
+    compute_transaction_balance_effect,
+)
+from abrechnung.application.transactions import TransactionService
+from abrechnung.domain.accounts import AccountType, NewAccount
+from abrechnung.domain.balances import AccountBalanceMap
+from abrechnung.domain.groups import Group
+from abrechnung.domain.transactions import (
+    NewTransaction,
+    NewTransactionPosition,
+    SplitMode,
+    TransactionBatch,
+    TransactionShares,
+    TransactionType,
+    UpdateTransaction,
+)
+from abrechnung.domain.users import User
+
+from .conftest import CreateTestAccount, CreateTestEvent
+
+
+def _transaction(
+    type: TransactionType,
+    value: float,
+    creditor_shares: TransactionShares,
+    debitor_shares: TransactionShares,
+    currency_conversion_rate: float = 1.0,
+    split_mode: SplitMode = SplitMode.shares,
+    positions: list[NewTransactionPosition] | None = None,
+) -> NewTransaction:
+    return NewTransaction(
+        type=type,
+        name="foo",
+        description="",
+        value=value,
+        currency_identifier="EUR" if currency_conversion_rate == 1.0 else "USD",
+        currency_conversion_rate=currency_conversion_rate,
+        billed_at=date.today(),
+        creditor_shares=creditor_shares,
+        debitor_shares=debitor_shares,
+        split_mode=split_mode,
+        new_positions=positions or [],
+    )
+
+
+async def test_group_balances(
+    db_pool: Pool,
+    balance_service: BalanceService,
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_account: CreateTestAccount,
+    create_test_event: CreateTestEvent,
+):
+    a = (await create_test_account(dummy_group.id)).id
+    b = (await create_test_account(dummy_group.id)).id
+    c = (await create_test_account(dummy_group.id)).id
+    inner_event = (await create_test_event(dummy_group.id, {a: 1.0, b: 3.0})).id
+    outer_event = (await create_test_event(dummy_group.id, {inner_event: 1.0, c: 1.0})).id
+
+    transactions = [
+        # positions: c uses 30, b uses half of 20, the remaining 60 are split evenly between a and b
+        _transaction(
+            TransactionType.purchase,
+            100,
+            {a: 1.0},
+            {a: 1.0, b: 1.0},
+            positions=[
+                NewTransactionPosition(name="p1", price=30, communist_shares=0, usages={c: 1.0}),
+                NewTransactionPosition(name="p2", price=20, communist_shares=1, usages={b: 1.0}),
+            ],
+        ),
+        _transaction(TransactionType.transfer, 10, {b: 1.0}, {a: 1.0}, currency_conversion_rate=2.0),
+        _transaction(
+            TransactionType.purchase,
+            30,
+            {c: 1.0},
+            {a: 10.0, b: 20.0},
+            currency_conversion_rate=0.5,
+            split_mode=SplitMode.absolute,
+        ),
+        _transaction(TransactionType.purchase, 40, {a: 1.0}, {b: 0.25, c: 0.75}, split_mode=SplitMode.percent),
+        _transaction(TransactionType.purchase, 80, {c: 1.0}, {outer_event: 1.0}),
+    ]
+    for transaction in transactions:
+        await transaction_service.create_transaction(user=dummy_user, group_id=dummy_group.id, transaction=transaction)
+
+    deleted_id = await transaction_service.create_transaction(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        transaction=_transaction(TransactionType.purchase, 1000, {a: 1.0}, {b: 1.0}),
+    )
+    await transaction_service.delete_transaction(user=dummy_user, group_id=dummy_group.id, transaction_id=deleted_id)
+
+    balances = await balance_service.get_balances(user=dummy_user, group_id=dummy_group.id)
+
+    assert set(balances.keys()) == {a, b, c, inner_event, outer_event}
+    assert balances[a].before_clearing == pytest.approx(70 - 20 - 5 + 40)
+    assert balances[b].before_clearing == pytest.approx(-40 + 20 - 10 - 10)
+    assert balances[c].before_clearing == pytest.approx(-30 + 15 - 30 + 80)
+    assert balances[outer_event].before_clearing == pytest.approx(-80)
+
+    assert balances[a].balance == pytest.approx(85 - 10)
+    assert balances[b].balance == pytest.approx(-40 - 30)
+    assert balances[c].balance == pytest.approx(35 - 40)
+    assert balances[outer_event].balance == pytest.approx(0)
+    assert balances[inner_event].balance == pytest.approx(0)
+    assert sum(balance.balance for balance in balances.values()) == pytest.approx(0)
+
+    assert balances[outer_event].clearing_resolution == pytest.approx({inner_event: -40, c: -40})
+    assert balances[inner_event].clearing_resolution == pytest.approx({a: -10, b: -30})
+
+    assert balances[a].total_paid_purchases == pytest.approx(140)
+    assert balances[a].total_consumed_purchases == pytest.approx(30 + 5 + 10)
+    assert balances[a].total_received_transfers == pytest.approx(20)
+    assert balances[b].total_paid_transfers == pytest.approx(20)
+
+    _assert_balances_equal(balances, await _reference_balances(db_pool, dummy_group.id))
+
+    # the engine accepts api models just as well as database rows
+    accounts = [{"id": account_id, "type": "personal", "clearing_shares": {}} for account_id in (a, b, c)]
+    listed = await transaction_service.list_transactions(user=dummy_user, group_id=dummy_group.id)
+    from_models = compute_account_balances(
+        accounts,
+        [t.model_dump(mode="json") for t in listed if not t.deleted and t.debitor_shares.keys() != {outer_event}],
+    )
+    assert from_models[a].balance == pytest.approx(85)
+
+
+async def test_transaction_balance_effect_sums_to_zero():
+    effect = compute_transaction_balance_effect(
+        {
+            "value": 33,
+            "currency_conversion_rate": 1.3,
+            "split_mode": "shares",
+            "creditor_shares": {"1": 1.0, "2": 2.0},
+            "debitor_shares": {"2": 1.0, "3": 3.0},
+            "positions": [
+                {"price": 7, "communist_shares": 2, "usages": {"1": 1.0}, "deleted": False},
+                {"price": 100, "communist_shares": 0, "usages": {"4": 1.0}, "deleted": True},
+            ],
+        }
+    )
+    assert set(effect.keys()) == {1, 2, 3}
+    assert effect[1].positions == pytest.approx(7 / 3 * 1.3)
+    assert sum(e.total for e in effect.values()) == pytest.approx(0)
+
+
+async def _reference_balances(db_pool: Pool, group_id: int) -> AccountBalanceMap:
+    accounts = await db_pool.fetch(
+        "select account_id as id, type, clearing_shares from group_account_state_valid_at($1) where not deleted",
+        group_id,
+    )
+    transactions = await db_pool.fetch(
+        "select * from current_transaction_state where group_id = $1 and not deleted", group_id
+    )
+    return compute_account_balances(accounts, transactions)
+
+
+def _assert_balances_equal(cached: AccountBalanceMap, recomputed: AccountBalanceMap):
+    assert cached.keys() == recomputed.keys()
+    for account_id, balance in recomputed.items():
+        cached_balance = cached[account_id]
+        assert cached_balance.clearing_resolution.keys() == balance.clearing_resolution.keys()
+        assert cached_balance.model_dump() == pytest.approx(
+            balance.model_dump(exclude={"clearing_resolution"})
+            | {"clearing_resolution": pytest.approx(balance.clearing_resolution)}
+        )
+
+
+async def test_cached_balances_match_recomputation(
+    db_pool: Pool,
+    balance_service: BalanceService,
+    account_service: AccountService,
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_account: CreateTestAccount,
+    create_test_event: CreateTestEvent,
+):
+    async def _check():
+        cached = await balance_service.get_balances(user=dummy_user, group_id=dummy_group.id)
+        recomputed = await balance_service.compute_balances(user=dummy_user, group_id=dummy_group.id)
+        _assert_balances_equal(cached, recomputed)
+        _assert_balances_equal(recomputed, await _reference_balances(db_pool, dummy_group.id))
+
+    async def _is_cached() -> bool:
+        return await db_pool.fetchval("select exists (select from balance_cache where group_id = $1)", dummy_group.id)
+
+    a = (await create_test_account(dummy_group.id)).id
+    b = (await create_test_account(dummy_group.id)).id
+    c = (await create_test_account(dummy_group.id)).id
+    inner_event = await create_test_event(dummy_group.id, {a: 1.0, b: 1.0})
+    outer_event = (await create_test_event(dummy_group.id, {inner_event.id: 2.0, c: 1.0})).id
+    await _check()
+    assert await _is_cached()
+
+    purchase_id = await transaction_service.create_transaction(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        transaction=_transaction(
+            TransactionType.purchase,
+            120,
+            {a: 1.0},
+            {outer_event: 1.0, b: 1.0},
+            positions=[NewTransactionPosition(name="p", price=20, communist_shares=1, usages={c: 1.0})],
+        ),
+    )
+    transfer_id = await transaction_service.create_transaction(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        transaction=_transaction(TransactionType.transfer, 15, {c: 1.0}, {inner_event.id: 1.0}),
+    )
+    assert await _is_cached()
+    await _check()
+
+    await transaction_service.update_transaction(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        transaction_id=purchase_id,
+        transaction=UpdateTransaction(
+            **_transaction(TransactionType.purchase, 90, {b: 1.0}, {a: 1.0, outer_event: 3.0}).model_dump()
+        ),
+    )
+    await transaction_service.delete_transaction(user=dummy_user, group_id=dummy_group.id, transaction_id=transfer_id)
+    assert await _is_cached()
+    await _check()
+
+    # changing the clearing shares changes how everything booked onto the event is distributed
+    await account_service.update_account(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        account_id=inner_event.id,
+        account=NewAccount(
+            type=AccountType.clearing,
+            name=inner_event.name,
+            date_info=inner_event.date_info,
+            clearing_shares={a: 1.0, c: 4.0},
+        ),
+    )
+    assert not await _is_cached()
+    await _check()
+
+    # accounts created after the cache was filled
+    d = (await create_test_account(dummy_group.id)).id
+    await _check()
+    await transaction_service.batch_update_transactions(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        batch=TransactionBatch(
+            new_transactions=[
+                _transaction(TransactionType.purchase, 7, {d: 1.0}, {inner_event.id: 1.0, a: 2.0}),
+                _transaction(TransactionType.transfer, 3, {b: 1.0}, {d: 1.0}, currency_conversion_rate=1.5),
+            ]
+        ),
+    )
+    assert await _is_cached()
+    await _check()
@@ -0,0 +1,155 @@
+# pylint: disable=attribute-defined-outside-init,missing-kwoa
+import asyncio
+import hashlib
+import secrets
+from pathlib import Path
+
+import asyncpg
+import httpx
+import pytest
+from asyncpg import Pool
+
+from abrechnung.application.blobs import BlobService
+from abrechnung.config import LocalBlobStorageConfig, S3BlobStorageConfig
+from abrechnung.core.blob_storage import BLOB_CHUNK_SIZE, BlobStorage, LocalBlobStorage, S3BlobStorage
+
+from .conftest import TEST_CONFIG
+
+
+class S3StandIn:
+    """Minimal in memory stand-in for an S3 compatible object store"""
+
+    def __init__(self, access_key_id: str):
+        self.access_key_id = access_key_id
+        self.objects: dict[str, bytes] = {}
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        assert request.headers["authorization"].startswith(f"AWS4-HMAC-SHA256 Credential={self.access_key_id}/")
+        assert request.headers["x-amz-content-sha256"] == hashlib.sha256(request.content).hexdigest()
+        path = request.url.path
+        if request.method == "PUT":
+            self.objects[path] = request.content
+            return httpx.Response(200)
+        if path not in self.objects:
+            return httpx.Response(404)
+        if request.method == "GET" and "range" in request.headers:
+            first, last = request.headers["range"].removeprefix("bytes=").split("-")
+            return httpx.Response(206, content=self.objects[path][int(first) : int(last) + 1])
+        if request.method == "GET":
+            return httpx.Response(200, content=self.objects[path])
+        if request.method == "DELETE":
+            del self.objects[path]
+            return httpx.Response(204)
+        return httpx.Response(405)
+
+
+@pytest.fixture
+def s3_stand_in() -> S3StandIn:
+    return S3StandIn(access_key_id="abrechnung")
+
+
+@pytest.fixture
+def s3_storage(s3_stand_in: S3StandIn) -> S3BlobStorage:
+    return S3BlobStorage(
+        S3BlobStorageConfig(
+            type="s3",
+            endpoint_url="http://s3.localhost:9000",
+            bucket="attachments",
+            prefix="test/",
+            access_key_id=s3_stand_in.access_key_id,
+            secret_access_key="secret",
+        ),
+        transport=httpx.MockTransport(s3_stand_in.handle),
+    )
+
+
+async def _check_storage_roundtrip(storage: BlobStorage):
+    key = storage.new_key()
+    content = secrets.token_bytes(BLOB_CHUNK_SIZE + 1024)
+    await storage.put(key, content)
+    assert await storage.get(key) == content
+    assert b"".join([chunk async for chunk in storage.stream(key, 0, len(content))]) == content
+    assert (
+        b"".join([chunk async for chunk in storage.stream(key, 1000, BLOB_CHUNK_SIZE + 10)])
+        == content[1000 : BLOB_CHUNK_SIZE + 10]
+    )
+    await storage.delete(key)
+    with pytest.raises(FileNotFoundError):
+        await storage.get(key)
+    with pytest.raises(FileNotFoundError):
+        await anext(storage.stream(key, 0, len(content)))
+    # deleting twice is fine, e.g. if a previous cleanup run was interrupted
+    await storage.delete(key)
+
+
+async def test_local_blob_storage(tmp_path: Path):
+    await _check_storage_roundtrip(LocalBlobStorage(LocalBlobStorageConfig(type="local", path=tmp_path)))
+
+
+async def test_s3_blob_storage(s3_storage: S3BlobStorage, s3_stand_in: S3StandIn):
+    await _check_storage_roundtrip(s3_storage)
+
+    key = s3_storage.new_key()
+    await s3_storage.put(key, b"content")
+    assert s3_stand_in.objects == {f"/attachments/test/{key}": b"content"}
+
+
+async def test_move_blobs_to_storage(db_pool: Pool, s3_storage: S3BlobStorage, s3_stand_in: S3StandIn):
+    database_blob_service = BlobService(db_pool, TEST_CONFIG)
+    database_blob_service.storage = None
+    content = secrets.token_bytes(1024)
+    async with db_pool.acquire() as conn:
+        blob_id = await database_blob_service.store_blob(conn=conn, content=content, mime_type="image/png")
+        assert await conn.fetchval("select content from blob where id = $1", blob_id) == content
+        stored_blob = await database_blob_service.get_blob(conn=conn, blob_id=blob_id)
+    assert stored_blob.size == len(content)
+    assert stored_blob.sha256 == hashlib.sha256(content).hexdigest()
+    assert b"".join([chunk async for chunk in database_blob_service.stream_blob(stored_blob, 10, 20)]) == content[10:20]
+
+    blob_service = BlobService(db_pool, TEST_CONFIG, storage=s3_storage)
+    # all other tests store their blobs in the local blob storage of the test config
+    assert await blob_service.move_blobs_to_storage(batch_size=1) == 1
+    assert len(s3_stand_in.objects) == 1
+
+    async with db_pool.acquire() as conn:
+        blob = await conn.fetchrow("select content, storage_key from blob where id = $1", blob_id)
+        assert blob["content"] is None
+        assert await blob_service.read_blob(conn=conn, blob_id=blob_id) == ("image/png", content)
+        stored_blob = await blob_service.get_blob(conn=conn, blob_id=blob_id)
+    assert b"".join([chunk async for chunk in blob_service.stream_blob(stored_blob)]) == content
+    async with db_pool.acquire() as conn:
+        # uploading the same content again does not store it a second time
+        assert await blob_service.store_blob(conn=conn, content=content, mime_type="image/png") == blob_id
+    assert len(s3_stand_in.objects) == 1
+
+    await db_pool.execute("delete from blob where id = $1", blob_id)
+    # the queue also contains the blobs deleted by other tests
+    assert await blob_service.delete_orphaned_blobs() >= 1
+    assert s3_stand_in.objects == {}
+    assert await db_pool.fetchval("select count(*) from orphaned_blob where storage_key = $1", blob["storage_key"]) == 0
+
+
+async def test_concurrent_store_blob(db_pool: Pool):
+    blob_service = BlobService(db_pool, TEST_CONFIG)
+    content = secrets.token_bytes(1024)
+    # the services run in serializable transactions which are retried on serialization failures
+    async with db_pool.acquire() as conn1, db_pool.acquire() as conn2:
+        transaction1 = conn1.transaction(isolation="serializable")
+        await transaction1.start()
+        blob_id = await blob_service.store_blob(conn=conn1, content=content, mime_type="image/png")
+
+        transaction2 = conn2.transaction(isolation="serializable")
+        await transaction2.start()
+        # misses the uncommitted blob and waits for the first transaction on inserting its own
+        store = asyncio.create_task(blob_service.store_blob(conn=conn2, content=content, mime_type="image/png"))
+        await asyncio.sleep(0.1)
+        assert not store.done()
+        await transaction1.commit()
+        with pytest.raises(asyncpg.SerializationError):
+            await asyncio.wait_for(store, timeout=2)
+        await transaction2.rollback()
+
+        async with conn2.transaction(isolation="serializable"):
+            assert await blob_service.store_blob(conn=conn2, content=content, mime_type="image/png") == blob_id
+
+    assert await db_pool.fetchval("select count(*) from blob where sha256 = $1", hashlib.sha256(content).digest()) == 1
@@ -0,0 +1,205 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from asyncpg import Pool
+from sftkit.database import DatabaseHook
+from sftkit.error import InvalidArgument
+
+from abrechnung.application.accounts import AccountService
+from abrechnung.application.balances import BalanceService
+from abrechnung.application.export_import import ExportImportService
+from abrechnung.application.group_changes import GroupChangeService
+from abrechnung.application.groups import GroupService
+from abrechnung.application.settlement import SettlementService
+from abrechnung.application.thumbnails import ThumbnailService
+from abrechnung.application.transactions import TransactionService
+from abrechnung.application.users import UserService
+from abrechnung.domain.groups import Group
+from abrechnung.domain.users import User
+from abrechnung.http.api import get_server
+from abrechnung.http.context import Context
+
+from .conftest import TEST_CONFIG, CreateTestAccount, CreateTestUser
+
+
+async def test_group_changed_notifications(
+    db_pool: Pool,
+    group_service: GroupService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_user: CreateTestUser,
+    create_test_account: CreateTestAccount,
+):
+    notifications: asyncio.Queue[str] = asyncio.Queue()
+
+    def _on_notification(connection, pid, channel, payload):
+        del connection, pid, channel  # unused
+        notifications.put_nowait(payload)
+
+    async def _next_notification() -> str:
+        return await asyncio.wait_for(notifications.get(), timeout=2)
+
+    async with db_pool.acquire() as conn:
+        await conn.add_listener("group_changed", _on_notification)
+        try:
+            await create_test_account(group_id=dummy_group.id)
+            assert await _next_notification() == str(dummy_group.id)
+            # all notifications of a database transaction are delivered once
+            assert notifications.empty()
+
+            invite_id = await group_service.create_invite(
+                user=dummy_user,
+                group_id=dummy_group.id,
+                description="",
+                single_use=False,
+                join_as_editor=False,
+                valid_until=datetime.now() + timedelta(days=1),
+            )
+            invite = await group_service.get_invite(user=dummy_user, group_id=dummy_group.id, invite_id=invite_id)
+            user2, _ = await create_test_user()
+            await group_service.join_group(user=user2, invite_token=invite.token)
+            assert await _next_notification() == str(dummy_group.id)
+        finally:
+            await conn.remove_listener("group_changed", _on_notification)
+
+
+async def test_subscribe_to_group_changes(
+    db_pool: Pool,
+    group_service: GroupService,
+    group_change_service: GroupChangeService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_user: CreateTestUser,
+):
+    other_user, _ = await create_test_user()
+    with pytest.raises(InvalidArgument):
+        await group_change_service.subscribe(user=other_user, group_id=dummy_group.id)
+
+    hook = DatabaseHook(
+        db_pool, channel="group_changed", event_handler=group_change_service.handle_group_changed_notification
+    )
+    hook_task = asyncio.create_task(hook.run())
+    changes = await group_change_service.subscribe(user=dummy_user, group_id=dummy_group.id)
+    try:
+        group = await anext(changes)
+        assert group is not None and group.name == dummy_group.name
+        # give the hook time to start listening
+        await asyncio.sleep(0.1)
+
+        await group_service.update_group(
+            user=dummy_user,
+            group_id=dummy_group.id,
+            name="new name",
+            description=dummy_group.description,
+            add_user_account_on_join=dummy_group.add_user_account_on_join,
+            terms=dummy_group.terms,
+        )
+        group = await asyncio.wait_for(anext(changes), timeout=2)
+        assert group is not None and group.name == "new name"
+        assert group.last_changed > dummy_group.last_changed
+
+        # subscriptions end once the group is gone
+        await group_service.delete_group(user=dummy_user, group_id=dummy_group.id)
+        with pytest.raises(InvalidArgument):
+            await asyncio.wait_for(anext(changes), timeout=2)
+    finally:
+        await changes.aclose()
+        hook.stop()
+        await hook_task
+
+
+async def test_subscription_ends_when_member_leaves(
+    db_pool: Pool,
+    user_service: UserService,
+    group_service: GroupService,
+    group_change_service: GroupChangeService,
+    account_service: AccountService,
+    balance_service: BalanceService,
+    transaction_service: TransactionService,
+    settlement_service: SettlementService,
+    export_import_service: ExportImportService,
+    thumbnail_service: ThumbnailService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_user: CreateTestUser,
+):
+    # goes through the whole asgi app as the membership cache of the request must not outlive the membership
+    context = Context(
+        config=TEST_CONFIG,
+        user_service=user_service,
+        transaction_service=transaction_service,
+        account_service=account_service,
+        balance_service=balance_service,
+        settlement_service=settlement_service,
+        group_service=group_service,
+        export_import_service=export_import_service,
+        group_change_service=group_change_service,
+        thumbnail_service=thumbnail_service,
+    )
+    app = get_server(TEST_CONFIG).api
+
+    invite_id = await group_service.create_invite(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        description="",
+        single_use=False,
+        join_as_editor=False,
+        valid_until=None,
+    )
+    invite = await group_service.get_invite(user=dummy_user, group_id=dummy_group.id, invite_id=invite_id)
+    member, password = await create_test_user()
+    await group_service.join_group(user=member, invite_token=invite.token)
+    _, _, token = await user_service.login_user(username=member.username, password=password, session_name="test")
+
+    messages: asyncio.Queue[dict] = asyncio.Queue()
+    disconnected = asyncio.Event()
+
+    async def _receive():
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def _send(message):
+        await messages.put(message)
+
+    async def _next_message() -> dict:
+        return await asyncio.wait_for(messages.get(), timeout=2)
+
+    path = f"/api/v1/groups/{dummy_group.id}/changes"
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"authorization", f"Bearer {token}".encode())],
+        "server": ("test", 80),
+        "client": ("test", 1234),
+        "state": {"context": context},
+    }
+
+    hook = DatabaseHook(
+        db_pool, channel="group_changed", event_handler=group_change_service.handle_group_changed_notification
+    )
+    hook_task = asyncio.create_task(hook.run())
+    app_task = asyncio.create_task(app(scope, _receive, _send))
+    try:
+        assert (await _next_message())["status"] == 200
+        assert b"event: group_changed" in (await _next_message())["body"]
+        # give the hook time to start listening
+        await asyncio.sleep(0.1)
+
+        await group_service.leave_group(user=member, group_id=dummy_group.id)
+        # the stream ends cleanly instead of failing half way through the response
+        while (message := await _next_message()).get("more_body", False):
+            assert not message["body"]
+        await asyncio.wait_for(app_task, timeout=2)
+    finally:
+        disconnected.set()
+        if not app_task.done():
+            app_task.cancel()
+        hook.stop()
+        await hook_task
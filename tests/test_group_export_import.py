@@ -1,13 +1,20 @@
 import base64
+import io
+import json
+import secrets
+import tarfile
+import zipfile
 from pathlib import Path
 
 import pytest
+from sftkit.error import InvalidArgument
 
 from abrechnung.application.accounts import AccountService
+from abrechnung.application.balances import BalanceService
 from abrechnung.application.export_import import ExportImportService
 from abrechnung.application.groups import GroupService
 from abrechnung.application.transactions import TransactionService
-from abrechnung.domain.export_import import GroupJsonExportV1
+from abrechnung.domain.export_import import ExportFormat, GroupJsonExportV1
 from abrechnung.domain.groups import Group
 from abrechnung.domain.transactions import NewFile, NewTransactionPosition
 from abrechnung.domain.users import User
@@ -22,6 +29,7 @@ test_image = base64.b64encode((asset_base_path / "test_image.jpg").read_bytes())
 async def test_basic_json_export_import(
     group_service: GroupService,
     account_service: AccountService,
+    balance_service: BalanceService,
     transaction_service: TransactionService,
     export_import_service: ExportImportService,
     dummy_group: Group,
@@ -58,7 +66,7 @@ async def test_basic_json_export_import(
     await create_test_transfer(group_id=dummy_group.id, value=10, creditor_id=account2.id, debitor_id=account1.id)
     dump: GroupJsonExportV1 = await export_import_service.export_group_as_json(user=dummy_user, group_id=dummy_group.id)
 
-    group_id, _ = await export_import_service.import_group_from_json(
+    group_id, account_mapping = await export_import_service.import_group_from_json(
         user=dummy_user, group_json_dump=dump.model_dump_json()
     )
     new_group: Group = await group_service.get_group(user=dummy_user, group_id=group_id)
@@ -73,6 +81,19 @@ async def test_basic_json_export_import(
     transactions = await transaction_service.list_transactions(user=dummy_user, group_id=group_id)
     assert len(transactions) == 4
 
+    balances = await balance_service.get_balances(user=dummy_user, group_id=dummy_group.id)
+    imported_balances = await balance_service.get_balances(user=dummy_user, group_id=group_id)
+    for account_id, balance in balances.items():
+        assert imported_balances[account_mapping[account_id]].balance == pytest.approx(balance.balance)
+
+
+async def test_import_with_unknown_account(export_import_service: ExportImportService, dummy_user: User):
+    dump = json.loads((dump_assets_base_path / "basic.json").read_text())
+    dump["transactions"][0]["debitor_shares"] = {"424242": 1.0}
+    # the dump is validated as a whole before anything is written
+    with pytest.raises(InvalidArgument):
+        await export_import_service.import_group_from_json(user=dummy_user, group_json_dump=json.dumps(dump))
+
 
 def remap_dump_account_ids(dump: GroupJsonExportV1, account_mapping: dict[int, int]):
     def remap_shares(shares: dict[int, float]) -> dict[int, float]:
@@ -128,3 +149,90 @@ async def test_export_import_idempotence(
     reexported = reexported_dump.model_dump()
     remove_ids_from_transactions(reexported["transactions"])
     assert original == reexported
+
+
+async def test_streaming_export(
+    export_import_service: ExportImportService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_account: CreateTestAccount,
+    create_test_purchase: CreateTestPurchase,
+):
+    account1 = await create_test_account(group_id=dummy_group.id)
+    account2 = await create_test_account(group_id=dummy_group.id)
+    # larger than a blob chunk and not a multiple of three bytes to exercise the chunked base64 encoding
+    large_content = secrets.token_bytes(600 * 1024 + 1)
+    contents = [(asset_base_path / "test_image.jpg").read_bytes() + secrets.token_bytes(16), large_content]
+    for content in contents:
+        await create_test_purchase(
+            group_id=dummy_group.id,
+            value=10,
+            creditor_id=account1.id,
+            debitor_shares={account2.id: 1.0},
+            files=[NewFile(filename="file", mime_type="image/jpeg", content=base64.b64encode(content).decode("utf-8"))],
+        )
+    await create_test_purchase(
+        group_id=dummy_group.id, value=5, creditor_id=account2.id, debitor_shares={account1.id: 1.0}
+    )
+
+    async def _read(export_format: ExportFormat) -> bytes:
+        chunks = await export_import_service.export_group(
+            user=dummy_user, group_id=dummy_group.id, export_format=export_format
+        )
+        return b"".join([chunk async for chunk in chunks])
+
+    dump = await export_import_service.export_group_as_json(user=dummy_user, group_id=dummy_group.id)
+    streamed = await _read(ExportFormat.json)
+    assert json.loads(streamed) == json.loads(dump.model_dump_json())
+    assert sorted(
+        base64.b64decode(file.content) for transaction in dump.transactions for file in transaction.files
+    ) == sorted(contents)
+
+    with zipfile.ZipFile(io.BytesIO(await _read(ExportFormat.zip))) as archive:
+        zip_entries = {name: archive.read(name) for name in archive.namelist()}
+    with tarfile.open(fileobj=io.BytesIO(await _read(ExportFormat.tar))) as archive:
+        tar_entries = {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+    assert zip_entries == tar_entries
+
+    archived_dump = GroupJsonExportV1.model_validate_json(zip_entries["group.json"])
+    files = [file for transaction in archived_dump.transactions for file in transaction.files]
+    assert len(files) == 2
+    assert all(file.content is None for file in files)
+    assert sorted(zip_entries[file.path] for file in files) == sorted(contents)
+
+    # attachments of archive exports are not part of the json document, it cannot be imported on its own
+    with pytest.raises(InvalidArgument):
+        await export_import_service.import_group_from_json(
+            user=dummy_user, group_json_dump=zip_entries["group.json"].decode("utf-8")
+        )
+
+
+async def test_streaming_export_outlives_deleted_files(
+    export_import_service: ExportImportService,
+    group_service: GroupService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_account: CreateTestAccount,
+    create_test_purchase: CreateTestPurchase,
+):
+    account1 = await create_test_account(group_id=dummy_group.id)
+    account2 = await create_test_account(group_id=dummy_group.id)
+    content = secrets.token_bytes(1024)
+    await create_test_purchase(
+        group_id=dummy_group.id,
+        value=10,
+        creditor_id=account1.id,
+        debitor_shares={account2.id: 1.0},
+        files=[NewFile(filename="file", mime_type="image/jpeg", content=base64.b64encode(content).decode("utf-8"))],
+    )
+
+    chunks = await export_import_service.export_group(
+        user=dummy_user, group_id=dummy_group.id, export_format=ExportFormat.zip
+    )
+    # deleting the group drops its blobs, their contents stay in the blob storage until orphaned blobs are cleaned up
+    await group_service.delete_group(user=dummy_user, group_id=dummy_group.id)
+
+    with zipfile.ZipFile(io.BytesIO(b"".join([chunk async for chunk in chunks]))) as archive:
+        archived_dump = GroupJsonExportV1.model_validate_json(archive.read("group.json"))
+        files = [file for transaction in archived_dump.transactions for file in transaction.files]
+        assert [archive.read(file.path) for file in files] == [content]
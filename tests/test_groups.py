@@ -3,13 +3,18 @@ from datetime import datetime, timedelta
 
 import pytest
 from asyncpg import Pool
-from sftkit.error import InvalidArgument
+from sftkit.error import AccessDenied, InvalidArgument
 
 from abrechnung.application.groups import GroupService
+from abrechnung.core.auth import (
+    check_group_permissions,
+    group_membership_cache,
+    invalidate_group_membership_cache,
+)
 from abrechnung.domain.groups import Group, GroupInvite, GroupPreview
 from abrechnung.domain.users import User
 
-from .conftest import CreateTestUser
+from .conftest import CreateTestAccount, CreateTestUser
 
 
 async def test_basic_invites(
@@ -162,3 +167,95 @@ async def test_delete_group_fails_multiple_members(
 
     with pytest.raises(InvalidArgument):
         await group_service.delete_group(user=dummy_user, group_id=group_id)
+
+
+async def test_group_membership_cache(
+    db_pool: Pool,
+    group_service: GroupService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_user: CreateTestUser,
+):
+    invite_id = await group_service.create_invite(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        description="",
+        single_use=False,
+        join_as_editor=False,
+        valid_until=datetime.now() + timedelta(days=1),
+    )
+    invite = await group_service.get_invite(user=dummy_user, group_id=dummy_group.id, invite_id=invite_id)
+    user2, _ = await create_test_user()
+
+    with group_membership_cache():
+        with pytest.raises(InvalidArgument):
+            await group_service.get_group(user=user2, group_id=dummy_group.id)
+        # joining replaces the cached non-membership
+        await group_service.join_group(user=user2, invite_token=invite.token)
+        await group_service.get_group(user=user2, group_id=dummy_group.id)
+
+        async with db_pool.acquire() as conn:
+            with pytest.raises(AccessDenied):
+                await check_group_permissions(conn=conn, group_id=dummy_group.id, user=user2, can_write=True)
+        await group_service.update_member_permissions(
+            user=dummy_user, group_id=dummy_group.id, member_id=user2.id, can_write=True, is_owner=False
+        )
+        async with db_pool.acquire() as conn:
+            await check_group_permissions(conn=conn, group_id=dummy_group.id, user=user2, can_write=True)
+
+            # memberships are served from the cache until it is invalidated
+            await conn.execute(
+                "delete from group_membership where group_id = $1 and user_id = $2", dummy_group.id, user2.id
+            )
+            await check_group_permissions(conn=conn, group_id=dummy_group.id, user=user2)
+            invalidate_group_membership_cache(dummy_group.id)
+            with pytest.raises(InvalidArgument):
+                await check_group_permissions(conn=conn, group_id=dummy_group.id, user=user2)
+
+
+async def test_group_last_changed_tracks_all_changes(
+    group_service: GroupService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_user: CreateTestUser,
+    create_test_account: CreateTestAccount,
+):
+    last_changed = await group_service.get_last_changed(user=dummy_user, group_id=dummy_group.id)
+
+    async def assert_changed():
+        nonlocal last_changed
+        new_last_changed = await group_service.get_last_changed(user=dummy_user, group_id=dummy_group.id)
+        assert new_last_changed != last_changed
+        last_changed = new_last_changed
+
+    account = await create_test_account(dummy_group.id)
+    await assert_changed()
+
+    await group_service.send_group_message(user=dummy_user, group_id=dummy_group.id, message="hello")
+    await assert_changed()
+
+    invite_id = await group_service.create_invite(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        description="",
+        single_use=False,
+        join_as_editor=False,
+        valid_until=None,
+    )
+    await assert_changed()
+    invite = await group_service.get_invite(user=dummy_user, group_id=dummy_group.id, invite_id=invite_id)
+
+    user2, _ = await create_test_user()
+    await group_service.join_group(user=user2, invite_token=invite.token)
+    await assert_changed()
+
+    await group_service.update_member_owned_account(
+        user=user2, group_id=dummy_group.id, member_id=user2.id, owned_account_id=account.id
+    )
+    await assert_changed()
+
+    await group_service.leave_group(user=user2, group_id=dummy_group.id)
+    await assert_changed()
+
+    with pytest.raises(InvalidArgument):
+        await group_service.get_last_changed(user=user2, group_id=dummy_group.id)
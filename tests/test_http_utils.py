@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from abrechnung.http.utils import RangeNotSatisfiable, etag_matches, group_etag, parse_byte_range
+
+
+@pytest.mark.parametrize(
+    "range_header, expected",
+    [
+        ("bytes=0-99", (0, 100)),
+        ("bytes=100-", (100, 1000)),
+        ("bytes=900-2000", (900, 1000)),
+        ("bytes=-100", (900, 1000)),
+        ("bytes=-2000", (0, 1000)),
+        # ignored, the whole resource is returned instead
+        ("bytes=0-9,20-29", None),
+        ("bytes=10-5", None),
+        ("bytes=a-b", None),
+        ("items=0-9", None),
+    ],
+)
+def test_parse_byte_range(range_header: str, expected: tuple[int, int] | None):
+    assert parse_byte_range(range_header, 1000) == expected
+
+
+@pytest.mark.parametrize("range_header", ["bytes=1000-", "bytes=1000-1100", "bytes=-0"])
+def test_parse_byte_range_not_satisfiable(range_header: str):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_byte_range(range_header, 1000)
+
+
+def test_etag_matches():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"abc"', '"abc"')
+    assert etag_matches('"other", "abc"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches('"other"', '"abc"')
+
+
+def test_group_etag():
+    last_changed = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+    etag = group_etag(1, 2, last_changed)
+    assert etag.startswith('W/"') and etag.endswith('"')
+    assert etag == group_etag(1, 2, last_changed.astimezone(timezone(timedelta(hours=2))))
+    assert etag != group_etag(1, 2, last_changed + timedelta(microseconds=1))
+    assert etag != group_etag(1, 3, last_changed)
+    assert etag != group_etag(2, 2, last_changed)
+    assert etag_matches(etag.removeprefix("W/"), etag)
@@ -1,5 +1,6 @@
 # pylint: disable=attribute-defined-outside-init,missing-kwoa
 import asyncio
+import email.message
 from dataclasses import dataclass
 from typing import AsyncGenerator, Optional
 
@@ -10,6 +11,7 @@ from asyncpg import Pool
 
 from abrechnung.application.users import UserService
 from abrechnung.config import Config
+from abrechnung.core.smtp import SmtpPool
 from abrechnung.mailer import Mailer
 
 from .conftest import TEST_CONFIG, CreateTestUser
@@ -35,14 +37,20 @@ def decode(val: str | bytes | None) -> str:
 class DummySMTPHandler:
     def __init__(self):
         self.mail_queue: asyncio.Queue[smtp.Envelope] = asyncio.Queue()
+        # client addresses of the sessions mails have been delivered over
+        self.peers: set[tuple[str, int]] = set()
+        self.refused_addresses: set[str] = set()
 
     async def handle_RCPT(self, server, session, envelope: smtp.Envelope, address: str, rcpt_options):
         del server, session, rcpt_options  # unused
+        if address in self.refused_addresses:
+            return "550 No such user"
         envelope.rcpt_tos.append(address)
         return "250 OK"
 
     async def handle_DATA(self, server, session, envelope: smtp.Envelope):
-        del server, session  # unused
+        del server  # unused
+        self.peers.add(session.peer)
         await self.mail_queue.put(envelope)
         return "250 Message accepted for delivery"
 
@@ -107,3 +115,197 @@ async def test_password_reset_mail_delivery(test_fixture: TestFixtures, create_t
     assert mail is not None
     assert user.email in mail.rcpt_tos
     assert "[Test Abrechnung] Reset password" in decode(mail.content)
+
+
+def _test_message(i: int) -> email.message.EmailMessage:
+    msg = email.message.EmailMessage()
+    msg.set_content(f"mail {i}")
+    msg["Subject"] = f"mail {i}"
+    msg["To"] = f"user{i}@email.com"
+    msg["From"] = "abrechnung@stusta.de"
+    return msg
+
+
+async def test_smtp_pool_reuses_sessions():
+    smtp_handler = DummySMTPHandler()
+    controller = Controller(smtp_handler)
+    controller.start()
+    config = TEST_CONFIG.email.model_copy(update={"host": controller.hostname, "port": controller.port})
+    config.max_connections = 2
+    pool = SmtpPool(config)
+    try:
+        await asyncio.gather(*(pool.send(_test_message(i)) for i in range(10)))
+        assert smtp_handler.mail_queue.qsize() == 10
+        # mails are sent concurrently but never over more sessions than configured
+        assert 1 <= len(smtp_handler.peers) <= 2
+
+        # sessions closed by the server while idle are replaced transparently
+        port = controller.port
+        controller.stop()
+        controller = Controller(smtp_handler, port=port)
+        controller.start()
+        await pool.send(_test_message(10))
+        assert smtp_handler.mail_queue.qsize() == 11
+    finally:
+        await pool.close()
+        controller.stop()
+
+
+@pytest.fixture
+async def smtp_handler() -> AsyncGenerator[tuple[DummySMTPHandler, Config], None]:
+    handler = DummySMTPHandler()
+    controller = Controller(handler)
+    controller.start()
+    config = TEST_CONFIG.model_copy(deep=True)
+    config.email.host = controller.hostname
+    config.email.port = controller.port
+    config.email.address = "abrechnung@stusta.de"
+    yield handler, config
+    controller.stop()
+
+
+def _received_addresses(handler: DummySMTPHandler) -> list[str]:
+    addresses = []
+    while not handler.mail_queue.empty():
+        addresses.extend(handler.mail_queue.get_nowait().rcpt_tos)
+    return addresses
+
+
+async def test_concurrent_mailers_claim_disjoint_mails(
+    db_pool: Pool, smtp_handler: tuple[DummySMTPHandler, Config], create_test_user: CreateTestUser
+):
+    handler, config = smtp_handler
+    config.email.batch_size = 2
+    users = [(await create_test_user())[0] for _ in range(7)]
+    await db_pool.executemany(
+        "insert into pending_password_recovery (user_id) values ($1)", [(user.id,) for user in users]
+    )
+
+    mailers = [Mailer(config=config) for _ in range(3)]
+    for mailer in mailers:
+        mailer.db_pool = db_pool
+    try:
+        await asyncio.gather(*(mailer.deliver_pending_mails("pending_password_recovery") for mailer in mailers))
+    finally:
+        for mailer in mailers:
+            await mailer.smtp.close()
+
+    # every mail is sent exactly once, no matter which mailer claimed it
+    received = _received_addresses(handler)
+    for user in users:
+        assert received.count(user.email) == 1
+    rows = await db_pool.fetch(
+        "select mail_next_attempt, mail_attempts from pending_password_recovery where user_id = any($1::int[])",
+        [user.id for user in users],
+    )
+    assert all(row["mail_next_attempt"] is None and row["mail_attempts"] == 1 for row in rows)
+
+
+async def test_failed_mails_are_retried_and_given_up_on(
+    db_pool: Pool, smtp_handler: tuple[DummySMTPHandler, Config], create_test_user: CreateTestUser
+):
+    handler, config = smtp_handler
+    config.email.max_attempts = 2
+    user, _ = await create_test_user()
+    handler.refused_addresses.add(user.email)
+    await db_pool.execute("insert into pending_password_recovery (user_id) values ($1)", user.id)
+
+    mailer = Mailer(config=config)
+    mailer.db_pool = db_pool
+
+    async def _state():
+        return await db_pool.fetchrow(
+            "select mail_next_attempt > now() as postponed, mail_next_attempt is null as done, mail_attempts, "
+            "   mail_last_error, mail_failed_at "
+            "from pending_password_recovery where user_id = $1",
+            user.id,
+        )
+
+    try:
+        await mailer.deliver_pending_mails("pending_password_recovery")
+        state = await _state()
+        assert state["postponed"]
+        assert state["mail_attempts"] == 1
+        assert "550" in state["mail_last_error"]
+        assert state["mail_failed_at"] is None
+
+        # the retry is not due yet
+        await mailer.deliver_pending_mails("pending_password_recovery")
+        assert (await _state())["mail_attempts"] == 1
+
+        await db_pool.execute(
+            "update pending_password_recovery set mail_next_attempt = now() where user_id = $1", user.id
+        )
+        await mailer.deliver_pending_mails("pending_password_recovery")
+        state = await _state()
+        assert state["done"]
+        assert state["mail_attempts"] == 2
+        assert state["mail_failed_at"] is not None
+    finally:
+        await mailer.smtp.close()
+    assert user.email not in _received_addresses(handler)
+
+
+async def test_email_change_confirmation_is_not_resent(
+    db_pool: Pool, smtp_handler: tuple[DummySMTPHandler, Config], create_test_user: CreateTestUser
+):
+    handler, config = smtp_handler
+    user, _ = await create_test_user()
+    new_email = f"new-{user.email}"
+    handler.refused_addresses.add(user.email)
+    await db_pool.execute("insert into pending_email_change (user_id, new_email) values ($1, $2)", user.id, new_email)
+
+    mailer = Mailer(config=config)
+    mailer.db_pool = db_pool
+    try:
+        await mailer.deliver_pending_mails("pending_email_change")
+        assert _received_addresses(handler) == [new_email]
+
+        # only the notice to the old address is retried
+        handler.refused_addresses.clear()
+        await db_pool.execute("update pending_email_change set mail_next_attempt = now() where user_id = $1", user.id)
+        await mailer.deliver_pending_mails("pending_email_change")
+        assert _received_addresses(handler) == [user.email]
+    finally:
+        await mailer.smtp.close()
+    assert await db_pool.fetchval(
+        "select mail_next_attempt is null and mail_attempts = 2 from pending_email_change where user_id = $1", user.id
+    )
+
+
+async def test_notification_bursts_are_coalesced(
+    db_pool: Pool, smtp_handler: tuple[DummySMTPHandler, Config], create_test_user: CreateTestUser
+):
+    handler, config = smtp_handler
+    users = [(await create_test_user())[0] for _ in range(5)]
+    await db_pool.executemany(
+        "insert into pending_password_recovery (user_id) values ($1)", [(user.id,) for user in users]
+    )
+
+    mailer = Mailer(config=config)
+    mailer.db_pool = db_pool
+    n_deliveries = 0
+    deliver_pending_mails = mailer.deliver_pending_mails
+
+    async def _counting_deliver_pending_mails(table: str) -> int:
+        nonlocal n_deliveries
+        if table == "pending_password_recovery":
+            n_deliveries += 1
+        return await deliver_pending_mails(table)
+
+    mailer.deliver_pending_mails = _counting_deliver_pending_mails
+    mailer.events = asyncio.Queue()
+    for _ in range(500):
+        mailer.notification_callback(None, 0, "mailer", "pending_password_recovery")
+    mailer.events.put_nowait(StopIteration())
+    try:
+        await mailer._mailer_loop()  # pylint: disable=protected-access
+        await asyncio.gather(*mailer._deliveries.values())  # pylint: disable=protected-access
+    finally:
+        await mailer.smtp.close()
+
+    # the whole burst is handled within the debounce window of a single delivery
+    assert n_deliveries == 1
+    received = _received_addresses(handler)
+    for user in users:
+        assert received.count(user.email) == 1
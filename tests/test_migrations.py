@@ -0,0 +1,196 @@
+# pylint: disable=missing-kwoa
+from datetime import datetime, timedelta, timezone
+
+from asyncpg.pool import Pool
+from sftkit.database import Connection, SchemaMigration
+
+from abrechnung.database.migrations import DB_CODE_PATH, MIGRATION_PATH
+from abrechnung.domain.transactions import Transaction
+
+# the revision before current_transaction_state was introduced and the one materializing it
+PRE_MATERIALIZED_STATE_REVISION = "b59de5c4"
+MATERIALIZED_STATE_REVISION = "d1d0a2c7"
+
+
+async def _migrate(conn: Connection, after: str | None, until: str | None):
+    """Applies the migrations following revision `after` up to and including revision `until`"""
+    found = after is None
+    for migration in SchemaMigration.migrations_from_dir(MIGRATION_PATH):
+        if found:
+            await migration.apply(conn)
+        if migration.version == until:
+            return
+        if migration.version == after:
+            found = True
+
+
+async def _seed_transaction_history(conn: Connection) -> list[int]:
+    """
+    Writes committed, deleted and uncommitted revisions directly into the tables of the pre materialized state schema.
+
+    @returns the ids of all transactions with at least one committed revision
+    """
+    t0 = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+    user_id, other_user_id = [
+        await conn.fetchval(
+            "insert into usr (username, email, hashed_password, pending) values ($1, $2, 'x', false) returning id",
+            name,
+            f"{name}@example.lol",
+        )
+        for name in ["user", "other"]
+    ]
+    group_id = await conn.fetchval(
+        "insert into grp (name, created_by, currency_identifier) values ('group', $1, 'EUR') returning id", user_id
+    )
+    account1, account2 = [
+        await conn.fetchval("insert into account (group_id, type) values ($1, 'personal') returning id", group_id)
+        for _ in range(2)
+    ]
+    tag_id = await conn.fetchval("insert into tag (group_id, name) values ($1, 'food') returning id", group_id)
+    blob_id = await conn.fetchval(
+        "insert into blob (content, mime_type) values ('receipt', 'image/png') returning id",
+    )
+
+    async def _transaction(type_: str) -> int:
+        return await conn.fetchval(
+            "insert into transaction (group_id, type) values ($1, $2) returning id", group_id, type_
+        )
+
+    async def _revision(transaction_id: int, user: int, created_at: datetime | None) -> int:
+        return await conn.fetchval(
+            "insert into transaction_revision (user_id, transaction_id, created_at) values ($1, $2, $3) returning id",
+            user,
+            transaction_id,
+            created_at,
+        )
+
+    async def _history(
+        transaction_id: int,
+        revision_id: int,
+        value: float,
+        creditor_shares: dict[int, float],
+        debitor_shares: dict[int, float],
+        deleted: bool = False,
+    ):
+        await conn.execute(
+            "insert into transaction_history "
+            "(id, revision_id, currency_conversion_rate, value, billed_at, name, deleted, currency_identifier) "
+            "values ($1, $2, 1.0, $3, '2024-01-01', $4, $5, 'EUR')",
+            transaction_id,
+            revision_id,
+            value,
+            f"name {revision_id}",
+            deleted,
+        )
+        for table, shares in [("creditor_share", creditor_shares), ("debitor_share", debitor_shares)]:
+            for account_id, share in shares.items():
+                await conn.execute(
+                    f"insert into {table} (transaction_id, revision_id, account_id, shares) values ($1, $2, $3, $4)",
+                    transaction_id,
+                    revision_id,
+                    account_id,
+                    share,
+                )
+
+    async def _position(item_id: int, revision_id: int, price: float, usages: dict[int, float], deleted=False):
+        await conn.execute(
+            "insert into purchase_item_history (id, revision_id, name, price, communist_shares, deleted) "
+            "values ($1, $2, $3, $4, 1.0, $5)",
+            item_id,
+            revision_id,
+            f"item {item_id}",
+            price,
+            deleted,
+        )
+        for account_id, share in usages.items():
+            await conn.execute(
+                "insert into purchase_item_usage (item_id, revision_id, account_id, share_amount) "
+                "values ($1, $2, $3, $4)",
+                item_id,
+                revision_id,
+                account_id,
+                share,
+            )
+
+    # a purchase changed several times, the last committed revision only touches one of its positions
+    purchase = await _transaction("purchase")
+    item1, item2 = [
+        await conn.fetchval("insert into purchase_item (transaction_id) values ($1) returning id", purchase)
+        for _ in range(2)
+    ]
+    file_id = await conn.fetchval("insert into file (transaction_id) values ($1) returning id", purchase)
+    revision = await _revision(purchase, user_id, t0)
+    await _history(purchase, revision, 10.0, {account1: 1.0}, {account1: 1.0, account2: 2.5})
+    await conn.execute(
+        "insert into transaction_to_tag (transaction_id, revision_id, tag_id) values ($1, $2, $3)",
+        purchase,
+        revision,
+        tag_id,
+    )
+    await _position(item1, revision, 3.0, {account2: 1.0})
+    await conn.execute(
+        "insert into file_history (id, revision_id, filename, blob_id) values ($1, $2, 'receipt', $3)",
+        file_id,
+        revision,
+        blob_id,
+    )
+    revision = await _revision(purchase, user_id, t0 + timedelta(hours=1))
+    await _history(purchase, revision, 20.0, {account2: 1.0}, {account1: 1.0})
+    await _position(item1, revision, 4.0, {account1: 1.0, account2: 1.0})
+    await _position(item2, revision, 5.0, {})
+    revision = await _revision(purchase, user_id, t0 + timedelta(hours=3))
+    await _position(item2, revision, 6.0, {account2: 2.0}, deleted=True)
+    # pending changes of another user are not part of the committed state
+    revision = await _revision(purchase, other_user_id, None)
+    await _history(purchase, revision, 999.0, {account1: 1.0}, {account2: 1.0})
+    await _position(item1, revision, 999.0, {account2: 1.0})
+
+    # a deleted transfer
+    transfer = await _transaction("transfer")
+    revision = await _revision(transfer, user_id, t0)
+    await _history(transfer, revision, 5.0, {account1: 1.0}, {account2: 1.0})
+    revision = await _revision(transfer, user_id, t0 + timedelta(hours=2))
+    await _history(transfer, revision, 5.0, {account1: 1.0}, {account2: 1.0}, deleted=True)
+
+    # a transaction which was never committed
+    uncommitted = await _transaction("transfer")
+    revision = await _revision(uncommitted, other_user_id, None)
+    await _history(uncommitted, revision, 7.0, {account2: 1.0}, {account1: 1.0})
+
+    return [purchase, transfer]
+
+
+async def test_materialized_transaction_state_migration(db_pool: Pool):
+    def _normalize(transactions: list[Transaction]) -> list[Transaction]:
+        for t in transactions:
+            t.positions.sort(key=lambda p: p.id)
+            t.files.sort(key=lambda f: f.id)
+        return sorted(transactions, key=lambda t: t.id)
+
+    async with db_pool.acquire() as conn:
+        # the whole schema is rebuilt within a transaction which is rolled back, other tests are not affected
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            await conn.execute("drop schema public cascade")
+            await conn.execute("create schema public")
+            await conn.execute("create table schema_revision (version text not null primary key)")
+            await _migrate(conn, after=None, until=PRE_MATERIALIZED_STATE_REVISION)
+            committed_transaction_ids = await _seed_transaction_history(conn)
+
+            await _migrate(conn, after=PRE_MATERIALIZED_STATE_REVISION, until=MATERIALIZED_STATE_REVISION)
+            materialized = await conn.fetch_many(Transaction, "select * from current_transaction_state")
+
+            await _migrate(conn, after=MATERIALIZED_STATE_REVISION, until=None)
+            for code_file in sorted(DB_CODE_PATH.glob("*.sql")):
+                await conn.execute(code_file.read_text("utf-8"))
+            # the columns of current_transaction_state changed since its rows were read last
+            await conn.reload_schema_state()
+            recomputed = await conn.fetch_many(Transaction, "select * from full_transaction_state_valid_at(now())")
+            migrated = await conn.fetch_many(Transaction, "select * from current_transaction_state")
+        finally:
+            await transaction.rollback()
+
+    assert sorted(t.id for t in materialized) == sorted(committed_transaction_ids)
+    assert _normalize(materialized) == _normalize(recomputed)
+    assert _normalize(migrated) == _normalize(recomputed)
@@ -0,0 +1,149 @@
+# pylint: disable=attribute-defined-outside-init,missing-kwoa,unexpected-keyword-arg
+import random
+from datetime import date
+
+import pytest
+from sftkit.error import InvalidArgument
+
+from abrechnung.application.balances import BalanceService
+from abrechnung.application.settlement import (
+    EXACT_SETTLEMENT_MAX_ACCOUNTS,
+    SettlementService,
+    compute_settlement_plan,
+)
+from abrechnung.application.transactions import TransactionService
+from abrechnung.domain.balances import GroupSettlement, SettlementMode, SettlementPlan
+from abrechnung.domain.groups import Group
+from abrechnung.domain.transactions import NewTransaction, SplitMode, TransactionType
+from abrechnung.domain.users import User
+
+from .conftest import CreateTestAccount, CreateTestEvent
+
+
+def _settled_balances(balances: dict[int, float], plan: SettlementPlan) -> dict[int, float]:
+    settled = dict(balances)
+    for item in plan:
+        assert item.payment_amount > 0
+        settled[item.creditor_id] += item.payment_amount
+        settled[item.debitor_id] -= item.payment_amount
+    return settled
+
+
+def _random_balances(rng: random.Random, n_accounts: int) -> dict[int, float]:
+    # few distinct amounts such that there are zero sum subsets to find
+    amounts = [rng.choice([-1, 1]) * rng.randint(1, 6) * 2.5 for _ in range(n_accounts - 1)]
+    amounts.append(-sum(amounts))
+    return {account_id: amount for account_id, amount in enumerate(amounts, start=1)}
+
+
+def _min_transfers(balances: dict[int, float]) -> int:
+    """Minimal number of transfers by trying all ways to split the accounts into zero sum groups"""
+    amounts = [round(amount * 100) for amount in balances.values() if round(amount * 100) != 0]
+
+    def max_groups(remaining: tuple[int, ...]) -> int:
+        if not remaining:
+            return 0
+        first, rest = remaining[0], remaining[1:]
+        best = 0
+        for mask in range(1 << len(rest)):
+            group = [first] + [a for i, a in enumerate(rest) if mask >> i & 1]
+            if sum(group) == 0:
+                others = tuple(a for i, a in enumerate(rest) if not mask >> i & 1)
+                best = max(best, 1 + max_groups(others))
+        return best
+
+    return len(amounts) - max_groups(tuple(amounts))
+
+
+@pytest.mark.parametrize("mode", [SettlementMode.exact, SettlementMode.greedy, SettlementMode.auto])
+async def test_settlement_plan_settles_all_balances(mode: SettlementMode):
+    rng = random.Random(42)
+    for _ in range(100):
+        balances = _random_balances(rng, rng.randint(1, 9))
+        plan = compute_settlement_plan(balances, mode)
+        assert all(balance == pytest.approx(0) for balance in _settled_balances(balances, plan).values())
+        n_open = len([balance for balance in balances.values() if round(balance * 100) != 0])
+        assert len(plan) <= max(n_open - 1, 0)
+        if mode != SettlementMode.greedy:
+            assert len(plan) == _min_transfers(balances)
+
+
+async def test_settlement_plan_rounding():
+    # the cent lost when rounding the balances is taken from the largest one
+    plan = compute_settlement_plan({1: 10 / 3, 2: 10 / 3, 3: -20 / 3})
+    assert sorted((item.creditor_id, item.debitor_id, item.payment_amount) for item in plan) == [
+        (3, 1, 3.33),
+        (3, 2, 3.33),
+    ]
+    assert compute_settlement_plan({1: 0.001, 2: -0.001}) == []
+
+
+async def test_settlement_plan_rejects_unbalanced_balances():
+    # a residual within the rounding error of the accounts is still absorbed
+    assert len(compute_settlement_plan({1: 10.006, 2: 10.006, 3: -20.0})) == 2
+    with pytest.raises(InvalidArgument):
+        compute_settlement_plan({1: 10.0, 2: -9.0})
+    with pytest.raises(InvalidArgument):
+        compute_settlement_plan({1: 10.0, 2: 10.0, 3: -20.05}, SettlementMode.greedy)
+
+
+async def test_settlement_plan_modes():
+    rng = random.Random(1)
+    balances = _random_balances(rng, 400)
+    plan = compute_settlement_plan(balances, SettlementMode.auto)
+    assert plan == compute_settlement_plan(balances, SettlementMode.greedy)
+    assert all(balance == pytest.approx(0) for balance in _settled_balances(balances, plan).values())
+
+    with pytest.raises(InvalidArgument):
+        compute_settlement_plan(_random_balances(rng, EXACT_SETTLEMENT_MAX_ACCOUNTS + 5), SettlementMode.exact)
+
+
+async def test_settle_group(
+    balance_service: BalanceService,
+    settlement_service: SettlementService,
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_account: CreateTestAccount,
+    create_test_event: CreateTestEvent,
+):
+    a = (await create_test_account(dummy_group.id)).id
+    b = (await create_test_account(dummy_group.id)).id
+    c = (await create_test_account(dummy_group.id)).id
+    event = (await create_test_event(dummy_group.id, {a: 1.0, b: 1.0, c: 1.0})).id
+    await transaction_service.create_transaction(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        transaction=NewTransaction(
+            type=TransactionType.purchase,
+            name="dinner",
+            description="",
+            value=90,
+            currency_identifier=dummy_group.currency_identifier,
+            currency_conversion_rate=1.0,
+            billed_at=date.today(),
+            creditor_shares={a: 1.0},
+            debitor_shares={event: 1.0},
+            split_mode=SplitMode.shares,
+        ),
+    )
+
+    plan = await settlement_service.get_settlement_plan(user=dummy_user, group_id=dummy_group.id)
+    # the clearing account is not part of the plan, only the accounts it is distributed onto
+    assert sorted((item.creditor_id, item.debitor_id, item.payment_amount) for item in plan) == sorted(
+        [(b, a, 30.0), (c, a, 30.0)]
+    )
+
+    transfers = await settlement_service.settle_group(
+        user=dummy_user, group_id=dummy_group.id, settlement=GroupSettlement(name="settle up")
+    )
+    assert len(transfers) == 2
+    assert all(t.type == TransactionType.transfer and t.name == "settle up" for t in transfers)
+
+    balances = await balance_service.get_balances(user=dummy_user, group_id=dummy_group.id)
+    assert all(balance.balance == pytest.approx(0) for balance in balances.values())
+    assert await settlement_service.get_settlement_plan(user=dummy_user, group_id=dummy_group.id) == []
+    assert (
+        await settlement_service.settle_group(user=dummy_user, group_id=dummy_group.id, settlement=GroupSettlement())
+        == []
+    )
@@ -0,0 +1,116 @@
+# pylint: disable=attribute-defined-outside-init,missing-kwoa,unexpected-keyword-arg
+import asyncio
+import io
+import secrets
+from pathlib import Path
+
+import pytest
+from asyncpg.pool import Pool
+from PIL import Image
+from sftkit.error import InvalidArgument
+
+from abrechnung.application.groups import GroupService
+from abrechnung.application.thumbnails import ThumbnailService
+from abrechnung.application.transactions import TransactionService
+from abrechnung.core.thumbnails import THUMBNAIL_MIME_TYPE, ThumbnailError, render_thumbnails
+from abrechnung.domain.groups import Group
+from abrechnung.domain.users import User
+
+TEST_IMAGE = Path(__file__).parent / "assets" / "test_image.jpg"
+
+
+async def _chunks(content: bytes):
+    yield content
+
+
+async def _upload(transaction_service: TransactionService, user: User, group: Group, content: bytes) -> int:
+    uploaded = await transaction_service.upload_file(
+        user=user, group_id=group.id, mime_type="image/jpeg", content=_chunks(content)
+    )
+    return uploaded.blob_id
+
+
+def test_render_thumbnails():
+    content = TEST_IMAGE.read_bytes()
+    with Image.open(io.BytesIO(content)) as image:
+        original_size = image.size
+
+    thumbnails = render_thumbnails(content, [128, 512])
+    assert set(thumbnails) == {128, 512}
+    for size, thumbnail in thumbnails.items():
+        with Image.open(io.BytesIO(thumbnail)) as image:
+            assert image.format == "WEBP"
+            assert max(image.size) <= size
+            # the aspect ratio is kept
+            assert image.size[0] / image.size[1] == pytest.approx(original_size[0] / original_size[1], rel=0.05)
+
+    with pytest.raises(ThumbnailError):
+        render_thumbnails(b"not an image", [128])
+
+
+async def test_get_thumbnail(
+    db_pool: Pool,
+    thumbnail_service: ThumbnailService,
+    transaction_service: TransactionService,
+    group_service: GroupService,
+    dummy_group: Group,
+    dummy_user: User,
+):
+    blob_id = await _upload(
+        transaction_service, dummy_user, dummy_group, TEST_IMAGE.read_bytes() + secrets.token_bytes(16)
+    )
+
+    # thumbnails which do not exist yet are generated on their first request
+    thumbnail = await thumbnail_service.get_thumbnail(blob_id=blob_id, size=200)
+    assert thumbnail.mime_type == THUMBNAIL_MIME_TYPE
+    assert await db_pool.fetchval("select size from blob_thumbnail where blob_id = $1", thumbnail.id) == 256
+    assert await db_pool.fetchval("select count(*) from blob_thumbnail where source_blob_id = $1", blob_id) == 3
+    assert await thumbnail_service.get_thumbnail(blob_id=blob_id, size=200) == thumbnail
+    # sizes larger than the largest thumbnail get the largest one
+    large = await thumbnail_service.get_thumbnail(blob_id=blob_id, size=10000)
+    assert await db_pool.fetchval("select size from blob_thumbnail where blob_id = $1", large.id) == 512
+
+    # thumbnails are deleted together with the blob they belong to
+    thumbnail_blob_ids = [
+        row["blob_id"]
+        for row in await db_pool.fetch("select blob_id from blob_thumbnail where source_blob_id = $1", blob_id)
+    ]
+    await group_service.delete_group(user=dummy_user, group_id=dummy_group.id)
+    assert await db_pool.fetchval("select count(*) from blob where id = $1", blob_id) == 0
+    assert await db_pool.fetchval("select count(*) from blob where id = any($1::int[])", thumbnail_blob_ids) == 0
+
+
+async def test_blob_created_notification(
+    db_pool: Pool,
+    thumbnail_service: ThumbnailService,
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+):
+    blob_id = await _upload(
+        transaction_service, dummy_user, dummy_group, TEST_IMAGE.read_bytes() + secrets.token_bytes(16)
+    )
+
+    # every api worker receives the notification but only one of them generates the thumbnails
+    await thumbnail_service.handle_blob_created_notification(str(blob_id))
+    await thumbnail_service.handle_blob_created_notification(str(blob_id))
+    await asyncio.gather(*thumbnail_service._tasks)  # pylint: disable=protected-access
+    assert await db_pool.fetchval("select count(*) from blob_thumbnail where source_blob_id = $1", blob_id) == 3
+    assert await db_pool.fetchval("select thumbnailed_at is not null from blob where id = $1", blob_id)
+
+    # generated thumbnails are not thumbnailed themselves
+    thumbnail = await thumbnail_service.get_thumbnail(blob_id=blob_id, size=128)
+    await thumbnail_service.handle_blob_created_notification(str(thumbnail.id))
+    await asyncio.gather(*thumbnail_service._tasks)  # pylint: disable=protected-access
+    assert await db_pool.fetchval("select count(*) from blob_thumbnail where source_blob_id = $1", thumbnail.id) == 0
+
+
+async def test_thumbnail_of_non_image(
+    thumbnail_service: ThumbnailService,
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+):
+    blob_id = await _upload(transaction_service, dummy_user, dummy_group, b"not an image" + secrets.token_bytes(16))
+    with pytest.raises(InvalidArgument):
+        await thumbnail_service.get_thumbnail(blob_id=blob_id, size=128)
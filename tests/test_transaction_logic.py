@@ -1,11 +1,15 @@
 # pylint: disable=attribute-defined-outside-init,missing-kwoa,unexpected-keyword-arg
 import base64
+import secrets
 from datetime import datetime
 from pathlib import Path
 
 import pytest
+from asyncpg import Pool
+from sftkit.error import InvalidArgument
 
 from abrechnung.application.accounts import AccountService
+from abrechnung.application.groups import GroupService
 from abrechnung.application.transactions import TransactionService
 from abrechnung.domain.accounts import AccountType, ClearingAccount, NewAccount
 from abrechnung.domain.groups import Group
@@ -19,6 +23,7 @@ from abrechnung.domain.transactions import (
     UpdateTransaction,
 )
 from abrechnung.domain.users import User
+from tests.conftest import CreateTestUser
 
 
 async def _create_accounts(
@@ -204,3 +209,153 @@ async def test_file_upload(
     transaction = await transaction_service.get_transaction(user=dummy_user, transaction_id=transaction_id)
     assert len(transaction.files) == 1
     assert transaction.files[0].deleted
+
+
+async def test_file_deduplication(
+    db_pool: Pool,
+    account_service: AccountService,
+    group_service: GroupService,
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+):
+    account1_id, account2_id = await _create_accounts(account_service, dummy_group, dummy_user, 2)
+    # unique content, blobs are shared with the files of other tests otherwise
+    image_content = (Path(__file__).parent / "assets" / "test_image.jpg").read_bytes() + secrets.token_bytes(16)
+    image_base64 = base64.b64encode(image_content).decode("ascii")
+
+    transaction_ids = []
+    for filename in ["receipt", "receipt copy"]:
+        transaction_ids.append(
+            await transaction_service.create_transaction(
+                user=dummy_user,
+                group_id=dummy_group.id,
+                transaction=NewTransaction(
+                    type=TransactionType.purchase,
+                    name="foo",
+                    description="foo",
+                    billed_at=datetime.now().date(),
+                    currency_identifier="EUR",
+                    currency_conversion_rate=1.0,
+                    tags=[],
+                    value=33,
+                    debitor_shares={account1_id: 1.0},
+                    creditor_shares={account2_id: 1.0},
+                    split_mode=SplitMode.shares,
+                    new_files=[NewFile(filename=filename, mime_type="image/jpeg", content=image_base64)],
+                ),
+            )
+        )
+
+    files = [
+        (await transaction_service.get_transaction(user=dummy_user, transaction_id=transaction_id)).files[0]
+        for transaction_id in transaction_ids
+    ]
+    assert files[0].id != files[1].id
+    assert files[0].blob_id == files[1].blob_id
+    blob_id = files[0].blob_id
+    assert await db_pool.fetchval("select ref_count from blob where id = $1", blob_id) == 2
+
+    for file in files:
+        _, content = await transaction_service.read_file_contents(user=dummy_user, file_id=file.id, blob_id=blob_id)
+        assert base64.b64encode(content).decode("ascii") == image_base64
+
+    # the blob is removed together with the last file revision referencing it
+    await group_service.delete_group(user=dummy_user, group_id=dummy_group.id)
+    assert await db_pool.fetchval("select count(*) from blob where id = $1", blob_id) == 0
+
+
+async def _chunks(content: bytes, chunk_size: int = 1000):
+    for offset in range(0, len(content), chunk_size):
+        yield content[offset : offset + chunk_size]
+
+
+async def test_file_upload_by_blob_id(
+    db_pool: Pool,
+    account_service: AccountService,
+    group_service: GroupService,
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_user: CreateTestUser,
+):
+    account1_id, account2_id = await _create_accounts(account_service, dummy_group, dummy_user, 2)
+    image_content = (Path(__file__).parent / "assets" / "test_image.jpg").read_bytes() + secrets.token_bytes(16)
+
+    uploaded = await transaction_service.upload_file(
+        user=dummy_user, group_id=dummy_group.id, mime_type="image/jpeg", content=_chunks(image_content)
+    )
+    assert uploaded.size == len(image_content)
+
+    def _new_transaction(blob_id: int) -> NewTransaction:
+        return NewTransaction(
+            type=TransactionType.purchase,
+            name="foo",
+            description="foo",
+            billed_at=datetime.now().date(),
+            currency_identifier="EUR",
+            currency_conversion_rate=1.0,
+            value=33,
+            debitor_shares={account1_id: 1.0},
+            creditor_shares={account2_id: 1.0},
+            split_mode=SplitMode.shares,
+            new_files=[NewFile(filename="receipt", blob_id=blob_id)],
+        )
+
+    transaction_id = await transaction_service.create_transaction(
+        user=dummy_user, group_id=dummy_group.id, transaction=_new_transaction(uploaded.blob_id)
+    )
+    transaction = await transaction_service.get_transaction(user=dummy_user, transaction_id=transaction_id)
+    assert transaction.files[0].blob_id == uploaded.blob_id
+    assert transaction.files[0].mime_type == "image/jpeg"
+    _, content = await transaction_service.read_file_contents(
+        user=dummy_user, file_id=transaction.files[0].id, blob_id=uploaded.blob_id
+    )
+    assert content == image_content
+
+    # uploads can only be attached within the group they were uploaded to
+    other_group_id = await group_service.create_group(
+        user=dummy_user,
+        name="other group",
+        description="",
+        currency_identifier="EUR",
+        terms="",
+        add_user_account_on_join=False,
+    )
+    with pytest.raises(InvalidArgument):
+        await transaction_service.create_transaction(
+            user=dummy_user, group_id=other_group_id, transaction=_new_transaction(uploaded.blob_id)
+        )
+
+    max_size = transaction_service.config.api.max_uploadable_file_size * 1024
+    with pytest.raises(InvalidArgument):
+        await transaction_service.upload_file(
+            user=dummy_user,
+            group_id=dummy_group.id,
+            mime_type="image/jpeg",
+            content=_chunks(secrets.token_bytes(max_size + 1), chunk_size=64 * 1024),
+        )
+
+    # users without write access are rejected before any content is received
+    outsider, _ = await create_test_user()
+
+    async def _unexpected_content():
+        raise AssertionError("the upload content must not be read")
+        yield b""  # pylint: disable=unreachable
+
+    with pytest.raises(InvalidArgument):
+        await transaction_service.upload_file(
+            user=outsider, group_id=dummy_group.id, mime_type="image/jpeg", content=_unexpected_content()
+        )
+
+    # expired uploads are discarded, their blobs only if no transaction attached them
+    unattached = await transaction_service.upload_file(
+        user=dummy_user, group_id=dummy_group.id, mime_type="image/png", content=_chunks(secrets.token_bytes(100))
+    )
+    await db_pool.execute(
+        "update blob_upload set uploaded_at = now() - interval '2 days' where blob_id = any($1::int[])",
+        [uploaded.blob_id, unattached.blob_id],
+    )
+    assert await transaction_service.blob_service.delete_expired_uploads() >= 2
+    assert await db_pool.fetchval("select ref_count from blob where id = $1", uploaded.blob_id) == 1
+    assert await db_pool.fetchval("select count(*) from blob where id = $1", unattached.blob_id) == 0
@@ -1,23 +1,32 @@
 # pylint: disable=missing-kwoa,unexpected-keyword-arg
+import base64
+import json
 from datetime import date, datetime
 
 import pytest
+from asyncpg.pool import Pool
+from pydantic import TypeAdapter
 
 from abrechnung.application.accounts import AccountService
 from abrechnung.application.transactions import TransactionService
+from abrechnung.domain.accounts import Account, ClearingAccount, PersonalAccount
 from abrechnung.domain.groups import Group
 from abrechnung.domain.transactions import (
+    ChangedTransaction,
+    FileAttachment,
+    NewFile,
     NewTransaction,
     NewTransactionPosition,
     SplitMode,
     Transaction,
+    TransactionBatch,
     TransactionPosition,
     TransactionType,
     UpdateTransaction,
 )
 from abrechnung.domain.users import User
 
-from .conftest import CreateTestAccount, CreateTestPurchase
+from .conftest import CreateTestAccount, CreateTestEvent, CreateTestPurchase
 
 
 async def test_list_transactions(
@@ -304,3 +313,421 @@ async def test_purchase_items(
     assert t.positions is not None
     assert len(t.positions) == 1
     assert account2.id in t.positions[0].usages
+
+
+async def test_current_transaction_state_matches_point_in_time_state(
+    db_pool: Pool,
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_account: CreateTestAccount,
+    create_test_purchase: CreateTestPurchase,
+):
+    account1 = await create_test_account(group_id=dummy_group.id)
+    account2 = await create_test_account(group_id=dummy_group.id)
+    purchase = await create_test_purchase(
+        group_id=dummy_group.id,
+        value=100,
+        creditor_id=account1.id,
+        debitor_shares={account1.id: 1.0, account2.id: 2.0},
+        positions=[
+            NewTransactionPosition(name="carrots", price=12.22, communist_shares=1, usages={account2.id: 1.0}),
+            NewTransactionPosition(name="potatoes", price=5.0, communist_shares=0, usages={account1.id: 1.0}),
+        ],
+    )
+    await transaction_service.update_transaction_positions(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        transaction_id=purchase.id,
+        positions=[
+            TransactionPosition(
+                id=purchase.positions[0].id,
+                name="carrots",
+                price=10.0,
+                communist_shares=0,
+                usages={account1.id: 1.0},
+                deleted=True,
+            )
+        ],
+    )
+    deleted_purchase = await create_test_purchase(
+        group_id=dummy_group.id,
+        value=10,
+        creditor_id=account2.id,
+        debitor_shares={account1.id: 1.0},
+    )
+    await transaction_service.delete_transaction(
+        user=dummy_user, group_id=dummy_group.id, transaction_id=deleted_purchase.id
+    )
+
+    async with db_pool.acquire() as conn:
+        materialized = await conn.fetch_many(
+            Transaction, "select * from current_transaction_state where group_id = $1", dummy_group.id
+        )
+        recomputed = await conn.fetch_many(
+            Transaction, "select * from full_transaction_state_valid_at(now()) where group_id = $1", dummy_group.id
+        )
+
+    def _normalize(transactions: list[Transaction]) -> list[Transaction]:
+        for t in transactions:
+            t.positions.sort(key=lambda p: p.id)
+        return sorted(transactions, key=lambda t: t.id)
+
+    assert len(materialized) == 2
+    assert _normalize(materialized) == _normalize(recomputed)
+
+
+async def test_group_scoped_state_matches_instance_wide_state(
+    db_pool: Pool,
+    dummy_group: Group,
+    create_test_account: CreateTestAccount,
+    create_test_purchase: CreateTestPurchase,
+):
+    account1 = await create_test_account(group_id=dummy_group.id)
+    account2 = await create_test_account(group_id=dummy_group.id)
+    await create_test_purchase(
+        group_id=dummy_group.id,
+        value=100,
+        creditor_id=account1.id,
+        debitor_shares={account2.id: 1.0},
+        positions=[
+            NewTransactionPosition(name="carrots", price=12.22, communist_shares=1, usages={account2.id: 1.0}),
+        ],
+    )
+
+    async with db_pool.acquire() as conn:
+        for group_scoped, instance_wide in [
+            (
+                "select * from group_full_account_state_valid_at($1) order by id",
+                "select * from full_account_state_valid_at(now()) where group_id = $1 order by id",
+            ),
+            (
+                "select * from group_transaction_state_valid_at($1) order by transaction_id",
+                "select * from transaction_state_valid_at(now()) where group_id = $1 order by transaction_id",
+            ),
+            (
+                "select * from group_transaction_position_state_valid_at($1) order by id",
+                "select p.* from transaction_position_state_valid_at(now()) p "
+                "join transaction t on p.transaction_id = t.id where t.group_id = $1 order by p.id",
+            ),
+        ]:
+            scoped = await conn.fetch(group_scoped, dummy_group.id)
+            unscoped = await conn.fetch(instance_wide, dummy_group.id)
+            assert len(scoped) > 0
+            assert [dict(r) for r in scoped] == [dict(r) for r in unscoped]
+
+
+async def test_update_transaction_with_new_and_changed_positions(
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_account: CreateTestAccount,
+    create_test_purchase: CreateTestPurchase,
+):
+    accounts = [await create_test_account(group_id=dummy_group.id) for _ in range(5)]
+    purchase = await create_test_purchase(
+        group_id=dummy_group.id,
+        value=100,
+        creditor_id=accounts[0].id,
+        debitor_shares={a.id: 1.0 for a in accounts},
+        positions=[NewTransactionPosition(name="carrots", price=12.22, communist_shares=1, usages={})],
+    )
+    carrots = purchase.positions[0]
+    await transaction_service.update_transaction(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        transaction_id=purchase.id,
+        transaction=UpdateTransaction(
+            type=TransactionType.purchase,
+            name="name123",
+            description="description123",
+            currency_identifier="EUR",
+            billed_at=date.today(),
+            currency_conversion_rate=1,
+            tags=["food", "trip", "food"],
+            value=100,
+            debitor_shares={a.id: 2.0 for a in accounts[1:]},
+            creditor_shares={accounts[0].id: 1.0},
+            split_mode=SplitMode.shares,
+            new_positions=[
+                NewTransactionPosition(
+                    name=f"item {i}", price=float(i), communist_shares=0, usages={a.id: 1.0 for a in accounts}
+                )
+                for i in range(10)
+            ],
+            changed_positions=[
+                TransactionPosition(
+                    id=carrots.id,
+                    name="carrots",
+                    price=10.0,
+                    communist_shares=0,
+                    usages={accounts[1].id: 3.0},
+                    deleted=False,
+                )
+            ],
+        ),
+    )
+
+    t = await transaction_service.get_transaction(user=dummy_user, transaction_id=purchase.id)
+    assert sorted(t.tags) == ["food", "trip"]
+    assert t.debitor_shares == {a.id: 2.0 for a in accounts[1:]}
+    assert len(t.positions) == 11
+    updated_carrots = next(p for p in t.positions if p.id == carrots.id)
+    assert updated_carrots.price == 10.0
+    assert updated_carrots.usages == {accounts[1].id: 3.0}
+    for position in t.positions:
+        if position.id != carrots.id:
+            assert position.usages == {a.id: 1.0 for a in accounts}
+
+    with pytest.raises(Exception):
+        await transaction_service.update_transaction_positions(
+            user=dummy_user,
+            group_id=dummy_group.id,
+            transaction_id=purchase.id,
+            positions=[
+                NewTransactionPosition(
+                    name="invalid", price=1.0, communist_shares=0, usages={accounts[0].id + 1000: 1.0}
+                )
+            ],
+        )
+
+
+async def test_update_same_position_twice(
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_account: CreateTestAccount,
+    create_test_purchase: CreateTestPurchase,
+):
+    account1 = await create_test_account(group_id=dummy_group.id)
+    account2 = await create_test_account(group_id=dummy_group.id)
+    purchase = await create_test_purchase(
+        group_id=dummy_group.id,
+        value=100,
+        creditor_id=account1.id,
+        debitor_shares={account1.id: 1.0},
+        positions=[NewTransactionPosition(name="carrots", price=12.22, communist_shares=1, usages={})],
+    )
+    carrots = purchase.positions[0]
+
+    await transaction_service.update_transaction_positions(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        transaction_id=purchase.id,
+        positions=[
+            TransactionPosition(
+                id=carrots.id,
+                name="carrots",
+                price=10.0,
+                communist_shares=0,
+                usages={account1.id: 1.0},
+                deleted=False,
+            ),
+            TransactionPosition(
+                id=carrots.id,
+                name="more carrots",
+                price=20.0,
+                communist_shares=0,
+                usages={account1.id: 2.0, account2.id: 1.0},
+                deleted=False,
+            ),
+        ],
+    )
+
+    t = await transaction_service.get_transaction(user=dummy_user, transaction_id=purchase.id)
+    assert len(t.positions) == 1
+    assert t.positions[0].name == "more carrots"
+    assert t.positions[0].price == 20.0
+    assert t.positions[0].usages == {account1.id: 2.0, account2.id: 1.0}
+
+
+async def test_batch_update_transactions(
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_account: CreateTestAccount,
+    create_test_purchase: CreateTestPurchase,
+):
+    account1 = await create_test_account(group_id=dummy_group.id)
+    account2 = await create_test_account(group_id=dummy_group.id)
+    existing = await create_test_purchase(
+        group_id=dummy_group.id, value=10, creditor_id=account1.id, debitor_shares={account2.id: 1.0}
+    )
+
+    def _new_transfer(value: float) -> NewTransaction:
+        return NewTransaction(
+            type=TransactionType.transfer,
+            name=f"transfer {value}",
+            description="",
+            currency_identifier="EUR",
+            currency_conversion_rate=1.0,
+            value=value,
+            billed_at=date.today(),
+            creditor_shares={account2.id: 1.0},
+            debitor_shares={account1.id: 1.0},
+            split_mode=SplitMode.shares,
+        )
+
+    transactions = await transaction_service.batch_update_transactions(
+        user=dummy_user,
+        group_id=dummy_group.id,
+        batch=TransactionBatch(
+            new_transactions=[_new_transfer(1.0), _new_transfer(2.0)],
+            changed_transactions=[
+                ChangedTransaction(
+                    id=existing.id,
+                    type=TransactionType.purchase,
+                    name="changed",
+                    description="",
+                    currency_identifier="EUR",
+                    currency_conversion_rate=1.0,
+                    value=20,
+                    billed_at=date.today(),
+                    creditor_shares={account1.id: 1.0},
+                    debitor_shares={account1.id: 1.0, account2.id: 1.0},
+                    split_mode=SplitMode.shares,
+                )
+            ],
+        ),
+    )
+    assert [t.value for t in transactions] == [1.0, 2.0, 20.0]
+    assert transactions[2].id == existing.id
+    assert transactions[2].debitor_shares == {account1.id: 1.0, account2.id: 1.0}
+    assert len(await transaction_service.list_transactions(user=dummy_user, group_id=dummy_group.id)) == 3
+
+    # the whole batch is rejected if any of its transactions references an unknown account
+    invalid = _new_transfer(3.0)
+    invalid.creditor_shares = {account2.id + 1000: 1.0}
+    with pytest.raises(Exception):
+        await transaction_service.batch_update_transactions(
+            user=dummy_user,
+            group_id=dummy_group.id,
+            batch=TransactionBatch(new_transactions=[_new_transfer(4.0), invalid]),
+        )
+    assert len(await transaction_service.list_transactions(user=dummy_user, group_id=dummy_group.id)) == 3
+
+    # changed transactions must keep their type
+    with pytest.raises(Exception, match="does not match the expected type"):
+        await transaction_service.batch_update_transactions(
+            user=dummy_user,
+            group_id=dummy_group.id,
+            batch=TransactionBatch(
+                changed_transactions=[
+                    ChangedTransaction(
+                        **_new_transfer(5.0).model_dump(exclude={"type"}),
+                        id=transactions[0].id,
+                        type=TransactionType.purchase,
+                    )
+                ]
+            ),
+        )
+
+
+async def test_paginate_and_stream_transactions(
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_account: CreateTestAccount,
+    create_test_purchase: CreateTestPurchase,
+):
+    account = await create_test_account(group_id=dummy_group.id)
+    for i in range(7):
+        await create_test_purchase(
+            group_id=dummy_group.id, value=i + 1, creditor_id=account.id, debitor_shares={account.id: 1.0}
+        )
+    all_transactions = await transaction_service.list_transactions(user=dummy_user, group_id=dummy_group.id)
+    assert [(t.last_changed, t.id) for t in all_transactions] == sorted(
+        (t.last_changed, t.id) for t in all_transactions
+    )
+
+    pages = []
+    after = None
+    while True:
+        page = await transaction_service.list_transactions(
+            user=dummy_user, group_id=dummy_group.id, after=after, limit=3
+        )
+        if not page:
+            break
+        pages.append(page)
+        after = (page[-1].last_changed, page[-1].id)
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [t.id for page in pages for t in page] == [t.id for t in all_transactions]
+
+    streamed = [
+        Transaction.model_validate_json(line)
+        async for line in transaction_service.stream_transactions_json(user=dummy_user, group_id=dummy_group.id)
+    ]
+    assert streamed == all_transactions
+
+    streamed = [
+        Transaction.model_validate_json(line)
+        async for line in transaction_service.stream_transactions_json(
+            user=dummy_user, group_id=dummy_group.id, after=(all_transactions[4].last_changed, all_transactions[4].id)
+        )
+    ]
+    assert streamed == all_transactions[5:]
+
+
+def _canonical_json(value) -> str:
+    # json.dumps renders ints and floats differently, comparing the rendered documents tells 1 and 1.0 apart
+    return json.dumps(value, sort_keys=True)
+
+
+async def test_list_json_matches_response_models(
+    db_pool: Pool,
+    account_service: AccountService,
+    transaction_service: TransactionService,
+    dummy_group: Group,
+    dummy_user: User,
+    create_test_account: CreateTestAccount,
+    create_test_event: CreateTestEvent,
+    create_test_purchase: CreateTestPurchase,
+):
+    account1 = await create_test_account(group_id=dummy_group.id)
+    account2 = await create_test_account(group_id=dummy_group.id)
+    await create_test_event(group_id=dummy_group.id, clearing_shares={account1.id: 1, account2.id: 2.5})
+    purchase = await create_test_purchase(
+        group_id=dummy_group.id,
+        value=100,
+        creditor_id=account1.id,
+        debitor_shares={account1.id: 1, account2.id: 2.5},
+        positions=[NewTransactionPosition(name="carrots", price=12, communist_shares=1, usages={account2.id: 1})],
+        files=[NewFile(filename="receipt", mime_type="image/png", content=base64.b64encode(b"foo").decode())],
+    )
+
+    whole_second_purchase = await create_test_purchase(
+        group_id=dummy_group.id, value=2.5, creditor_id=account2.id, debitor_shares={account1.id: 1}
+    )
+    # timestamps without fractional seconds are rendered without them
+    await db_pool.execute(
+        "update current_transaction_state set last_changed = date_trunc('second', last_changed) where id = $1",
+        whole_second_purchase.id,
+    )
+
+    transactions_json = await transaction_service.list_transactions_json(user=dummy_user, group_id=dummy_group.id)
+    transactions = await transaction_service.list_transactions(user=dummy_user, group_id=dummy_group.id)
+    assert _canonical_json(json.loads(transactions_json)) == _canonical_json(
+        [transaction.model_dump(mode="json") for transaction in transactions]
+    )
+    parsed_transactions = TypeAdapter(list[Transaction]).validate_json(transactions_json)
+    assert len(parsed_transactions) == 2
+    assert next(t for t in parsed_transactions if t.id == purchase.id).files[0].host_url is not None
+    assert parsed_transactions == transactions
+
+    accounts_json = await account_service.list_accounts_json(user=dummy_user, group_id=dummy_group.id)
+    accounts = await account_service.list_accounts(user=dummy_user, group_id=dummy_group.id)
+    assert _canonical_json(sorted(json.loads(accounts_json), key=lambda a: a["id"])) == _canonical_json(
+        sorted((account.model_dump(mode="json") for account in accounts), key=lambda a: a["id"])
+    )
+    parsed_accounts = TypeAdapter(list[Account]).validate_json(accounts_json)
+    assert len(parsed_accounts) == 3
+    assert sorted(parsed_accounts, key=lambda a: a.id) == sorted(accounts, key=lambda a: a.id)
+    # the json built by the database must not contain any fields not part of the response models
+    for account in json.loads(accounts_json):
+        model = ClearingAccount if account["type"] == "clearing" else PersonalAccount
+        assert set(account.keys()) == set(model.model_fields.keys())
+    for transaction in json.loads(transactions_json):
+        assert set(transaction.keys()) == set(Transaction.model_fields.keys())
+    transaction = next(t for t in json.loads(transactions_json) if t["id"] == purchase.id)
+    assert set(transaction["positions"][0].keys()) == set(TransactionPosition.model_fields.keys())
+    assert set(transaction["files"][0].keys()) == set(FileAttachment.model_fields.keys())
@@ -0,0 +1,179 @@
+# pylint: disable=missing-kwoa
+"""
+Compare the reference balance computation, which loops over the share dictionaries of every transaction,
+against the vectorized numpy implementation used for full recomputations.
+
+The first part runs against an existing group, e.g. one created by tools/generate_dummy_data.py, the second part
+resolves a synthetic clearing account graph of configurable size.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from abrechnung.application.balance_matrix import (
+    compute_account_balances_vectorized,
+    fetch_balance_arrays,
+    resolve_clearing_matrix,
+)
+from abrechnung.application.balances import (
+    _ordered_clearing_shares,
+    compute_account_balances,
+    resolve_clearing_accounts,
+)
+from abrechnung.config import read_config
+from abrechnung.database.migrations import get_database
+from abrechnung.domain.balances import AccountBalance
+
+
+def bench(name: str, n_runs: int, func: Callable[[], object]) -> float:
+    timings = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(f"{name:<45} {best * 1000:10.2f} ms")
+    return best
+
+
+async def bench_group(config_path: str, group_id: int, n_runs: int):
+    config = read_config(Path(config_path))
+    database = get_database(config.database)
+    db_pool = await database.create_pool()
+
+    async with db_pool.acquire() as conn:
+        accounts = await conn.fetch(
+            "select account_id as id, type, clearing_shares from group_account_state_valid_at($1) where not deleted",
+            group_id,
+        )
+        start = time.perf_counter()
+        transactions = await conn.fetch(
+            "select * from current_transaction_state where group_id = $1 and not deleted", group_id
+        )
+        fetch_rows = time.perf_counter() - start
+        start = time.perf_counter()
+        arrays = await fetch_balance_arrays(conn, group_id)
+        fetch_arrays = time.perf_counter() - start
+    await db_pool.close()
+
+    account_ids = [account["id"] for account in accounts]
+    clearing_shares = _ordered_clearing_shares(accounts)
+    print(
+        f"group {group_id}: {len(transactions)} transactions, {len(arrays.position_price)} positions, "
+        f"{len(accounts)} accounts, best of {n_runs} runs"
+    )
+    print(f"{'fetch rows':<45} {fetch_rows * 1000:10.2f} ms")
+    print(f"{'fetch arrays':<45} {fetch_arrays * 1000:10.2f} ms")
+    before = bench("reference", n_runs, lambda: compute_account_balances(accounts, transactions))
+    after = bench(
+        "vectorized",
+        n_runs,
+        lambda: compute_account_balances_vectorized(arrays, account_ids, clearing_shares),
+    )
+    print(f"{'':<45} speedup {before / after:.1f}x (computation only)")
+
+    reference = compute_account_balances(accounts, transactions)
+    vectorized = compute_account_balances_vectorized(arrays, account_ids, clearing_shares)
+    max_diff = max(abs(reference[i].balance - vectorized[i].balance) for i in account_ids) if account_ids else 0
+    print(f"{'':<45} max balance difference {max_diff:.3g}")
+
+
+def bench_clearing(n_accounts: int, n_clearing_accounts: int, n_runs: int, seed: int):
+    rng = random.Random(seed)
+    account_ids = list(range(1, n_accounts + 1))
+    clearing_ids = rng.sample(account_ids, n_clearing_accounts)
+    # clearing accounts only clear to accounts after them in this order which keeps the graph acyclic
+    position = {account_id: i for i, account_id in enumerate(clearing_ids)}
+    shares = {}
+    for clearing_account_id in clearing_ids:
+        candidates = [
+            account_id
+            for account_id in account_ids
+            if position.get(account_id, n_accounts) > position[clearing_account_id]
+        ]
+        shares[clearing_account_id] = {
+            account_id: float(rng.randint(1, 5)) for account_id in rng.sample(candidates, min(10, len(candidates)))
+        }
+    accounts = [
+        {
+            "id": account_id,
+            "type": "clearing" if account_id in shares else "personal",
+            "clearing_shares": shares.get(account_id, {}),
+        }
+        for account_id in account_ids
+    ]
+    clearing_shares = _ordered_clearing_shares(accounts)
+    initial = {account_id: rng.uniform(-100, 100) for account_id in account_ids}
+    sorted_ids = np.array(account_ids, dtype=np.int64)
+    initial_array = np.array([initial[account_id] for account_id in account_ids])
+
+    def reference():
+        balances = {account_id: AccountBalance(balance=value) for account_id, value in initial.items()}
+        resolve_clearing_accounts(balances, clearing_shares)
+        return balances
+
+    print(f"clearing graph: {n_accounts} accounts, {n_clearing_accounts} clearing accounts, best of {n_runs} runs")
+    before = bench("reference clearing resolution", n_runs, reference)
+    after = bench(
+        "matrix clearing resolution",
+        n_runs,
+        lambda: resolve_clearing_matrix(sorted_ids, initial_array, clearing_shares),
+    )
+    print(f"{'':<45} speedup {before / after:.1f}x")
+
+    reference_balances = reference()
+    matrix = resolve_clearing_matrix(sorted_ids, initial_array, clearing_shares)
+    max_diff = max(abs(reference_balances[a].balance - matrix.balance[i]) for i, a in enumerate(account_ids))
+    print(f"{'':<45} max balance difference {max_diff:.3g}")
+
+
+def parse_args():
+    cli = argparse.ArgumentParser(description=__doc__)
+
+    cli.add_argument(
+        "-c",
+        "--config-path",
+        default="/etc/abrechnung/abrechnung.yaml",
+        help="config file, default: %(default)s",
+    )
+    cli.add_argument(
+        "--group-id",
+        type=int,
+        help="id of the group to compute the balances of, skips the group benchmark if not given",
+    )
+    cli.add_argument(
+        "--accounts",
+        type=int,
+        default=500,
+        help="number of accounts of the synthetic clearing graph, default: %(default)s",
+    )
+    cli.add_argument(
+        "--clearing-accounts",
+        type=int,
+        default=200,
+        help="number of clearing accounts of the synthetic clearing graph, default: %(default)s",
+    )
+    cli.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="number of runs per variant, the fastest one is reported",
+    )
+    cli.add_argument("--seed", type=int, default=0, help="random seed of the synthetic clearing graph")
+    return cli.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.group_id is not None:
+        asyncio.run(bench_group(config_path=args.config_path, group_id=args.group_id, n_runs=args.runs))
+        print()
+    bench_clearing(
+        n_accounts=args.accounts, n_clearing_accounts=args.clearing_accounts, n_runs=args.runs, seed=args.seed
+    )
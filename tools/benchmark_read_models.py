@@ -0,0 +1,124 @@
+# pylint: disable=missing-kwoa
+"""
+Compare the per row cost of the transaction and account list responses built from validated pydantic models
+against the responses serialized by the database.
+
+Run it against a large synthetic group, e.g. one created by tools/generate_dummy_data.py.
+"""
+
+import argparse
+import asyncio
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from pydantic import TypeAdapter
+
+from abrechnung.application.accounts import AccountService
+from abrechnung.application.transactions import TransactionService
+from abrechnung.application.users import UserService
+from abrechnung.config import read_config
+from abrechnung.database.migrations import get_database
+from abrechnung.domain.accounts import Account
+from abrechnung.domain.transactions import Transaction
+
+
+async def bench(name: str, n_rows: int, n_runs: int, func: Callable[[], Awaitable[bytes | str]]) -> float:
+    timings = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(f"{name:<45} {best * 1000:10.1f} ms total {best / max(n_rows, 1) * 1e6:10.2f} us/row")
+    return best
+
+
+async def main(config_path: str, group_id: int, user_id: int, n_runs: int):
+    config = read_config(Path(config_path))
+
+    database = get_database(config.database)
+    db_pool = await database.create_pool()
+    user_service = UserService(db_pool, config)
+    account_service = AccountService(db_pool, config)
+    transaction_service = TransactionService(db_pool, config)
+    user = await user_service.get_user(user_id=user_id)
+
+    transaction_list = TypeAdapter(list[Transaction])
+    account_list = TypeAdapter(list[Account])
+
+    async def validated_transactions() -> bytes:
+        transactions = await transaction_service.list_transactions(user=user, group_id=group_id)
+        return transaction_list.dump_json(transactions)
+
+    async def validated_accounts() -> bytes:
+        accounts = await account_service.list_accounts(user=user, group_id=group_id)
+        return account_list.dump_json(accounts)
+
+    n_transactions = len(await transaction_service.list_transactions(user=user, group_id=group_id))
+    n_accounts = len(await account_service.list_accounts(user=user, group_id=group_id))
+    print(f"group {group_id}: {n_transactions} transactions, {n_accounts} accounts, best of {n_runs} runs")
+
+    before = await bench(
+        "transactions: validated models + serialization", n_transactions, n_runs, validated_transactions
+    )
+    after = await bench(
+        "transactions: database json",
+        n_transactions,
+        n_runs,
+        lambda: transaction_service.list_transactions_json(user=user, group_id=group_id),
+    )
+    print(f"{'':<45} speedup {before / after:.1f}x")
+
+    before = await bench("accounts: validated models + serialization", n_accounts, n_runs, validated_accounts)
+    after = await bench(
+        "accounts: database json",
+        n_accounts,
+        n_runs,
+        lambda: account_service.list_accounts_json(user=user, group_id=group_id),
+    )
+    print(f"{'':<45} speedup {before / after:.1f}x")
+
+    await db_pool.close()
+
+
+def parse_args():
+    cli = argparse.ArgumentParser(description=__doc__)
+
+    cli.add_argument(
+        "-c",
+        "--config-path",
+        default="/etc/abrechnung/abrechnung.yaml",
+        help="config file, default: %(default)s",
+    )
+    cli.add_argument(
+        "--group-id",
+        required=True,
+        type=int,
+        help="id of the group to list",
+    )
+    cli.add_argument(
+        "--user-id",
+        required=True,
+        type=int,
+        help="id of a user which is a member of the group",
+    )
+    cli.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="number of runs per variant, the fastest one is reported",
+    )
+    return cli.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(
+        main(
+            config_path=args.config_path,
+            group_id=args.group_id,
+            user_id=args.user_id,
+            n_runs=args.runs,
+        )
+    )